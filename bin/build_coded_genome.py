@@ -0,0 +1,32 @@
+import os, sys
+
+sys.path.insert(0, "/users/nboley/src/TF_binding/")
+
+import pyTFbindtools
+from pyTFbindtools.coded_genome import build_coded_genome
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert a fasta file into a memory mapped coded genome.')
+
+    parser.add_argument( '--fasta', type=file, required=True,
+        help='Fasta containing genome sequence (must be faidx indexed).')
+    parser.add_argument( '--output-prefix', '-o', 
+        help='Output prefix (default: the fasta filename without extension).')
+
+    args = parser.parse_args()
+    if args.output_prefix == None:
+        args.output_prefix = os.path.splitext(args.fasta.name)[0]
+    
+    return args.fasta.name, args.output_prefix
+
+def main():
+    fasta_fname, ofprefix = parse_arguments()
+    pyTFbindtools.log("Coding '%s'" % fasta_fname)
+    index_fname = build_coded_genome(fasta_fname, ofprefix)
+    pyTFbindtools.log("Wrote coded genome '%s'" % index_fname)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import os, sys
+
+sys.path.insert(0, "/users/nboley/src/TF_binding/")
+
+import pyTFbindtools
+from pyTFbindtools.score_genomic_regions import ATACSeqReads
+from pyTFbindtools.DNABindingProteins import ChIPSeqReads
+from pyTFbindtools.coverage_tracks import build_coverage_tracks
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Write the ATAC-seq and ChIP-seq coverage into a coverage track store.')
+
+    parser.add_argument( '--ATAC-seq-reads', type=file, required=True,
+        help='Indexed BAM file containing ATAC seq reads.')
+    parser.add_argument( '--ChIP-seq-reads', type=file, nargs='*', default=[],
+        help='Indexed BAM files containing ChIP-seq reads.')
+    parser.add_argument( '--output-dir', '-o', required=True,
+        help='The coverage track store directory.')
+
+    args = parser.parse_args()
+
+    atacseq_reads = ATACSeqReads(args.ATAC_seq_reads.name).init(
+        True, True, False, False)
+    chipseq_reads = [ChIPSeqReads(fp.name).init()
+                     for fp in args.ChIP_seq_reads]
+    return atacseq_reads, chipseq_reads, args.output_dir
+
+def main():
+    atacseq_reads, chipseq_reads, store_dir = parse_arguments()
+    build_coverage_tracks(store_dir, atacseq_reads, chipseq_reads)
+    pyTFbindtools.log("Wrote coverage tracks to '%s'" % store_dir)
+    return
+
+if __name__ == '__main__':
+    main()
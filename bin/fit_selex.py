@@ -1,5 +1,4 @@
 import os, sys
-import gzip
 
 from itertools import izip
 
@@ -12,11 +11,13 @@ import pyTFbindtools
 import pyTFbindtools.selex
 
 from pyTFbindtools.selex import (
-    find_pwm, code_seqs, 
+    find_pwm, code_reads, build_random_read_energies_pool,
     estimate_dg_matrix_with_adadelta,
     est_chem_potentials, bootstrap_lhds,
-    find_pwm_from_starting_alignment,
-    PartitionedAndCodedSeqs, calc_log_lhd_factory, base_map)
+    find_pwm_from_starting_alignment, find_pwms_from_starting_alignments,
+    PartitionedAndCodedSeqs, AdaDeltaState, calc_log_lhd_factory, base_map)
+from pyTFbindtools.selex.load_reads import load_rounds
+from pyTFbindtools.selex.cache import ArrayCache
 from pyTFbindtools.motif_tools import (
     load_energy_data, load_motifs, load_motif_from_text,
     logistic, Motif, R, T,
@@ -72,34 +73,23 @@ dna_conc = n_dna_seq/(6.02e23*5.0e-5) # mol/L
 prot_conc = dna_conc/25 # mol/L (should be 25)
 #prot_conc *= 10
 
-def load_text_file(fp):
-    seqs = []
-    for line in fp:
-        seqs.append(line.strip().upper())
-    return seqs
-
-def load_fastq(fp):
-    seqs = []
-    for i, line in enumerate(fp):
-        if i%4 == 1:
-            seqs.append(line.strip().upper())
-    return seqs
-
-def load_sequences(fnames):
-    rnds_and_seqs = []
-    for fname in sorted(fnames,
-                        key=lambda x: int(x.split("_")[-1].split(".")[0])):
-        opener = gzip.open if fname.endswith(".gz") else open  
-        with opener(fname) as fp:
-            loader = load_fastq if ".fastq" in fname else load_text_file
-            rnds_and_seqs.append( loader(fp) ) # [:1000]
-    return rnds_and_seqs
-
-def write_output(motif, ddg_array, ref_energy, ofp=sys.stdout):
+# the maximum number of motif lengths that fit_model tries
+MAX_NUM_MOTIF_LENS = 20
+
+def load_sequences(fnames, max_num_reads=None):
+    """Load the reads from each round into a coded uint8 matrix.
+
+    The rounds are ordered by the round number in their file names. If
+    pyTFbindtools.selex.CODED_SEQS_CACHE is set, the coded reads are cached.
+    """
+    return load_rounds(list(fnames), max_num_reads=max_num_reads,
+                       cache=pyTFbindtools.selex.CODED_SEQS_CACHE)
+
+def write_output(motif_name, ddg_array, ref_energy, ofp=sys.stdout):
     # normalize the array so that the consensus energy is zero
     consensus_energy = ddg_array.calc_min_energy(ref_energy)
     base_energies = ddg_array.calc_base_contributions()
-    print >> ofp, ">%s.ENERGY\t%.6f" % (motif.name, consensus_energy)
+    print >> ofp, ">%s.ENERGY\t%.6f" % (motif_name, consensus_energy)
     #print >> ofp, "\t".join(["pos", "A", "C", "G", "T"])
     conc_energies = []
     for pos, energies in enumerate(base_energies, start=1):
@@ -109,7 +99,7 @@ def write_output(motif, ddg_array, ref_energy, ofp=sys.stdout):
             "%.6f" % (x - energies.min()) 
             for x in energies )
 
-    print >> ofp, ">%s.PWM" % motif.name
+    print >> ofp, ">%s.PWM" % motif_name
     #print >> ofp, "\t".join(["pos", "A", "C", "G", "T"])
     for pos, energies in enumerate(conc_energies, start=1):
         pwm = 1-logistic(energies)
@@ -125,6 +115,9 @@ def parse_arguments():
     parser.add_argument( '--selex-files', nargs='+', type=file, required=True,
                          help='Files containing SELEX reads.')
 
+    parser.add_argument( '--max-num-reads', type=int,
+        help='Use a random subsample of at most this many reads per round.')
+
     parser.add_argument( '--background-sequence', type=file, 
         help='File containing reads sequenced from round 0.')
 
@@ -148,6 +141,18 @@ def parse_arguments():
         help='The random pool size for the bootstrap.')
 
 
+    parser.add_argument( '--threads', '-t', default=1, type=int,
+        help='The number of processes to use when fitting the model.')
+    parser.add_argument( '--backend', default='auto',
+        choices=pyTFbindtools.selex.backends.BACKEND_NAMES,
+        help='The compute backend (default: numba if installed, else numpy).')
+    parser.add_argument( '--cache-dir',
+        help='Directory to cache the coded reads and binding sites in.')
+    parser.add_argument( '--cache-size', type=float, default=50,
+        help='The maximum size of the cache in GB (default: 50).')
+    parser.add_argument( '--incremental', default=False, action='store_true',
+        help='Fit each new motif position before refining the full model.')
+
     parser.add_argument( '--verbose', default=False, action='store_true',
                          help='Print extra status information.')
     parser.add_argument( '--debug-verbose', default=False, action='store_true',
@@ -164,12 +169,18 @@ def parse_arguments():
     pyTFbindtools.selex.MAX_NUM_ITER = int(args.max_iter)
     assert args.momentum < 1 and args.momentum >= 0
     pyTFbindtools.selex.MOMENTUM = args.momentum
+    pyTFbindtools.selex.NTHREADS = args.threads
+    pyTFbindtools.selex.set_backend(args.backend)
+    if args.cache_dir != None:
+        pyTFbindtools.selex.CODED_SEQS_CACHE = ArrayCache(
+            args.cache_dir, int(args.cache_size*2**30))
     
     if args.random_seed != None:
         np.random.seed(args.random_seed)
 
     pyTFbindtools.log("Loading sequences", 'VERBOSE')
-    rnds_and_seqs = load_sequences(x.name for x in args.selex_files)
+    rnds_and_seqs = load_sequences(
+        (x.name for x in args.selex_files), args.max_num_reads)
 
     if args.starting_pwm != None:
         pyTFbindtools.log("Loading PWM starting location", 'VERBOSE')
@@ -191,27 +202,30 @@ def parse_arguments():
         motif = Motif("aligned_%imer" % args.initial_binding_site_len, 
                       factor_name, pwm)
     
-    return motif, rnds_and_seqs, int(args.random_seq_pool_size)
+    return ( motif, rnds_and_seqs, int(args.random_seq_pool_size), 
+             args.incremental )
 
 def build_pwm_from_energies(ddg_array, ref_energy, chem_pot):
-    from pyTFbindtools.selex import build_random_read_energies_pool, calc_occ
-    pwm = np.zeros((len(ddg_array)/3, 4))
+    from pyTFbindtools.selex import calc_occ
+    # score a random pool of binding sites, and weight each base by the 
+    # occupancy of the sites that contain it
+    motif_len = ddg_array.motif_len
     energies, seqs = build_random_read_energies_pool(
-        10000, len(ddg_array)/3, ddg_array, ref_energy, store_seqs=True)
+        10000, motif_len, ddg_array, ref_energy, store_seqs=True)
     occs = calc_occ(energies, ref_energy, chem_pot)
-    for seq, occ in izip(seqs, occs):
-        for base_pos, base in enumerate(seq):
-            pwm[base_pos,base_map(base)] += occ
+    pwm = np.array([np.bincount(seqs[:,pos], weights=occs, minlength=4)
+                    for pos in xrange(motif_len)])
     pwm = pwm.T/pwm.sum(1)
     return pwm
 
 def find_best_shift(rnds_and_seqs, ddg_array, ref_energy):
+    coded_reads = code_reads(rnds_and_seqs[-1])
     pwm = find_pwm_from_starting_alignment(
-        rnds_and_seqs[-1], build_pwm_from_energies(ddg_array, ref_energy, -12))
-    left_shift_pwm = find_pwm_from_starting_alignment(
-        rnds_and_seqs[-1], np.hstack((np.zeros((4,1)), pwm.T)))    
-    right_shift_pwm = find_pwm_from_starting_alignment(
-        rnds_and_seqs[-1], np.hstack((pwm.T, np.zeros((4,1)))))    
+        coded_reads, build_pwm_from_energies(ddg_array, ref_energy, -12))
+    # run the left and right shifted alignments together
+    left_shift_pwm, right_shift_pwm = find_pwms_from_starting_alignments(
+        coded_reads, [ np.hstack((np.zeros((4,1)), pwm.T)), 
+                       np.hstack((pwm.T, np.zeros((4,1)))) ])
     # calculate the entropies, and shift int he direction that gives the
     # smallest entropy
     left_shift_score = -(
@@ -225,24 +239,119 @@ def find_best_shift(rnds_and_seqs, ddg_array, ref_energy):
     else:
         return "RIGHT"
 
-def fit_model(rnds_and_seqs, ddg_array, ref_energy):
+def extend_motif(rnds_and_seqs, ddg_array, ref_energy):
+    """Add a base to the side of the motif that gives the smallest entropy.
+
+    Returns the extended ddg_array and the shift type ('LEFT' or 'RIGHT').
+    """
+    pyTFbindtools.log("Finding best shift", 'VERBOSE')
+    shift_type = find_best_shift(rnds_and_seqs, ddg_array, ref_energy)
+    if shift_type == 'LEFT':
+        pyTFbindtools.log("Adding left base to motif", level='VERBOSE' )
+        ddg_array = np.insert(ddg_array, 0, np.zeros(3, dtype='float32')
+                          ).view(DeltaDeltaGArray)
+    elif shift_type == 'RIGHT':
+        pyTFbindtools.log("Adding right base to motif", level='VERBOSE' )
+        ddg_array = np.append(ddg_array, np.zeros(3, dtype='float32')).view(
+            DeltaDeltaGArray)
+    else:
+        assert False, "Unrecognized shift type '%s'" % shift_type
+    return ddg_array, shift_type
+
+def extend_model(rnds_and_seqs, ddg_array, ref_energy, adadelta_state=None):
+    """Extend the motif by a base (see extend_motif).
+
+    If adadelta_state is set, accumulators are inserted for the new position.
+    Returns the extended ddg_array and the index of the new position.
+    """
+    ddg_array, shift_type = extend_motif(rnds_and_seqs, ddg_array, ref_energy)
+    new_pos = 0 if shift_type == 'LEFT' else ddg_array.motif_len-1
+    if adadelta_state is not None:
+        adadelta_state.insert_position(new_pos)
+    return ddg_array, new_pos
+
+def calc_max_motif_len(rnds_and_seqs, initial_motif_len):
+    """The longest motif that fit_model grows from initial_motif_len.
+    """
+    return min(initial_motif_len + MAX_NUM_MOTIF_LENS - 1,
+               len(rnds_and_seqs[0][0]))
+
+def model_has_converged(lhd_path):
+    """Check whether adding the last base failed to improve the lhd.
+    """
+    return lhd_path[0] + 10 > lhd_path[-1]
+
+def fit_model(rnds_and_seqs, ddg_array, ref_energy,
+              dna_conc=dna_conc, prot_conc=prot_conc, 
+              callback=None, incremental=False,
+              max_motif_len=None, adadelta_state=None, new_pos=None):
+    """Fit the energy model, growing the motif until the lhd stops improving.
+
+    The motif grows to at most max_motif_len bases (default: 
+    calc_max_motif_len of the initial motif length).
+
+    If callback is set, it is called with (bs_len, ref_energy, ddg_array, 
+    chem_pots, lhd_hat, lhd_path, adadelta_state) after each motif length is
+    fit (e.g. to checkpoint the fit).
+
+    If incremental is set, then each extended motif re-uses the partitioned
+    reads and the AdaDelta state from the previous motif length, and the new
+    position is fit (with the rest of the model fixed) before the full model 
+    is refined. To continue an incremental fit from an extended motif, pass 
+    the AdaDelta state (with the new position inserted) and the new position.
+    """
     opt_path = []
     prev_lhd = None
-    for rnd_num in xrange(min(20, 
-                              len(rnds_and_seqs[0][0])-ddg_array.motif_len+1)):
+    # code the reads once, and re-use them for every motif length
+    rnds_and_coded_reads = [code_reads(seqs) for seqs in rnds_and_seqs]
+    partitioned_and_coded_rnds_and_seqs = None
+    if max_motif_len is None:
+        max_motif_len = calc_max_motif_len(rnds_and_seqs, ddg_array.motif_len)
+    if incremental:
+        assert not pyTFbindtools.selex.USE_SHAPE, \
+            "Incremental fitting doesn't support shape parameters"
+        if adadelta_state is None:
+            adadelta_state = AdaDeltaState(len(ddg_array)+1)
+            new_pos = None
+    else:
+        adadelta_state = None
+        new_pos = None
+    for rnd_num in xrange(max_motif_len-ddg_array.motif_len+1):
         bs_len = ddg_array.motif_len
         pyTFbindtools.log("Coding sequences", 'VERBOSE')
-        partitioned_and_coded_rnds_and_seqs = PartitionedAndCodedSeqs(
-            rnds_and_seqs, bs_len)
+        if incremental and partitioned_and_coded_rnds_and_seqs is not None:
+            partitioned_and_coded_rnds_and_seqs = \
+                partitioned_and_coded_rnds_and_seqs.recode(bs_len)
+        else:
+            partitioned_and_coded_rnds_and_seqs = PartitionedAndCodedSeqs(
+                rnds_and_coded_reads, bs_len)
+
+        new_pos_lhd_path = []
+        if incremental and new_pos is not None:
+            pyTFbindtools.log("Estimating the new position", 'VERBOSE')
+            free_params = np.zeros(len(ddg_array)+1, dtype=bool)
+            free_params[1+3*new_pos:1+3*(new_pos+1)] = True
+            ( ddg_array, ref_energy, chem_pots, new_pos_lhd_path, lhd_hat 
+                ) = estimate_dg_matrix_with_adadelta(
+                    partitioned_and_coded_rnds_and_seqs,
+                    ddg_array, ref_energy,
+                    dna_conc, prot_conc,
+                    adadelta_state=adadelta_state,
+                    free_params=free_params)
 
         pyTFbindtools.log("Estimating energy model", 'VERBOSE')
         ( ddg_array, ref_energy, chem_pots, lhd_path, lhd_hat 
             ) = estimate_dg_matrix_with_adadelta(
                 partitioned_and_coded_rnds_and_seqs,
                 ddg_array, ref_energy,
-                dna_conc, prot_conc)
+                dna_conc, prot_conc,
+                adadelta_state=adadelta_state)
+        lhd_path = new_pos_lhd_path + lhd_path
 
         opt_path.append([bs_len, lhd_hat, ddg_array, ref_energy])
+        if callback is not None:
+            callback(bs_len, ref_energy, ddg_array, 
+                     chem_pots, lhd_hat, lhd_path, adadelta_state)
 
         pyTFbindtools.log(ddg_array.consensus_seq(), 'VERBOSE')
         pyTFbindtools.log("Ref: %s" % ref_energy, 'VERBOSE')
@@ -259,25 +368,20 @@ def fit_model(rnds_and_seqs, ddg_array, ref_energy):
         pyTFbindtools.log("Prev: %.2f\tCurr: %.2f\tDiff: %.2f" % (
             lhd_path[0], lhd_path[-1], lhd_path[0]-lhd_path[-1]), 'VERBOSE')
 
-        if lhd_path[0] + 10 > lhd_path[-1]:        
+        if model_has_converged(lhd_path):
             pyTFbindtools.log("Model has finished fitting", 'VERBOSE')
             break
+
+        # the motif can't be longer than the reads
+        if bs_len >= len(rnds_and_seqs[0][0]):
+            pyTFbindtools.log("Motif covers the full read", 'VERBOSE')
+            break
         
         # update hte previous likelihood
         #prev_lhd = lhd_hat
         
-        pyTFbindtools.log("Finding best shift", 'VERBOSE')
-        shift_type = find_best_shift(rnds_and_seqs, ddg_array, ref_energy)
-        if shift_type == 'LEFT':
-            pyTFbindtools.log("Adding left base to motif", level='VERBOSE' )
-            ddg_array = np.insert(ddg_array, 0, np.zeros(3, dtype='float32')
-                              ).view(DeltaDeltaGArray)
-        elif shift_type == 'RIGHT':
-            pyTFbindtools.log("Adding right base to motif", level='VERBOSE' )
-            ddg_array = np.append(ddg_array, np.zeros(3, dtype='float32')).view(
-                DeltaDeltaGArray)
-        else:
-            assert False, "Unrecognized shift type '%s'" % shift_type
+        ddg_array, new_pos = extend_model(
+            rnds_and_coded_reads, ddg_array, ref_energy, adadelta_state)
         ref_energy = ref_energy
         
     for entry in opt_path:
@@ -286,13 +390,14 @@ def fit_model(rnds_and_seqs, ddg_array, ref_energy):
     return ddg_array, ref_energy
     
 def main():
-    motif, rnds_and_seqs, random_seq_pool_size = parse_arguments()
+    ( motif, rnds_and_seqs, random_seq_pool_size, incremental 
+        ) = parse_arguments()
     ref_energy, ddg_array = motif.build_ddg_array()
     ddg_array_hat, ref_energy_hat = fit_model(
-        rnds_and_seqs, ddg_array, ref_energy )
+        rnds_and_seqs, ddg_array, ref_energy, incremental=incremental )
     
     with open(motif.name + ".SELEX.txt", "w") as ofp:
-        write_output(motif, ddg_array_hat, ref_energy_hat, ofp)
+        write_output(motif.name, ddg_array_hat, ref_energy_hat, ofp)
     
     # THEANO_FLAGS=mode=FAST_RUN,device=gpu,floatX=float32
     return
@@ -0,0 +1,254 @@
+import os, sys
+import json
+import random
+import traceback
+
+import multiprocessing
+
+from collections import namedtuple
+
+import numpy as np
+
+from fit_selex import (
+    find_pwm, load_sequences, write_output, extend_model,
+    model_has_converged, calc_max_motif_len, fit_model,
+    Motif, DeltaDeltaGArray, AdaDeltaState, ArrayCache, pyTFbindtools )
+
+SelexExperiment = namedtuple(
+    'SelexExperiment', ['name', 'dna_conc', 'prot_conc', 'fnames'])
+
+def load_manifest(fp):
+    """Load a manifest written by scripts/list_motifs_and_SELEX_files.py.
+
+    Each line contains the experiment name, the DNA and protein
+    concentrations, and the comma separated round files.
+    """
+    experiments = []
+    for line in fp:
+        if line.strip() == '' or line.startswith("#"): continue
+        name, dna_conc, prot_conc, fnames = line.split()
+        experiments.append(SelexExperiment(
+            name, float(dna_conc), float(prot_conc), fnames.split(",")))
+    return experiments
+
+class ModelStore(object):
+    """Store the fit models for each experiment in output_dir.
+
+    Each motif length is checkpointed to a separate json file, so that a
+    crashed fit can be restarted from the last motif length that finished.
+    The checkpoints also store the maximum motif length and the AdaDelta 
+    state (for incremental fits), so that a restarted fit finishes the same
+    way as an uninterrupted one.
+    """
+    def __init__(self, output_dir, experiment):
+        self.experiment = experiment
+        self.output_dir = os.path.join(output_dir, experiment.name)
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+    def checkpoint_fname(self, motif_len):
+        return os.path.join(self.output_dir, "%s.%i.json" % (
+            self.experiment.name, motif_len))
+
+    @property
+    def output_fname(self):
+        return os.path.join(
+            self.output_dir, self.experiment.name + ".SELEX.txt")
+
+    def is_finished(self):
+        return os.path.exists(self.output_fname)
+
+    def save_checkpoint(self, motif_len, ref_energy, ddg_array,
+                        chem_pots, lhd_hat, lhd_path,
+                        adadelta_state, max_motif_len):
+        data = { 'motif_len': motif_len,
+                 'max_motif_len': max_motif_len,
+                 'ref_energy': float(ref_energy),
+                 'ddg_array': ddg_array.tolist(),
+                 'chem_affinities': chem_pots.tolist(),
+                 'validation_lhd': float(lhd_hat),
+                 'lhd_path': [float(x) for x in lhd_path] }
+        if adadelta_state is not None:
+            data['adadelta_state'] = {
+                'grad_sq': adadelta_state.grad_sq.tolist(),
+                'delta_x_sq': adadelta_state.delta_x_sq.tolist() }
+        # write to a temporary file and then move it, so that a crash can't
+        # leave a partially written checkpoint
+        fname = self.checkpoint_fname(motif_len)
+        with open(fname + ".tmp", "w") as ofp:
+            json.dump(data, ofp)
+        os.rename(fname + ".tmp", fname)
+        return
+
+    def load_last_checkpoint(self):
+        """Return the checkpoint with the longest motif, or None.
+        """
+        motif_lens = []
+        prefix = self.experiment.name + "."
+        for fname in os.listdir(self.output_dir):
+            if not fname.startswith(prefix) or not fname.endswith(".json"):
+                continue
+            motif_len = fname[len(prefix):-len(".json")]
+            if motif_len.isdigit():
+                motif_lens.append(int(motif_len))
+        if len(motif_lens) == 0:
+            return None
+        with open(self.checkpoint_fname(max(motif_lens))) as fp:
+            return json.load(fp)
+
+    def save_model(self, ddg_array, ref_energy):
+        with open(self.output_fname + ".tmp", "w") as ofp:
+            write_output(self.experiment.name, ddg_array, ref_energy, ofp)
+        os.rename(self.output_fname + ".tmp", self.output_fname)
+        return
+
+def fit_experiment(experiment, output_dir,
+                   initial_binding_site_len=6, random_seed=None,
+                   incremental=False):
+    store = ModelStore(output_dir, experiment)
+    if store.is_finished():
+        pyTFbindtools.log("Skipping finished experiment %s" % experiment.name,
+                          'VERBOSE')
+        return experiment.name
+
+    if random_seed is not None:
+        np.random.seed(random_seed)
+        random.seed(random_seed)
+
+    pyTFbindtools.log("Loading sequences for %s" % experiment.name, 'VERBOSE')
+    rnds_and_seqs = load_sequences(experiment.fnames)
+
+    checkpoint = store.load_last_checkpoint()
+    adadelta_state = None
+    new_pos = None
+    if checkpoint is None:
+        pwm = find_pwm(rnds_and_seqs, initial_binding_site_len)
+        motif = Motif(experiment.name, experiment.name, pwm)
+        ref_energy, ddg_array = motif.build_ddg_array()
+        max_motif_len = calc_max_motif_len(
+            rnds_and_seqs, ddg_array.motif_len)
+    else:
+        # restart from the last motif length that finished. The maximum 
+        # motif length comes from the original fit, so that the restarted
+        # fit grows the motif as far as an uninterrupted one would.
+        pyTFbindtools.log("Restarting %s from motif length %i" % (
+            experiment.name, checkpoint['motif_len']), 'VERBOSE')
+        max_motif_len = checkpoint['max_motif_len']
+        ref_energy = checkpoint['ref_energy']
+        ddg_array = np.array(
+            checkpoint['ddg_array'], dtype='float32').view(DeltaDeltaGArray)
+        if ( model_has_converged(checkpoint['lhd_path']) 
+             or checkpoint['motif_len'] >= len(rnds_and_seqs[0][0]) ):
+            store.save_model(ddg_array, ref_energy)
+            return experiment.name
+        # continue an incremental fit with its AdaDelta state (a 
+        # non-incremental checkpoint has no state, so the incremental fit
+        # starts with fresh accumulators)
+        if incremental and 'adadelta_state' in checkpoint:
+            adadelta_state = AdaDeltaState(len(ddg_array)+1)
+            adadelta_state.grad_sq = np.array(
+                checkpoint['adadelta_state']['grad_sq'])
+            adadelta_state.delta_x_sq = np.array(
+                checkpoint['adadelta_state']['delta_x_sq'])
+        ddg_array, new_pos = extend_model(
+            rnds_and_seqs, ddg_array, ref_energy, adadelta_state)
+
+    def save_checkpoint(*args):
+        store.save_checkpoint(*(args + (max_motif_len,)))
+        return
+
+    ddg_array_hat, ref_energy_hat = fit_model(
+        rnds_and_seqs, ddg_array, ref_energy,
+        experiment.dna_conc, experiment.prot_conc,
+        callback=save_checkpoint, incremental=incremental,
+        max_motif_len=max_motif_len,
+        adadelta_state=adadelta_state, new_pos=new_pos)
+    store.save_model(ddg_array_hat, ref_energy_hat)
+    return experiment.name
+
+def fit_experiment_worker(args):
+    # log the error and move on to the next experiment, so that one bad
+    # experiment doesn't kill the batch
+    try:
+        return fit_experiment(*args)
+    except Exception:
+        pyTFbindtools.log("Failed to fit %s:\n%s" % (
+            args[0].name, traceback.format_exc()))
+        return None
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Estimate energy models for a batch of SELEX experiments.')
+
+    parser.add_argument( 'manifest', type=file,
+        help='Manifest of experiments (from list_motifs_and_SELEX_files.py).')
+    parser.add_argument( '--output-dir', default='./SELEX_models/',
+        help='Directory to write the models and checkpoints to.')
+
+    parser.add_argument( '--initial-binding-site-len', type=int, default=6,
+        help='The starting length of the binding site (this will grow)')
+    parser.add_argument( '--max-iter', type=float, default=1e5,
+                         help='Maximum number of optimization iterations.')
+
+    parser.add_argument( '--threads', '-t', default=1, type=int,
+        help='The number of experiments to fit in parallel.')
+    parser.add_argument( '--incremental', default=False, action='store_true',
+        help='Fit each new motif position before refining the full model.')
+    parser.add_argument( '--backend', default='auto',
+        choices=pyTFbindtools.selex.backends.BACKEND_NAMES,
+        help='The compute backend (default: numba if installed, else numpy).')
+    parser.add_argument( '--cache-dir',
+        help='Directory to cache the coded reads and binding sites in.')
+    parser.add_argument( '--cache-size', type=float, default=50,
+        help='The maximum size of the cache in GB (default: 50).')
+    parser.add_argument( '--random-seed', type=int,
+                         help='Set the random number generator seed.')
+
+    parser.add_argument( '--verbose', default=False, action='store_true',
+                         help='Print extra status information.')
+    parser.add_argument( '--debug-verbose', default=False, action='store_true',
+                         help='Print debug information.')
+
+    args = parser.parse_args()
+
+    pyTFbindtools.VERBOSE = args.verbose or args.debug_verbose
+    pyTFbindtools.DEBUG = args.debug_verbose
+    pyTFbindtools.selex.MAX_NUM_ITER = int(args.max_iter)
+    # the experiments are fit in parallel, so each fit uses a single process
+    pyTFbindtools.selex.NTHREADS = 1
+    pyTFbindtools.selex.set_backend(args.backend)
+    # the cache is safe to share between the worker processes
+    if args.cache_dir != None:
+        pyTFbindtools.selex.CODED_SEQS_CACHE = ArrayCache(
+            args.cache_dir, int(args.cache_size*2**30))
+
+    experiments = load_manifest(args.manifest)
+    args.manifest.close()
+
+    return ( experiments, args.output_dir, args.initial_binding_site_len,
+             args.random_seed, args.incremental, args.threads )
+
+def main():
+    ( experiments, output_dir, initial_binding_site_len, random_seed, 
+      incremental, n_threads ) = parse_arguments()
+    all_args = [ (experiment, output_dir, initial_binding_site_len, random_seed,
+                  incremental)
+                 for experiment in experiments ]
+    if n_threads == 1:
+        results = map(fit_experiment_worker, all_args)
+    else:
+        pool = multiprocessing.Pool(n_threads, maxtasksperchild=1)
+        results = list(pool.imap_unordered(fit_experiment_worker, all_args))
+        pool.close()
+        pool.join()
+
+    n_failed = sum(1 for x in results if x is None)
+    pyTFbindtools.log("Fit %i experiments (%i failed)" % (
+        len(results)-n_failed, n_failed))
+    if n_failed > 0:
+        sys.exit(1)
+    return
+
+if __name__ == '__main__':
+    main()
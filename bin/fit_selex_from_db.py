@@ -1,12 +1,11 @@
 import os, sys
 
-import psycopg2
-
 import numpy as np
 
 from fit_selex import (
     estimate_dg_matrix_with_adadelta, find_pwm, load_sequences, 
-    Motif, PartitionedAndCodedSeqs, pyTFbindtools, find_best_shift, DeltaDeltaGArray )
+    Motif, PartitionedAndCodedSeqs, pyTFbindtools, extend_motif, 
+    code_reads )
 
 def insert_model_into_db(exp_id, motif_len, 
                          ref_energy, ddg_array, 
@@ -29,6 +28,7 @@ def insert_model_into_db(exp_id, motif_len,
     """
     motif_len = ddg_array.motif_len
     consensus_energy, base_contributions = ddg_array.calc_normalized_base_conts(ref_energy)
+    import psycopg2
     conn = psycopg2.connect("host=mitra dbname=cisbp user=nboley")
     cur = conn.cursor()    
     query = """
@@ -43,12 +43,14 @@ def insert_model_into_db(exp_id, motif_len,
     return
 
 def fit_model(exp_id, rnds_and_seqs, ddg_array, ref_energy, dna_conc, prot_conc):
+    # code the reads once, and re-use them for every motif length
+    rnds_and_coded_reads = [code_reads(seqs) for seqs in rnds_and_seqs]
     for rnd_num in xrange(
             min(20-ddg_array.motif_len+1, 
                 len(rnds_and_seqs[0][0])-ddg_array.motif_len+1)):
         bs_len = ddg_array.motif_len
         partitioned_and_coded_rnds_and_seqs = PartitionedAndCodedSeqs(
-            rnds_and_seqs, bs_len)
+            rnds_and_coded_reads, bs_len)
 
         ( ddg_array, ref_energy, chem_affinities, lhd_path, lhd_hat 
             ) = estimate_dg_matrix_with_adadelta(
@@ -58,20 +60,14 @@ def fit_model(exp_id, rnds_and_seqs, ddg_array, ref_energy, dna_conc, prot_conc)
         insert_model_into_db(exp_id, bs_len, ref_energy, ddg_array,
                              chem_affinities, lhd_hat, lhd_path)
         
-        shift_type = find_best_shift(rnds_and_seqs, ddg_array, ref_energy)
-        if shift_type == 'LEFT':
-            ddg_array = np.insert(ddg_array, 0, np.zeros(3, dtype='float32')
-                              ).view(DeltaDeltaGArray)
-        elif shift_type == 'RIGHT':
-            ddg_array = np.append(ddg_array, np.zeros(3, dtype='float32')).view(
-                DeltaDeltaGArray)
-        else:
-            assert False, "Unrecognized shift type '%s'" % shift_type
+        ddg_array, shift_type = extend_motif(
+            rnds_and_seqs, ddg_array, ref_energy)
         print "Finished model w/ length %i" % bs_len
     
     return
 
 def get_fnames(exp_id):
+    import psycopg2
     conn = psycopg2.connect("host=mitra dbname=cisbp user=nboley")
     cur = conn.cursor()
     query = """
@@ -85,6 +81,7 @@ def get_fnames(exp_id):
     return res
 
 def get_dna_and_prot_conc(exp_id):
+    import psycopg2
     conn = psycopg2.connect("host=mitra dbname=cisbp user=nboley")
     cur = conn.cursor()
     query = """
@@ -112,4 +109,5 @@ def main():
         exp_id, rnds_and_seqs, ddg_array, ref_energy, dna_conc, prot_conc )
     return
 
-main()
+if __name__ == '__main__':
+    main()
@@ -4,39 +4,89 @@ import numpy as np
 
 sys.path.insert(0, "/home/nboley/src/TF_binding/")
 
+from scipy.special import expit
+
 import pyTFbindtools
-from pyTFbindtools.selex import est_chem_potentials
-from pyTFbindtools.motif_tools import load_energy_data, load_motifs
+from pyTFbindtools.selex import est_chem_potentials, build_energy_fn
+from pyTFbindtools.motif_tools import load_energy_data, load_motifs, R, T
+
+
+# the number of reads to generate or write at once
+CHUNK_SIZE = 1000000
+
+def sample_random_pool(pool_size, seq_len, chunk_size=CHUNK_SIZE):
+    """Sample a (pool_size, seq_len) uint8 matrix of random coded reads.
+    """
+    pool = np.empty((pool_size, seq_len), dtype='uint8')
+    # sample in chunks, because randint builds an int64 matrix
+    for start in xrange(0, pool_size, chunk_size):
+        stop = min(start+chunk_size, pool_size)
+        pool[start:stop] = np.random.randint(4, size=(stop-start, seq_len))
+    return pool
+
+def calc_pool_occupancies(coded_reads, ddg_array, ref_energy, chem_pot):
+    """Calculate the occupancy of every read in a coded read matrix.
+    """
+    calc_energies = build_energy_fn(coded_reads, ddg_array.motif_len)
+    energies = ref_energy + calc_energies(ddg_array)[0]
+    return expit((chem_pot - energies)/(R*T))
 
+def sample_reads(coded_reads, weights, size):
+    """Sample size reads, with replacement, proportional to weights.
+
+    Returns the indices of the sampled reads.
+    """
+    # cast to a double, and re-normalize to avoid errors in np.random.choice
+    ps = np.array(weights/weights.sum(), dtype='double')
+    ps = ps/ps.sum()
+    return np.random.choice(len(coded_reads), size=size, p=ps, replace=True)
+
+def write_reads(coded_reads, ofp, fastq=False, chunk_size=CHUNK_SIZE):
+    """Write coded reads to ofp, one read per line (or as a fastq).
+    """
+    n_reads, read_len = coded_reads.shape
+    base_chars = np.frombuffer(b'ACGT', dtype='uint8')
+    qual_line = "+\n" + "I"*read_len + "\n"
+    for start in xrange(0, n_reads, chunk_size):
+        # decode the chunk into a character matrix with newlines, and write
+        # it in one call
+        lines = np.empty((min(chunk_size, n_reads-start), read_len+1), 
+                         dtype='uint8')
+        lines[:,:read_len] = base_chars[coded_reads[start:start+chunk_size]]
+        lines[:,read_len] = ord("\n")
+        if not fastq:
+            ofp.write(lines.tostring())
+            continue
+        lines = lines.tostring()
+        ofp.write("".join(
+            "@read_%i\n%s%s" % (
+                start+i, lines[i*(read_len+1):(i+1)*(read_len+1)], qual_line)
+            for i in xrange(len(lines)//(read_len+1))))
+    return
 
 def simulate_reads( motif, seq_len, sim_sizes,
                     dna_conc, prot_conc,
                     fname_prefix="test",
-                    pool_size = 100000):
+                    pool_size = 100000,
+                    fastq=False):
     ref_energy, ddg_array = motif.build_ddg_array()
     chem_pots = est_chem_potentials(
         ddg_array, ref_energy, dna_conc, prot_conc, 
-        2*(seq_len-len(motif)+1), len(sim_sizes))
-    current_pool = np.array([np.random.randint(4, size=seq_len)
-                             for i in xrange(pool_size)])
-    rnds_and_seqs = []
+        2*(seq_len-len(motif)+1), seq_len, len(sim_sizes))
+    current_pool = sample_random_pool(pool_size, seq_len)
     for rnd, (sim_size, chem_pot) in enumerate(
             zip(sim_sizes, chem_pots), start=1):
-        occs = np.array([motif.est_occ(chem_pot, seq)
-                         for seq in current_pool])
-        #print current_pool
-        seq_indices = np.random.choice(
-            len(current_pool), size=sim_size,
-            p=occs/occs.sum(), replace=True)
-        seqs = current_pool[np.array(seq_indices, dtype=int)]
-        seq_occs = occs[np.array(seq_indices, dtype=int)]
-
-        with open("%s_rnd_%i.txt" % (fname_prefix, rnd), "w") as ofp:
-            for seq in seqs:
-                print >> ofp, "".join('ACGT'[x] for x in seq)
-        current_pool = seqs[np.random.choice(
-            len(seqs), size=pool_size,
-            p=seq_occs/seq_occs.sum(), replace=True)]
+        occs = calc_pool_occupancies(
+            current_pool, ddg_array, ref_energy, chem_pot)
+        seq_indices = sample_reads(current_pool, occs, sim_size)
+        seqs = current_pool[seq_indices]
+        seq_occs = occs[seq_indices]
+
+        fname = "%s_rnd_%i.%s" % (
+            fname_prefix, rnd, "fastq" if fastq else "txt")
+        with open(fname, "w") as ofp:
+            write_reads(seqs, ofp, fastq)
+        current_pool = seqs[sample_reads(seqs, seq_occs, pool_size)]
         pyTFbindtools.log( 
             "Finished simulations for round %i" % rnd, level='VERBOSE')
     
@@ -58,6 +108,12 @@ def parse_arguments():
     
     parser.add_argument( '--sim-sizes', type=int, nargs='+',
                          help='Number of reads to simulate for each round.')    
+    parser.add_argument( '--seq-len', type=int, default=20,
+                         help='The length of the simulated reads.')
+    parser.add_argument( '--output-prefix', default='test',
+        help='Write round i to <prefix>_rnd_<i>.txt (or .fastq).')
+    parser.add_argument( '--fastq', default=False, action='store_true',
+                         help='Write the reads as fastq files.')
     
     parser.add_argument( '--prot-conc', type=float, default=7.75e-10,
                          help='The protein concentration.')
@@ -90,19 +146,22 @@ def parse_arguments():
             "Either --energy-model or --pwm must be specified"
         pyTFbindtools.log("Loading energy data", 'VERBOSE')
         motif = load_energy_data(args.energy_model.name)
-        args.starting_energy_model.close()
+        args.energy_model.close()
     
     return ( motif, args.prot_conc, args.dna_conc, 
-             args.sim_sizes,
-             int(args.random_seq_pool_size) )
+             args.sim_sizes, args.seq_len,
+             int(args.random_seq_pool_size),
+             args.output_prefix, args.fastq )
 
 def main():
-    ( motif, prot_conc, dna_conc, sim_sizes, random_seq_pool_size 
-      ) = parse_arguments()
+    ( motif, prot_conc, dna_conc, sim_sizes, seq_len, random_seq_pool_size,
+      output_prefix, fastq ) = parse_arguments()
 
-    simulate_reads( motif, 20, sim_sizes,
+    simulate_reads( motif, seq_len, sim_sizes,
                     dna_conc, prot_conc,
-                    pool_size = random_seq_pool_size)
+                    fname_prefix = output_prefix,
+                    pool_size = random_seq_pool_size,
+                    fastq = fastq)
     return
 
 if __name__ == '__main__':
@@ -5,34 +5,78 @@ import numpy
 from grit.files.reads import Reads, MergedReads, determine_read_pair_params
 from grit.frag_len import build_normal_density
 
+def build_fragment_counts(fwd_starts, rev_ends, start, region_len, 
+                          window_size):
+    """Count the extended reads covering each base of a region.
+
+    Reads on the + strand are extended window_size bases downstream of their
+    start, and reads on the - strand window_size bases upstream of their end.
+    The counts are built from a difference array: each extended read adds one
+    at its first base and subtracts one after its last, and the cumulative 
+    sum of these gives the counts at bases start, ..., start+region_len-1.
+    """
+    rd_starts = numpy.concatenate(
+        (fwd_starts, rev_ends - window_size)) - start
+    rd_stops = rd_starts + window_size
+    # clip the extended reads to the region 
+    rd_starts = rd_starts.clip(0, region_len)
+    rd_stops = rd_stops.clip(0, region_len)
+    cnts_diff = (numpy.bincount(rd_starts, minlength=region_len+1)
+                 - numpy.bincount(rd_stops, minlength=region_len+1))
+    return cnts_diff.cumsum()[:region_len]
+
 class ChIPSeqReads(Reads):
     def __repr__(self):
         paired = 'paired' if self.reads_are_paired else 'unpaired'
         return "<ChIPSeqReads.%s.%i instance>" % (paired, self.frag_len)
 
-    def build_unpaired_reads_fragment_coverage_array( 
-            self, chrm, strand, start, stop, binding_site_size, 
-            window_size=None ):
-        if window_size == None:
-            window_size = self.frag_len
-        assert stop >= start
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
+    def load_read_ends(self, chrm, start, stop):
+        """Load the 5' ends of the reads in a region.
+
+        Returns arrays of the start positions of the reads on the + strand,
+        and of the end positions of the reads on the - strand.
+        """
+        fwd_starts = []
+        rev_ends = []
         for rd, strand in self.iter_reads_and_strand(chrm, start, stop):
             if strand == '+': 
-                rd_start = rd.pos # + binding_site_size
-                rd_stop = rd.pos + window_size # + binding_site_size
+                fwd_starts.append(rd.pos)
             elif strand == '-': 
-                rd_start = rd.aend - window_size
-                rd_stop = rd.aend
+                rev_ends.append(rd.aend)
             else:
                 assert False
-            cvg[max(0, rd_start-start):max(0, rd_stop-start)] += (
-                1.0/(rd_stop-rd_start+1))
+        return ( numpy.array(fwd_starts, dtype=int), 
+                 numpy.array(rev_ends, dtype=int) )
 
-        return cvg
+    def build_unpaired_reads_fragment_coverage_arrays( 
+            self, chrm, strand, start, stop, binding_site_size, 
+            window_sizes ):
+        """Build the fragment coverage of a region for several window sizes.
+
+        The reads are only loaded once. Each read is extended to cover 
+        window_size bases downstream of its 5' end, and adds 
+        1/(window_size+1) to each of them. The coverage is built from a
+        difference array (see build_fragment_counts). Returns a list of 
+        coverage arrays, one per window size.
+        """
+        assert stop >= start
+        full_region_len = stop - start + 1
+        fwd_starts, rev_ends = self.load_read_ends(chrm, start, stop)
+        cvgs = []
+        for window_size in window_sizes:
+            if window_size == None:
+                window_size = self.frag_len
+            cvg = build_fragment_counts(
+                fwd_starts, rev_ends, start, full_region_len, window_size)
+            cvgs.append(cvg/float(window_size+1))
+        return cvgs
+
+    def build_unpaired_reads_fragment_coverage_array( 
+            self, chrm, strand, start, stop, binding_site_size, 
+            window_size=None ):
+        return self.build_unpaired_reads_fragment_coverage_arrays(
+            chrm, strand, start, stop, binding_site_size, [window_size,])[0]
 
-        
     def init(self, 
              reverse_read_strand=None,  reads_are_stranded=None,
              pairs_are_opp_strand=None, reads_are_paired=None,
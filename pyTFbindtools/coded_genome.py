@@ -0,0 +1,120 @@
+"""Store a genome as a memory mapped array of coded bases.
+
+The genome is converted once into a single uint8 .npy file with one byte per 
+base (coded with code_seq_as_ints, so N -> 4), a tab delimited index of contig 
+offsets, and a sidecar file containing the N intervals of each contig. Regions 
+are returned as zero copy views into the memory map, so forked workers share 
+the page cache and the scoring code skips both the string fetch and the 
+re-encoding. 
+"""
+import os
+
+import numpy as np
+
+from pysam import FastaFile
+
+from motif_tools import code_seq_as_ints, decode_seq_from_ints
+
+INDEX_SUFFIX = ".coded_genome.txt"
+CODES_SUFFIX = ".coded_genome.npy"
+N_INTERVALS_SUFFIX = ".coded_genome.Ns.npz"
+
+# the number of bases to fetch from the fasta at once during the conversion
+CHUNK_SIZE = 10000000
+
+def find_N_intervals(coded_seq):
+    """Find the [start, stop) intervals of consecutive N's in coded_seq.
+    """
+    is_N = np.concatenate(([False,], coded_seq > 3, [False,]))
+    boundaries = np.flatnonzero(is_N[1:] != is_N[:-1])
+    return boundaries.reshape((-1, 2))
+
+def build_coded_genome(fasta_fname, ofprefix):
+    """Convert a (faidx indexed) fasta file into a coded genome.
+
+    Returns the name of the coded genome index file.
+    """
+    fasta = FastaFile(fasta_fname)
+    contigs = list(fasta.references)
+    contig_lens = list(fasta.lengths)
+    codes = np.lib.format.open_memmap(
+        ofprefix + CODES_SUFFIX, mode='w+', 
+        dtype='uint8', shape=(sum(contig_lens),))
+    N_intervals = {}
+    offset = 0
+    with open(ofprefix + INDEX_SUFFIX, "w") as ofp:
+        for contig, contig_len in zip(contigs, contig_lens):
+            for start in xrange(0, contig_len, CHUNK_SIZE):
+                stop = min(contig_len, start + CHUNK_SIZE)
+                codes[offset+start:offset+stop] = code_seq_as_ints(
+                    fasta.fetch(contig, start, stop))
+            N_intervals[contig] = find_N_intervals(
+                codes[offset:offset+contig_len])
+            ofp.write("%s\t%i\t%i\n" % (contig, offset, contig_len))
+            offset += contig_len
+    codes.flush()
+    del codes
+    np.savez(ofprefix + N_INTERVALS_SUFFIX, **N_intervals)
+    fasta.close()
+    return ofprefix + INDEX_SUFFIX
+
+class CodedGenome(object):
+    """Random access to a coded genome.
+
+    fetch_coded returns read only views into the memory mapped codes, and 
+    fetch returns strings (so this can be used in place of a FastaFile).
+    """
+    def __init__(self, fname):
+        assert fname.endswith(INDEX_SUFFIX), \
+            "'%s' is not a coded genome index" % fname
+        self.filename = fname
+        self.prefix = fname[:-len(INDEX_SUFFIX)]
+        self.contig_offsets = {}
+        self.references = []
+        self.lengths = []
+        with open(fname) as fp:
+            for line in fp:
+                contig, offset, contig_len = line.split()
+                self.contig_offsets[contig] = (int(offset), int(contig_len))
+                self.references.append(contig)
+                self.lengths.append(int(contig_len))
+        self.codes = np.load(self.prefix + CODES_SUFFIX, mmap_mode='r')
+        self._N_intervals = None
+
+    def fetch_coded(self, contig, start=None, stop=None):
+        offset, contig_len = self.contig_offsets[contig]
+        start = 0 if start is None else max(0, start)
+        stop = contig_len if stop is None else min(contig_len, stop)
+        assert start <= stop
+        return self.codes[offset+start:offset+stop]
+
+    def fetch(self, contig, start=None, stop=None):
+        return decode_seq_from_ints(self.fetch_coded(contig, start, stop))
+
+    def N_intervals(self, contig):
+        """The [start, stop) intervals of consecutive N's in contig.
+        """
+        if self._N_intervals is None:
+            self._N_intervals = np.load(self.prefix + N_INTERVALS_SUFFIX)
+        return self._N_intervals[contig]
+
+    def has_N(self, contig, start, stop):
+        intervals = self.N_intervals(contig)
+        return bool(((intervals[:,0] < stop) & (intervals[:,1] > start)).any())
+
+def load_genome(fname):
+    """Open either a coded genome index, or a (faidx indexed) fasta file.
+    """
+    if fname.endswith(INDEX_SUFFIX):
+        return CodedGenome(fname)
+    return FastaFile(fname)
+
+def reload_genome(genome):
+    """Make a genome process safe after a fork. 
+
+    Fasta files need to be re-opened, but the coded genome memory map is 
+    read only, and so can be shared between processes.
+    """
+    if isinstance(genome, CodedGenome):
+        return genome
+    return FastaFile(genome.filename)
@@ -0,0 +1,258 @@
+"""Store genome wide read coverage tracks in chunked, compressed arrays.
+
+Each BAM is read once, and its per base coverage is written into a store
+directory: the ATAC-seq read coverage, and for each ChIP-seq replicate the
+counts of the fragments extended to every window size (the coverage is the
+counts divided by window_size+1). Every (track, contig) array is split into
+CHUNK_SIZE base chunks, which are zlib compressed and concatenated into a
+single data file, along with an array of the chunk offsets. The data files are
+memory mapped, and a range read only decompresses the chunks that it overlaps,
+so forked workers share the page cache and never touch the BAMs.
+
+The store contains:
+    contigs.txt: the contig names and lengths
+    tracks.txt: the track name, kind, factor, replicate id, window size,
+                fragment length and dtype of each track
+    TRACK.CONTIG.zdat: the compressed chunks
+    TRACK.CONTIG.offsets.npy: the chunk offsets into the data file
+"""
+import os
+import zlib
+
+import numpy as np
+
+import pyTFbindtools
+
+CONTIGS_FNAME = "contigs.txt"
+TRACKS_FNAME = "tracks.txt"
+
+# the number of bases in each compressed chunk
+CHUNK_SIZE = 2**16
+# the number of bases whose coverage is built from one query of the BAM
+BUILD_WINDOW_SIZE = 64*CHUNK_SIZE
+
+ATACSEQ_TRACK = 'ATAC'
+# the ChIP-seq fragment window sizes used by PeakRegion (None means the
+# fragment length)
+CHIPSEQ_WINDOW_SIZES = (15, None)
+
+def iter_build_windows(contig_len):
+    for start in xrange(0, contig_len, BUILD_WINDOW_SIZE):
+        yield start, min(contig_len, start + BUILD_WINDOW_SIZE)
+    return
+
+def write_track(store_dir, track, contig, contig_len, iter_cov_windows,
+                dtype):
+    """Write the coverage of one contig into a chunked, compressed array.
+
+    iter_cov_windows yields the coverage of consecutive windows of the contig,
+    whose lengths must be multiples of CHUNK_SIZE (except for the last one).
+    """
+    prefix = os.path.join(store_dir, "%s.%s" % (track, contig))
+    offsets = [0,]
+    with open(prefix + ".zdat", "wb") as ofp:
+        for cov in iter_cov_windows:
+            cov = np.ascontiguousarray(cov, dtype=dtype)
+            for start in xrange(0, len(cov), CHUNK_SIZE):
+                data = zlib.compress(cov[start:start+CHUNK_SIZE].tostring())
+                ofp.write(data)
+                offsets.append(offsets[-1] + len(data))
+    assert len(offsets) - 1 == (contig_len + CHUNK_SIZE - 1)//CHUNK_SIZE
+    np.save(prefix + ".offsets.npy", np.array(offsets, dtype='int64'))
+    return
+
+def write_atacseq_tracks(store_dir, atacseq_reads):
+    """Write the read coverage of an ATAC-seq BAM.
+
+    Returns the track index entries.
+    """
+    def iter_cov_windows(contig, contig_len):
+        for start, stop in iter_build_windows(contig_len):
+            # build_read_coverage_array includes the stop base
+            yield atacseq_reads.build_read_coverage_array(
+                contig, '.', start, stop-1)
+        return
+
+    for contig, contig_len in zip(
+            atacseq_reads.references, atacseq_reads.lengths):
+        pyTFbindtools.log("Writing the ATAC-seq coverage of '%s'" % contig,
+                          'VERBOSE')
+        write_track(store_dir, ATACSEQ_TRACK, contig, contig_len,
+                    iter_cov_windows(contig, contig_len), 'float32')
+    return [(ATACSEQ_TRACK, 'ATAC', '.', '.', 0, 0, 'float32'),]
+
+def write_chipseq_tracks(store_dir, chipseq_reads,
+                         window_sizes=CHIPSEQ_WINDOW_SIZES):
+    """Write the extended fragment counts of a ChIP-seq replicate.
+
+    The reads of each window are loaded once, and are used to build the
+    counts for every window size. Returns the track index entries.
+    """
+    from DNABindingProteins import build_fragment_counts
+    window_sizes = [chipseq_reads.frag_len if window_size is None
+                    else window_size for window_size in window_sizes]
+    # load the reads whose extended fragments overlap the window
+    padding = max(window_sizes)
+    tracks = ["%s.w%i" % (chipseq_reads.id, window_size)
+              for window_size in window_sizes]
+    for contig, contig_len in zip(
+            chipseq_reads.references, chipseq_reads.lengths):
+        pyTFbindtools.log("Writing the ChIP-seq coverage of '%s' for %s" % (
+            contig, chipseq_reads.id), 'VERBOSE')
+        window_cnts = [[] for window_size in window_sizes]
+        for start, stop in iter_build_windows(contig_len):
+            fwd_starts, rev_ends = chipseq_reads.load_read_ends(
+                contig, max(0, start-padding), stop+padding)
+            for cnts, window_size in zip(window_cnts, window_sizes):
+                cnts.append(build_fragment_counts(
+                    fwd_starts, rev_ends, start, stop-start, window_size))
+        for track, cnts in zip(tracks, window_cnts):
+            write_track(store_dir, track, contig, contig_len, cnts, 'int32')
+    return [(track, 'ChIP', chipseq_reads.factor, chipseq_reads.id,
+             window_size, chipseq_reads.frag_len, 'int32')
+            for track, window_size in zip(tracks, window_sizes)]
+
+def build_coverage_tracks(store_dir, atacseq_reads, chipseq_reads):
+    """Build a coverage track store from an ATAC-seq BAM and ChIP-seq BAMs.
+
+    chipseq_reads is a list of ChIPSeqReads objects (one per replicate).
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    index = write_atacseq_tracks(store_dir, atacseq_reads)
+    for reads in chipseq_reads:
+        index.extend(write_chipseq_tracks(store_dir, reads))
+    with open(os.path.join(store_dir, CONTIGS_FNAME), "w") as ofp:
+        for contig, contig_len in zip(
+                atacseq_reads.references, atacseq_reads.lengths):
+            ofp.write("%s\t%i\n" % (contig, contig_len))
+    # write the track index last, so that an incomplete store fails to load
+    with open(os.path.join(store_dir, TRACKS_FNAME), "w") as ofp:
+        for entry in index:
+            ofp.write("\t".join(map(str, entry)) + "\n")
+    return
+
+class CoverageTracks(object):
+    """Random access to the tracks in a coverage track store.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.filename = os.path.join(store_dir, TRACKS_FNAME)
+        self.contig_lens = {}
+        with open(os.path.join(store_dir, CONTIGS_FNAME)) as fp:
+            for line in fp:
+                contig, contig_len = line.split()
+                self.contig_lens[contig] = int(contig_len)
+        self.tracks = {}
+        with open(self.filename) as fp:
+            for line in fp:
+                (track, kind, factor, rep_id, window_size, frag_len, dtype
+                 ) = line.split()
+                self.tracks[track] = (
+                    kind, factor, rep_id, int(window_size), int(frag_len),
+                    np.dtype(dtype))
+        self._chunks = {}
+
+    def _load_chunks(self, track, contig):
+        key = (track, contig)
+        if key not in self._chunks:
+            prefix = os.path.join(self.store_dir, "%s.%s" % (track, contig))
+            self._chunks[key] = (
+                np.memmap(prefix + ".zdat", dtype='uint8', mode='r'),
+                np.load(prefix + ".offsets.npy"))
+        return self._chunks[key]
+
+    def fetch(self, track, contig, start, stop):
+        """Return the stored values of bases start, ..., stop-1.
+
+        Bases past the end of the contig have a value of zero.
+        """
+        dtype = self.tracks[track][-1]
+        assert 0 <= start <= stop
+        rv = np.zeros(stop-start, dtype=dtype)
+        data, offsets = self._load_chunks(track, contig)
+        stop_in_contig = min(stop, self.contig_lens[contig])
+        for chunk_i in xrange(start//CHUNK_SIZE,
+                              (stop_in_contig+CHUNK_SIZE-1)//CHUNK_SIZE):
+            chunk = np.frombuffer(zlib.decompress(
+                data[offsets[chunk_i]:offsets[chunk_i+1]].tostring()),
+                dtype=dtype)
+            chunk_start = chunk_i*CHUNK_SIZE
+            region_start = max(start, chunk_start)
+            region_stop = min(stop_in_contig, chunk_start+len(chunk))
+            rv[region_start-start:region_stop-start] = chunk[
+                region_start-chunk_start:region_stop-chunk_start]
+        return rv
+
+    def reload(self):
+        # the memory maps are read only, so they can be shared between
+        # processes
+        return self
+
+class ATACSeqCoverage(object):
+    """Serve the ATAC-seq coverage of a store in place of ATACSeqReads.
+    """
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.filename = tracks.filename
+
+    def build_read_coverage_array(self, chrm, strand, start, stop):
+        return self.tracks.fetch(
+            ATACSEQ_TRACK, chrm, start, stop+1).astype(float)
+
+    def reload(self):
+        return self
+
+class ChIPSeqCoverage(object):
+    """Serve the ChIP-seq coverage of a replicate in place of ChIPSeqReads.
+    """
+    def __init__(self, tracks, factor, rep_id, frag_len,
+                 window_sizes_and_tracks):
+        self.tracks = tracks
+        self.filename = tracks.filename
+        self.factor = factor
+        self.id = rep_id
+        self.frag_len = frag_len
+        self.window_sizes_and_tracks = window_sizes_and_tracks
+
+    def build_unpaired_reads_fragment_coverage_arrays(
+            self, chrm, strand, start, stop, binding_site_size,
+            window_sizes ):
+        cvgs = []
+        for window_size in window_sizes:
+            if window_size == None:
+                window_size = self.frag_len
+            cnts = self.tracks.fetch(
+                self.window_sizes_and_tracks[window_size], chrm, start, stop+1)
+            cvgs.append(cnts/float(window_size+1))
+        return cvgs
+
+    def reload(self):
+        return self
+
+class MergedChIPSeqCoverage(list):
+    """The replicates of a factor (in place of grit's MergedReads).
+    """
+    def reload(self):
+        return self
+
+def load_coverage_tracks(store_dir):
+    """Load the ATAC-seq and ChIP-seq coverage in a store.
+
+    Returns the ATAC-seq coverage, and a dict of factor -> the ChIP-seq
+    coverage of its replicates (the same as load_chipseq_reads).
+    """
+    tracks = CoverageTracks(store_dir)
+    replicates = {}
+    for track, (kind, factor, rep_id, window_size, frag_len, dtype) in sorted(
+            tracks.tracks.iteritems()):
+        if kind != 'ChIP': continue
+        replicates.setdefault(
+            (factor, rep_id, frag_len), {})[window_size] = track
+    chipseq_cov = {}
+    for (factor, rep_id, frag_len), window_sizes_and_tracks in sorted(
+            replicates.iteritems()):
+        chipseq_cov.setdefault(factor, MergedChIPSeqCoverage()).append(
+            ChIPSeqCoverage(tracks, factor, rep_id, frag_len,
+                            window_sizes_and_tracks))
+    return ATACSeqCoverage(tracks), chipseq_cov
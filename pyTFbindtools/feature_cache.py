@@ -0,0 +1,185 @@
+"""A persistent cache of the features of genomic regions.
+
+The features are stored in a single sqlite database, with one row per
+(region, feature) pair holding the zlib compressed array. Every row also
+stores the digest of the inputs that the feature was built from (e.g. a
+motif's energies, or a BAM's path, size and modification time), so changing a
+motif or a track only invalidates the features that depend on it. All keys are
+sha1 digests, so they are stable between runs.
+
+Each process opens its own connection (sqlite handles the locking between
+concurrent writers), and the database is kept under a size budget by deleting
+the least recently used features. Cache hits don't write to the database: the
+last used times are buffered, and written with the next save or eviction (or
+every LAST_USED_FLUSH_INTERVAL hits).
+"""
+import os
+import time
+import zlib
+import hashlib
+import sqlite3
+
+import numpy as np
+
+import pyTFbindtools
+
+# the default cache size budget, in bytes
+DEFAULT_MAX_SIZE = 10*2**30
+# the number of features to save between size budget checks
+EVICT_INTERVAL = 1000
+# the maximum number of buffered last used times
+LAST_USED_FLUSH_INTERVAL = 1000
+
+def digest(*args):
+    """Calculate a stable sha1 digest of args.
+
+    The arguments can be arrays, or any objects with a stable repr.
+    """
+    checksum = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            checksum.update(repr((arg.shape, arg.dtype.str)))
+            checksum.update(np.ascontiguousarray(arg).data)
+        else:
+            checksum.update(repr(arg))
+    return checksum.hexdigest()
+
+def motif_digest(motif):
+    """The digest of everything that a motif's scores depend on.
+    """
+    return digest(motif.name, motif.pwm, motif.motif_data,
+                  float(motif.consensus_energy), float(motif.mean_energy))
+
+def reads_digest(reads):
+    """The digest of a reads (or coverage track) file and its parameters.
+    """
+    stat = os.stat(reads.filename)
+    return digest(os.path.abspath(reads.filename), stat.st_size,
+                  stat.st_mtime, getattr(reads, 'id', None),
+                  getattr(reads, 'frag_len', None))
+
+def region_digest(genome, contig, start, stop):
+    return digest(os.path.abspath(genome.filename), contig, start, stop)
+
+class RegionFeatureCache(object):
+    def __init__(self, fname, max_size=DEFAULT_MAX_SIZE):
+        self.fname = os.path.abspath(fname)
+        self.max_size = max_size
+        dirname = os.path.dirname(self.fname)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._conn = None
+        self._pid = None
+        self._n_saved = 0
+        self._last_used = {}
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared with forked processes, so every
+        # process opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.fname, timeout=600)
+            self._pid = os.getpid()
+            # the parent process flushes its own last used times
+            self._last_used = {}
+            # write ahead logging lets readers continue while another process
+            # is writing
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS features (
+                    region TEXT,
+                    feature TEXT,
+                    digest TEXT,
+                    dtype TEXT,
+                    shape TEXT,
+                    data BLOB,
+                    size INTEGER,
+                    last_used REAL,
+                    PRIMARY KEY (region, feature)
+                )""")
+                self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS features_last_used
+                ON features (last_used)""")
+        return self._conn
+
+    def load(self, region, feature, input_digest):
+        """Load a feature, or return None if it isn't in the cache, or it
+        was built from different inputs.
+        """
+        res = self.conn.execute(
+            "SELECT digest, dtype, shape, data FROM features "
+            "WHERE region = ? AND feature = ?", (region, feature)).fetchone()
+        if res is None or res[0] != input_digest:
+            return None
+        cached_digest, dtype, shape, data = res
+        self._last_used[(region, feature)] = time.time()
+        if len(self._last_used) >= LAST_USED_FLUSH_INTERVAL:
+            with self.conn:
+                self._flush_last_used()
+        return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(
+            tuple(int(x) for x in shape.split(",") if x != ""))
+
+    def save(self, region, feature, input_digest, array):
+        """Store a feature (replacing any old version of it).
+        """
+        array = np.ascontiguousarray(array)
+        data = zlib.compress(array.tostring())
+        with self.conn:
+            self._flush_last_used()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO features VALUES (?,?,?,?,?,?,?,?)",
+                (region, feature, input_digest, array.dtype.str,
+                 ",".join(str(x) for x in array.shape),
+                 sqlite3.Binary(data), len(data), time.time()))
+        self._n_saved += 1
+        if self._n_saved % EVICT_INTERVAL == 0:
+            self.evict()
+        return
+
+    def _flush_last_used(self):
+        # must be called inside a transaction
+        self.conn.executemany(
+            "UPDATE features SET last_used = ? "
+            "WHERE region = ? AND feature = ?",
+            [(last_used, region, feature) for (region, feature), last_used
+             in self._last_used.iteritems()])
+        self._last_used = {}
+        return
+
+    def flush(self):
+        """Write the buffered last used times.
+        """
+        if self._last_used:
+            with self.conn:
+                self._flush_last_used()
+        return
+
+    def get(self, region, feature, input_digest, build_array):
+        """Return a feature, building it if necessary.
+        """
+        array = self.load(region, feature, input_digest)
+        if array is None:
+            array = build_array()
+            self.save(region, feature, input_digest, array)
+        return array
+
+    def evict(self):
+        """Delete the least recently used features until the cache fits.
+        """
+        with self.conn:
+            self._flush_last_used()
+            total_size = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM features").fetchone()[0]
+            if total_size <= self.max_size: return
+            pyTFbindtools.log("Evicting features from '%s'" % self.fname,
+                              'VERBOSE')
+            evicted = []
+            for rowid, size in self.conn.execute(
+                    "SELECT rowid, size FROM features ORDER BY last_used"):
+                if total_size <= self.max_size: break
+                evicted.append((rowid,))
+                total_size -= size
+            self.conn.executemany(
+                "DELETE FROM features WHERE rowid = ?", evicted)
+        return
@@ -1,10 +1,10 @@
 import os, sys
 
-import gzip
-
 sys.path.insert(0, "/users/nboley/src/TF_binding/")
 from load_motifs import load_motifs
 
+from pyTFbindtools.selex.load_reads import iter_seq_lines
+
 try: 
     rev_comp_table = str.maketrans("ACGT", "TGCA")
 except:
@@ -13,15 +13,13 @@ except:
 
 
 def load_selex(fname):
-    seqs = []
-    with gzip.open(fname) as fp:
-        for line_i, line in enumerate(fp):
-            if line_i%4 != 1: continue
-            #if line[0] in '+@': continue 
-            line = line.strip()
-            if line == "": continue
-            seqs.append( line )
-    return seqs
+    # use the raw sequence lines (rather than the coded reads), so that reads
+    # with N's or of a different length are kept
+    for seqs in iter_seq_lines(fname):
+        for seq in seqs:
+            if seq == "": continue
+            yield seq
+    return
 
 def main():
     motif = load_motifs(sys.argv[1]).values()[0][0]
@@ -8,6 +8,7 @@ from scipy.optimize import brute, bisect
 from scipy.signal import convolve
 
 from collections import defaultdict, namedtuple
+from itertools import izip
 
 T = 300
 R = 1.987e-3 # in kCal/mol*K
@@ -110,20 +111,165 @@ def code_seq(seq):
         coded_seq[coded_base, i] = 1
     return coded_seq
 
-def score_region(region, genome, motifs):
-    seq = genome.fetch(region[0], region[1], region[2])
-    motifs_scores = []
-    for motif in motifs:
+# lookup table from ascii character to base code (matches code_base)
+base_code_table = np.zeros(256, dtype='uint8') + 4
+for base, code in zip('ACGTacgt', (0, 1, 2, 3, 0, 1, 2, 3)):
+    base_code_table[ord(base)] = code
+
+def code_seq_as_ints(seq):
+    """Code a sequence as a uint8 array, with A,C,G,T -> 0,1,2,3 and N -> 4.
+
+    seq can either be a string, or an iterable of already coded bases.
+    """
+    if isinstance(seq, basestring):
+        return base_code_table[np.frombuffer(bytes(seq), dtype='uint8')]
+    return np.asarray(seq, dtype='uint8')
+
+def decode_seq_from_ints(coded_seq):
+    """Convert a uint8 coded sequence back into a string.
+    """
+    return np.frombuffer(b'ACGTN', dtype='uint8')[coded_seq].tostring()
+
+def fetch_coded_seq(genome, contig, start, stop):
+    """Fetch a region from a FastaFile or CodedGenome as a uint8 code array.
+    """
+    try: 
+        fetch_coded = genome.fetch_coded
+    except AttributeError: 
+        return code_seq_as_ints(genome.fetch(contig, start, stop))
+    return fetch_coded(contig, start, stop)
+
+class MotifLibrary(object):
+    """A set of motifs packed into a single padded weight tensor.
+
+    This allows a sequence to be scored against every motif with a single
+    matrix product. PwmModel, SelexModel and Motif objects can be mixed.
+    For every motif type, higher scores are better binding sites: Motif and
+    SelexModel objects are scored with the negative binding energy, and 
+    PwmModel objects with -sum(log2(1-p)) (their matrices store log2(1-p),
+    which decreases as the base frequency p increases). Windows that contain
+    an N are given the motif's mean score, which matches the mean_energy 
+    that Motif.score_coded_seq gives them.
+    """
+    # the number of offsets to score in a single matrix product
+    chunk_size = 10000
+
+    @staticmethod
+    def _motif_score_matrix(motif):
+        """Return the score matrix, the constant offset, and the score of 
+        windows that contain an N (oriented so that higher is better).
+        """
         if isinstance(motif, PwmModel):
-            N_row = np.zeros((len(motif.pwm), 1)) + np.log2(0.25)
-            extended_mat = np.hstack((motif.pwm, N_row))
+            score_mat = -np.array(motif.pwm)
+            return score_mat, 0.0, score_mat.mean(1).sum()
         elif isinstance(motif, SelexModel):
-            N_row = np.zeros((len(motif.ddg_array), 1))
-            extended_mat = np.hstack((motif.ddg_array, N_row))
-        coded_seq = code_seq(bytes(seq))
-        scores = -convolve(coded_seq, extended_mat.T, mode='valid')
-        motifs_scores.append(scores)
-    return motifs_scores
+            # the consensus energy is included in the first row
+            score_mat = -np.array(motif.ddg_array)
+            return score_mat, 0.0, score_mat.mean(1).sum()
+        elif isinstance(motif, Motif):
+            score_mat = -np.array(motif.motif_data)
+            return score_mat, -motif.consensus_energy, -motif.mean_energy
+        else:
+            raise TypeError("Unrecognized motif type '%s'" % type(motif))
+
+    def __init__(self, motifs):
+        self.motifs = list(motifs)
+        assert len(self.motifs) > 0
+        score_mats = [self._motif_score_matrix(motif) for motif in self.motifs]
+        self.lengths = np.array([len(x[0]) for x in score_mats])
+        self.max_len = self.lengths.max()
+        self.min_len = self.lengths.min()
+        
+        # pack the motifs (and their reverse complements) into a 
+        # (n_motifs, max_len, 5) array, padding with zeros. Windows with N's
+        # are scored separately, so the N column is zero.
+        self.weights = np.zeros(
+            (len(self.motifs), self.max_len, 5), dtype='float32')
+        self.RC_weights = np.zeros(
+            (len(self.motifs), self.max_len, 5), dtype='float32')
+        self.offsets = np.zeros(len(self.motifs), dtype='float32')
+        self.N_scores = np.zeros(len(self.motifs), dtype='float32')
+        for i, (score_mat, offset, N_score) in enumerate(score_mats):
+            motif_len = len(score_mat)
+            self.weights[i,:motif_len,:4] = score_mat
+            self.RC_weights[i,:motif_len,:4] = score_mat[::-1,::-1]
+            self.offsets[i] = offset
+            self.N_scores[i] = N_score
+        self.weights = self.weights.reshape((len(self.motifs), -1))
+        self.RC_weights = self.RC_weights.reshape((len(self.motifs), -1))
+
+    def __len__(self):
+        return len(self.motifs)
+
+    def __iter__(self):
+        return iter(self.motifs)
+
+    def n_positions(self, seq_len):
+        """The number of valid offsets for each motif in a sequence of length seq_len.
+        """
+        return seq_len - self.lengths + 1
+    
+    def score_coded_seq(self, coded_seq, both_strands=False):
+        """Score every motif at every offset of coded_seq.
+
+        Returns a (n_motifs, len(coded_seq)-min_motif_len+1) array. Offsets 
+        where a motif runs past the end of the sequence are set to nan. If 
+        both_strands is set, then return the better (higher) of the forward 
+        and reverse complement scores.
+        """
+        coded_seq = code_seq_as_ints(coded_seq)
+        n_positions = len(coded_seq) - self.min_len + 1
+        assert n_positions > 0
+        # one hot encode the sequence, padding the end with N's so that every 
+        # motif can be scored at every position 
+        padded_len = n_positions + self.max_len - 1
+        one_hot = np.zeros((padded_len, 5), dtype='float32')
+        one_hot[np.arange(len(coded_seq)), coded_seq] = 1
+        one_hot[len(coded_seq):,4] = 1
+        # build a (n_positions, max_len*5) view of all of the windows 
+        windows = np.lib.stride_tricks.as_strided(
+            one_hot, 
+            shape=(n_positions, self.max_len*5), 
+            strides=(one_hot.strides[0], one_hot.strides[1]))
+
+        scores = np.zeros((len(self), n_positions), dtype='float32')
+        for start in xrange(0, n_positions, self.chunk_size):
+            chunk = windows[start:start+self.chunk_size].T
+            chunk_scores = self.weights.dot(chunk)
+            if both_strands:
+                chunk_scores = np.maximum(
+                    chunk_scores, self.RC_weights.dot(chunk))
+            scores[:,start:start+self.chunk_size] = chunk_scores
+        scores += self.offsets[:,None]
+        
+        # give the windows that contain an N the mean score. The number of 
+        # N's in each window is found from the cumulative N counts.
+        cum_Ns = np.concatenate(((0,), one_hot[:,4].cumsum()))
+        for motif_len in np.unique(self.lengths):
+            has_N = ( cum_Ns[motif_len:motif_len+n_positions] 
+                      > cum_Ns[:n_positions] )
+            motif_indices = np.flatnonzero(self.lengths == motif_len)
+            scores[np.ix_(motif_indices, has_N)] = self.N_scores[
+                motif_indices,None]
+        
+        # mask the offsets that extend past the end of the sequence
+        for i, n_motif_positions in enumerate(
+                self.n_positions(len(coded_seq))):
+            scores[i,n_motif_positions:] = np.nan
+        return scores
+
+def score_region(region, genome, motifs):
+    """Score every offset of region against each motif.
+
+    motifs is either a MotifLibrary or a list of motifs. Returns a list 
+    containing an array of forward strand scores for each motif.
+    """
+    if not isinstance(motifs, MotifLibrary):
+        motifs = MotifLibrary(motifs)
+    coded_seq = fetch_coded_seq(genome, region[0], region[1], region[2])
+    scores = motifs.score_coded_seq(coded_seq)
+    return [ motif_scores[:n_positions] for motif_scores, n_positions 
+             in izip(scores, motifs.n_positions(len(coded_seq))) ]
 
 def load_energy_data(fname):
     def load_energy(mo_text):
@@ -230,49 +376,71 @@ class Motif():
     def __len__(self):
         return self.length
 
+    def _score_coded_seq(self, coded_seq, score_mat, N_score):
+        """Score every offset of coded_seq on both strands.
+
+        score_mat is indexed by [position, base]. Windows that contain an N
+        are given the score N_score.
+        """
+        coded_seq = code_seq_as_ints(coded_seq)
+        n_offsets = len(coded_seq) - len(self) + 1
+        assert n_offsets > 0
+        # build the reverse complement scores, and add a column for N
+        N_col = np.zeros((len(self), 1))
+        RC_score_mat = np.hstack((score_mat[::-1,::-1], N_col))
+        score_mat = np.hstack((score_mat, N_col))
+        scores = np.zeros(n_offsets, dtype=float)
+        RC_scores = np.zeros(n_offsets, dtype=float)
+        has_N = np.zeros(n_offsets, dtype=bool)
+        for i in xrange(len(self)):
+            bases = coded_seq[i:i+n_offsets]
+            scores += score_mat[i, bases]
+            RC_scores += RC_score_mat[i, bases]
+            has_N |= (bases > 3)
+        scores[has_N] = N_score
+        RC_scores[has_N] = N_score
+        return scores, RC_scores
+
+    def score_coded_seq(self, coded_seq):
+        """Calculate the binding energy of every offset in coded_seq.
+
+        Returns the forward strand, reverse complement, and minimum energies.
+        """
+        scores, RC_scores = self._score_coded_seq(
+            coded_seq, self.motif_data, self.mean_energy-self.consensus_energy)
+        scores += self.consensus_energy
+        RC_scores += self.consensus_energy
+        return scores, RC_scores, np.minimum(scores, RC_scores)
+
+    def pwm_score_coded_seq(self, coded_seq):
+        """Calculate the pwm score of every offset in coded_seq.
+
+        Returns the forward strand, reverse complement, and maximum scores.
+        """
+        scores, RC_scores = self._score_coded_seq(
+            coded_seq, self.pwm, 0.25*len(self))
+        return scores, RC_scores, np.maximum(scores, RC_scores)
+
     def iter_pwm_score(self, seq):
-        seq = seq.upper()
-        for offset in xrange(len(seq) - len(self)+1):
-            subseq = seq[offset:offset+len(self)]
-            assert len(self) == len(subseq)
-            score = 0.0
-            RC_score = 0.0
-            if 'N' in subseq: 
-                yield offset + len(self)/2, False, 0.25*len(self)
-                continue
-            for i, base in enumerate(subseq):
-                score += self.pwm[i][base_map[base]]
-                RC_score += self.pwm[len(self)-i-1][RC_base_map[base]]
+        scores, RC_scores, max_scores = self.pwm_score_coded_seq(seq)
+        for offset, (score, RC_score, max_score) in enumerate(
+                izip(scores, RC_scores, max_scores)):
             RC = True if RC_score > score else False 
-            yield offset, RC, max(score, RC_score)
+            yield offset, RC, max_score
 
     def iter_seq_score(self, seq):
-        for offset in xrange(len(seq) - len(self)+1):
-            subseq = seq[offset:offset+len(self)]
-            assert len(self) == len(subseq)
-            score = self.consensus_energy
-            RC_score = self.consensus_energy
-            if 'N' in subseq:
-                yield offset, False, self.mean_energy
-                continue
-            for i, base in enumerate(subseq):
-                if isinstance(subseq, str): base = base_map[base]
-                score += self.motif_data[i][base]
-                RC_score += self.motif_data[len(self)-i-1][3-base]
-                #score += self.motif_data[i][base_map[base]]
-                #RC_score += self.motif_data[len(self)-i-1][RC_base_map[base]]
-            assert self.consensus_energy-1e-6 <= score <= self.max_energy+1e-6
-            assert self.consensus_energy-1e-6 <= RC_score <= self.max_energy+1e-6
+        scores, RC_scores, min_scores = self.score_coded_seq(seq)
+        for offset, (score, RC_score, min_score) in enumerate(
+                izip(scores, RC_scores, min_scores)):
             RC = True if RC_score < score else False 
-            yield offset, RC, min(score, RC_score)
-            #yield offset, False, score
+            yield offset, RC, min_score
 
     def score_seq(self, seq):
         try: assert len(seq) >= len(self)
         except: 
             print seq
             raise
-        return min(x[2] for x in self.iter_seq_score(seq))
+        return self.score_coded_seq(seq)[2].min()
     
     def est_occ(self, unbnd_tf_conc, seq):
         score = self.score_seq(seq)
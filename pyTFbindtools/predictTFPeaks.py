@@ -2,10 +2,12 @@ import os, sys
 
 from collections import defaultdict
 
-from pysam import FastaFile, TabixFile
+from pysam import TabixFile
 from peaks import load_narrow_peaks
+from coded_genome import load_genome, reload_genome
 
-from motif_tools import load_pwms_from_db, load_selex_models_from_db, score_region
+from motif_tools import (
+    load_pwms_from_db, load_selex_models_from_db, score_region, MotifLibrary )
 
 import multiprocessing
 import grit
@@ -58,7 +60,13 @@ def load_tf_peaks_fnames(
             os.path.join(base_dir, fname))
     return tf_peaks
 
-tf_peak_fnames = load_tf_peaks_fnames()
+# the peak files for each (factor, cell type), which are listed on first use
+tf_peak_fnames = None
+def get_tf_peak_fnames():
+    global tf_peak_fnames
+    if tf_peak_fnames is None:
+        tf_peak_fnames = load_tf_peaks_fnames()
+    return tf_peak_fnames
 
 def parse_arguments():
     import argparse
@@ -66,7 +74,7 @@ def parse_arguments():
         description='Estimate tf binding from sequence and chromatin accessibility data.')
 
     parser.add_argument( '--fasta', type=file, required=True,
-        help='Fasta containing genome sequence.')
+        help='Fasta (or coded genome index) containing genome sequence.')
 
     parser.add_argument( '--tf-names', nargs='+',
                          help='A list of human TF names')
@@ -81,7 +89,7 @@ def parse_arguments():
     global NTHREADS
     NTHREADS = args.threads
 
-    fasta = FastaFile(args.fasta.name)
+    fasta = load_genome(args.fasta.name)
 
     all_peaks = []
     for peaks_fp in args.peaks:
@@ -90,8 +98,8 @@ def parse_arguments():
         for peak in peaks:
             all_peaks.append((sample_id, peak))
     
-    # load the motifs
-    motifs = load_selex_models_from_db(args.tf_names)
+    # load the motifs, and pack them so that each region is scored in one pass
+    motifs = MotifLibrary(load_selex_models_from_db(args.tf_names))
 
     return (motifs, fasta, all_peaks)
 
@@ -107,14 +115,14 @@ def load_summary_stats(peak, fasta, motifs):
     for motif, motif_scores in zip(motifs, region_motifs_scores):
         header.extend("%s_%i_%s" % (motif.tf_name, 1600, label) 
                       for label in header_base)
-        summary_stats.append(motif_scores.mean()/len(motif_scores))
+        summary_stats.append(motif_scores.mean())
         summary_stats.append(motif_scores.max())
         for quantile in mquantiles(motif_scores, prob=quantile_probs):
             summary_stats.append(quantile)
-        motif_scores = motif_scores[:,500:-500]
+        motif_scores = motif_scores[500:-500]
         header.extend("%s_%i_%s" % (motif.tf_name, 600, label) 
                       for label in header_base)
-        summary_stats.append(motif_scores.mean()/len(motif_scores))
+        summary_stats.append(motif_scores.mean())
         summary_stats.append(motif_scores.max())
         for quantile in mquantiles(motif_scores, quantile_probs):
             summary_stats.append(quantile)
@@ -129,7 +137,7 @@ def classify_peak(peak, sample, motifs):
                peak.start+peak.summit+2000)
     status = []
     for motif in motifs:
-        fname = tf_peak_fnames[
+        fname = get_tf_peak_fnames()[
             (motif.tf_name, RMID_term_name_mapping[sample])][0]
         fp = TabixFile(fname)
         if peak[0] not in fp.contigs: 
@@ -148,7 +156,7 @@ def classify_peak(peak, sample, motifs):
 
 def extract_data_worker(ofp, peak_cntr, motifs, fasta, peaks):
     # reload the fasta file to make it thread safe
-    fasta = FastaFile(fasta.filename)
+    fasta = reload_genome(fasta)
     while True:
         index = peak_cntr.return_and_increment()
         if index >= len(peaks): break
@@ -175,9 +183,12 @@ def main():
     #output_fname = 'SELEX.output.txt'
     output_fname = 'SELEX.predictors.YY1.txt'
 
+    # list the peak files before forking, so that each worker doesn't have to
+    get_tf_peak_fnames()
     header, stats = load_summary_stats(peaks[100][1], fasta, motifs)
     with ThreadSafeFile(output_fname, 'w') as ofp:
         ofp.write("\t".join(header) + "\n")
         fork_and_wait(NTHREADS, extract_data_worker, (ofp, peak_cntr, motifs, fasta, peaks))
 
-main()
+if __name__ == '__main__':
+    main()
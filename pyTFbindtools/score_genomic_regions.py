@@ -5,8 +5,6 @@ import time
 
 import math
 
-import cPickle as pickle
-
 from collections import defaultdict
 from itertools import chain
 
@@ -14,7 +12,6 @@ from scipy.stats import spearmanr, rankdata
 
 import numpy
 
-from pysam import FastaFile
 
 import multiprocessing.queues
 import Queue
@@ -26,23 +23,37 @@ from grit.lib.multiprocessing_utils import fork_and_wait, ProcessSafeOPStream
 from grit.frag_len import build_normal_density
 
 import pandas as pd
-from pandas.tools.plotting import scatter_matrix
-
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
 from DNABindingProteins import ChIPSeqReads
+from coded_genome import load_genome, reload_genome
+from coverage_tracks import load_coverage_tracks, MergedChIPSeqCoverage
+from feature_cache import (
+    RegionFeatureCache, region_digest, motif_digest, reads_digest )
 
-from motif_tools import estimate_unbnd_conc_in_region, Motif, logistic, R, T
+from motif_tools import (
+    estimate_unbnd_conc_in_region, Motif, logistic, R, T, 
+    fetch_coded_seq, decode_seq_from_ints )
 
 NTHREADS = 1
 PLOT = False
 MAX_N_PEAKS = 10000
+# the number of peaks whose summary statistics are calculated at once
+SUMMARY_STATS_BATCH_SIZE = 1000
+# the RegionFeatureCache that peak region features are stored in
+REGION_FEATURE_CACHE = None
 
 MAX_ENERGY_WIGGLE = -math.log(1e-12)
 
+def import_pyplot():
+    """Import pyplot with a non-interactive backend.
+
+    matplotlib is only imported when we plot, because importing it is slow.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 class ATACSeqReads(Reads):
     pass
 
@@ -50,20 +61,11 @@ def load_peak_region(fasta, contig, start, stop,
                      atacseq_reads, histone_mark_reads,
                      factors_and_motifs,
                      factors_and_chipseq_reads, frag_len):
-
-    pickle_fname = PeakRegion.build_pickle_fname(
-        contig, start, stop, 
-        factors_and_chipseq_reads.keys(),
-        [x.name for x in chain(*factors_and_motifs.itervalues())])
-    try:
-        with open(pickle_fname, 'rb') as fp:
-            rv = pickle.load(fp)
-            return rv
-    except IOError:
-        pass
-
+    """Build a peak region, loading its features from 
+    REGION_FEATURE_CACHE (if it's set).
+    """
     peak = PeakRegion(
-        fasta, contig, start, stop)
+        fasta, contig, start, stop, REGION_FEATURE_CACHE)
     peak.add_atacseq_cov(atacseq_reads)
     for factor, motifs in factors_and_motifs.iteritems():
         for motif in motifs:
@@ -71,17 +73,15 @@ def load_peak_region(fasta, contig, start, stop,
     for factor, reads in factors_and_chipseq_reads.iteritems(): 
         peak.add_chipseq_reads(reads)
 
-    peak.write_to_disk()
-
     return peak
 
 class PeakRegion(object):
-    def __init__(self, fasta, contig, start, stop):
+    def __init__(self, fasta, contig, start, stop, cache=None):
         self.contig = contig
         self.start = start
         self.stop = stop
         
-        self.seq = fasta.fetch(contig, start, stop)
+        self.coded_seq = fetch_coded_seq(fasta, contig, start, stop)
         self.control_seq = None
         
         self.atacseq_cov = None
@@ -92,54 +92,44 @@ class PeakRegion(object):
         self.motifs = {} 
         self.pwm_cov = {}
         self.score_cov = {}
+
+        self.cache = cache
+        if cache is not None:
+            self.region_digest = region_digest(fasta, contig, start, stop)
     
     def __len__(self):
         return self.stop - self.start
-    
-    @staticmethod
-    def build_str(contig, start, stop, chipseq_factors, motif_names):
-        rv = []
-        rv.append("%s_%i_%i" % (contig, start, stop))
-        rv.append("-".join(sorted(chipseq_factors)))
-        rv.append("-".join(sorted(motif_names)))
-        return str(hash(".".join(rv)))
-
-    @staticmethod
-    def build_pickle_fname(contig, start, stop, chipseq_factors, motif_names):
-        return "./CACHED_OBJECTS/.PICKLEDREGION.%s.obj" % PeakRegion.build_str(
-            contig, start, stop, chipseq_factors, motif_names)
 
     @property
-    def pickle_fname(self):
-        return self.build_pickle_fname(
-            self.contig, self.start, self.stop,
-            self.chipseq_cov.iterkeys(),
-            self.motifs.iterkeys()
-        )
-
-    def __str__(self):
-        return self.build_str(
-            self.contig, self.start, self.stop,
-            self.chipseq_cov.iterkeys(),
-            self.motifs.iterkeys()
-        )
+    def seq(self):
+        return decode_seq_from_ints(self.coded_seq)
     
-    def write_to_disk(self, op_prefix='.'):
-        op_fname = os.path.join(op_prefix, self.pickle_fname)
-        with open(op_fname, "w") as ofp:
-            pickle.dump(self, ofp)
+    def __str__(self):
+        return "%s_%i_%i" % (self.contig, self.start, self.stop)
+
+    def _get_feature(self, feature, input_digest, build_array):
+        if self.cache is None:
+            return build_array()
+        return self.cache.get(
+            self.region_digest, feature, input_digest, build_array)
 
     def add_atacseq_cov(self, atacseq_reads):
-        self.atacseq_cov = atacseq_reads.build_read_coverage_array(
-            self.contig, '.', self.start, self.stop)
+        self.atacseq_cov = self._get_feature(
+            'atacseq_cov', reads_digest(atacseq_reads), 
+            lambda: atacseq_reads.build_read_coverage_array(
+                self.contig, '.', self.start, self.stop))
         return
     
     def add_motif(self, motif):
         self.motifs[motif.name] = motif
-        self.score_cov[motif.name] = numpy.array(
-            [score for pos, score in motif.iter_seq_score(self.seq)])
-        self.pwm_cov[motif.name] = numpy.array(
-            [score for pos, score in motif.iter_pwm_score(self.seq)])
+        # the scores are stored together, so that they're invalidated together
+        score_cov, pwm_cov = self._get_feature(
+            'motif.%s' % motif.name, motif_digest(motif), 
+            lambda: numpy.vstack((
+                motif.score_coded_seq(self.coded_seq)[2],
+                motif.pwm_score_coded_seq(self.coded_seq)[2])))
+        self.score_cov[motif.name] = score_cov
+        self.pwm_cov[motif.name] = pwm_cov
         return
     
     def add_chipseq_reads(self, chipseq_reads):
@@ -147,15 +137,21 @@ class PeakRegion(object):
         #assert factor not in self.smooth_chipseq_cov
         if isinstance(chipseq_reads, MergedReads):
             reads = chipseq_reads._reads
+        elif isinstance(chipseq_reads, MergedChIPSeqCoverage):
+            reads = chipseq_reads
         else:
             reads = [chipseq_reads,]
         for chipseq_reads in reads:
-            rd_cov = chipseq_reads.build_unpaired_reads_fragment_coverage_array(
-                self.contig, '.', self.start, self.stop, 1, 15)
+            # build the coverage with a window of 15, and the smoothed 
+            # coverage with the fragment length, from one pass over the reads
+            rd_cov, smooth_rd_cov = self._get_feature(
+                'chipseq_cov.%s.%s' % (chipseq_reads.factor, chipseq_reads.id),
+                reads_digest(chipseq_reads),
+                lambda: numpy.vstack(
+                    chipseq_reads.build_unpaired_reads_fragment_coverage_arrays(
+                        self.contig, '.', self.start, self.stop, 1, [15, None])))
             self.chipseq_cov[chipseq_reads.factor][chipseq_reads.id] = rd_cov
 
-            smooth_rd_cov = chipseq_reads.build_unpaired_reads_fragment_coverage_array(
-                self.contig, '.', self.start, self.stop, 15)
             self.smooth_chipseq_cov[chipseq_reads.factor][chipseq_reads.id]=( 
                 smooth_rd_cov/(smooth_rd_cov.sum()+1e-6))
         return
@@ -194,7 +190,8 @@ class PeakRegion(object):
         mean_rvs = []
         max_rvs = []
 
-        trimmed_atacseq_cov = self.atacseq_cov[len(motif)+1:]
+        # weight each binding site by the ATAC-seq coverage at its start
+        trimmed_atacseq_cov = self.atacseq_cov[:-len(motif)]
         atacseq_weights = trimmed_atacseq_cov/trimmed_atacseq_cov.max()
 
         for tf_conc in tf_concs:
@@ -208,113 +205,104 @@ class PeakRegion(object):
         return mean_rv, max_rvs
     
     def calc_summary_stats(self):
-        header = []
-        rv = []
-        
-        # add on the region and atacseq data
-        header.append('pk_length')
-        rv.append(self.stop - self.start)
+        table = calc_summary_stats_batch([self,])
+        return list(table.dtype.names), list(table.tolist()[0])
 
-        header.append('ATAC_mean')        
-        rv.append(self.atacseq_cov.mean())
+def iter_summary_stats_columns(peak):
+    """Iterate over the summary statistic columns of peak.
 
-        header.append('ATAC_max')        
-        rv.append(self.atacseq_cov.max())
+    Yields the column name, the type of the statistic, and the arguments 
+    used to calculate it.
+    """
+    # add on the region and atacseq data
+    yield 'pk_length', 'pk_length', ()
+    yield 'ATAC_mean', 'ATAC_mean', ()
+    yield 'ATAC_max', 'ATAC_max', ()
+
+    # find all factors with motif and chip-seq data
+    factors = sorted(set(motif.factor for name, motif 
+                         in peak.motifs.iteritems()
+                     ).intersection(peak.chipseq_cov.iterkeys()))
+    for factor in factors:
+        for BSID in peak.chipseq_cov[factor].iterkeys():
+            yield ( '%s_%s_mean_ChIPseq_cov' % (factor, BSID), 
+                    'mean_ChIPseq_cov', (factor, BSID) )
+        for motif_name, motif in sorted(peak.motifs.iteritems()):
+            # skip motifs that aren't the correct factor
+            if factor != motif.factor: continue
+            for stat in ('mean_score', 'max_score', 'mean_w_pwm_score',
+                         'mean_occ', 'max_occ'):
+                yield '%s_%s' % (motif_name, stat), stat, (motif_name,)
+    return
 
-        # find all factors with motif and chip-seq data
-        factors = sorted(set(motif.factor for name, motif 
-                            in self.motifs.iteritems()
-                        ).intersection(self.chipseq_cov.iterkeys()))
+def calc_summary_stats_batch(peaks):
+    """Calculate the summary statistics of many peaks.
 
-        percentiles = numpy.array(
-            [1e-3, 1e-2, 0.02, 0.05, 0.10, 0.25, 0.50])
-        
-        for factor in sorted(factors):
-            for BSID, cov in self.chipseq_cov[factor].iteritems():
-                header.append('%s_%s_mean_ChIPseq_cov' % (factor, BSID))
-                rv.append(cov.mean())
-            for motif_name, motif in sorted(self.motifs.iteritems()):
-                # skip motifs that aren't the correct factor
-                if factor != motif.factor: continue
-
-                header.append('%s_mean_score' % motif_name)
-                rv.append(self.score_cov[motif_name].mean())
-
-                header.append('%s_max_score' % motif_name)
-                rv.append(self.score_cov[motif_name].min())
-                #for percentile, score in self.iter_upper_rank_means(
-                #        self.score_cov[motif_name], percentiles):
-                #    header.append('%s_q_%.2f_score' % (motif_name, percentile))
-                #    rv.append(score)
-
-                trimmed_atacseq_cov = self.atacseq_cov[len(motif)+1:]
-                atacseq_weights = trimmed_atacseq_cov/trimmed_atacseq_cov.max()
-                #1000, trimmed_atacseq_cov.max())
-                
-                w_pwm_scores = self.pwm_cov[motif_name]*atacseq_weights
-                header.append('%s_mean_w_pwm_score' % motif_name)
-                rv.append(w_pwm_scores.mean())
-                #for percentile, score in self.iter_upper_rank_means(
-                #        w_pwm_scores, percentiles):
-                #    header.append('%s_q_%.2f_w_pwm_score' % (motif_name, percentile))
-                #    rv.append(score)
-                    
-                #header.append('%s_max_w_pwm_score' % motif_name)
-                #rv.append(w_pwm_scores.max())
-
-                """
-                for tf_conc in [1e-30, 1e-20, 1e-15, 1e-10, 1e-7, 1e-5, 1e-2, 1e-1, 
-                                1, 1e2, 1e5, 1e7, 1e10, 1e15, 1e20, 1e30 ]:
-                    log_tf_conc = numpy.log(tf_conc)
-
-                    raw_occ = logistic(
-                        log_tf_conc - self.score_cov[motif.name]/(R*T))
-                    occ = raw_occ*atacseq_weights
-                    header.append('%s_%e_mean_occ' % (motif_name, tf_conc))
-                    rv.append(occ.mean())
-
-                    #header.append('%s_%e_max_occ' % (motif_name, tf_conc))
-                    #rv.append(occ.max())
-                """
-                log_tf_conc = numpy.log(1e5)
-                raw_occ = logistic(
-                    log_tf_conc - self.score_cov[motif_name]/(R*T))
-                occ = raw_occ*atacseq_weights
-                header.append('%s_mean_occ' % motif_name)
-                rv.append(occ.mean())
-
-                header.append('%s_max_occ' % motif_name)
-                rv.append(occ.max())
-
-                """
-                # XXX
-                # find the raw occupancy that provies the best correpondence
-                # between the signals, and then try and predict these 
-                # sequentially
-                unbnd_conc = self.estimate_unbnd_conc_in_region(motif_name)
-                #print self.score_cov[motif_name].mean(), unbnd_conc
-
-                #print unbnd_conc
-                #unbnd_conc = 0.0
-                raw_occ = logistic(
-                    unbnd_conc + self.score_cov[motif_name]/(R*T))
-                occ = raw_occ*atacseq_weights
-                header.append('%s_weighted_occ' % motif_name)
-                rv.append(occ.mean())
-
-                header.append('%s_unbnd_conc' % motif_name)
-                rv.append(unbnd_conc)
-                """
-
-                #for percentile, score in self.iter_upper_rank_means(
-                #        occ, percentiles):
-                #    header.append('%s_q_%.2f_occ' % (motif_name, percentile))
-                #    rv.append(score)
-
-                #header.append('%s_max_occ' % motif_name)
-                #rv.append(occ.max())
-
-        return header, rv
+    The peaks must all have the same motifs and ChIP-seq data. Peaks of the
+    same length are stacked, and every statistic is calculated for all of 
+    them at once. Returns a numpy structured array with one row per peak 
+    (in the order of peaks) and one field per column, which can be passed 
+    directly to pandas.DataFrame.
+    """
+    columns = list(iter_summary_stats_columns(peaks[0]))
+    table = numpy.zeros(len(peaks), dtype=[
+        (name, 'int64' if stat == 'pk_length' else 'float64')
+        for name, stat, args in columns])
+
+    # group the peaks by length, so that their coverage can be stacked
+    indices_by_length = defaultdict(list)
+    for i, peak in enumerate(peaks):
+        indices_by_length[len(peak)].append(i)
+    
+    def calc_motif_stats(pks, atacseq_cov, motif_name):
+        motif = pks[0].motifs[motif_name]
+        scores = numpy.vstack([pk.score_cov[motif_name] for pk in pks])
+        pwm_scores = numpy.vstack([pk.pwm_cov[motif_name] for pk in pks])
+        # weight each binding site by the ATAC-seq coverage at its start
+        trimmed_atacseq_cov = atacseq_cov[:,:-len(motif)]
+        atacseq_weights = (
+            trimmed_atacseq_cov/trimmed_atacseq_cov.max(1)[:,None])
+        w_pwm_scores = pwm_scores*atacseq_weights
+        log_tf_conc = numpy.log(1e5)
+        raw_occ = logistic(log_tf_conc - scores/(R*T))
+        occ = raw_occ*atacseq_weights
+        return { 'mean_score': scores.mean(1),
+                 'max_score': scores.min(1),
+                 'mean_w_pwm_score': w_pwm_scores.mean(1),
+                 'mean_occ': occ.mean(1),
+                 'max_occ': occ.max(1) }
+
+    for indices in indices_by_length.itervalues():
+        pks = [peaks[i] for i in indices]
+        atacseq_cov = numpy.vstack([pk.atacseq_cov for pk in pks])
+        motifs_stats = {}
+        for name, stat, args in columns:
+            if stat == 'pk_length':
+                vals = [pk.stop - pk.start for pk in pks]
+            elif stat == 'ATAC_mean':
+                vals = atacseq_cov.mean(1)
+            elif stat == 'ATAC_max':
+                vals = atacseq_cov.max(1)
+            elif stat == 'mean_ChIPseq_cov':
+                factor, BSID = args
+                vals = numpy.vstack(
+                    [pk.chipseq_cov[factor][BSID] for pk in pks]).mean(1)
+            else:
+                motif_name, = args
+                if motif_name not in motifs_stats:
+                    motifs_stats[motif_name] = calc_motif_stats(
+                        pks, atacseq_cov, motif_name)
+                vals = motifs_stats[motif_name][stat]
+            table[name][indices] = vals
+
+    return table
+
+def write_summary_stats(ofp, table):
+    """Write the rows of a summary statistics table as tab delimited lines.
+    """
+    ofp.write("".join(
+        "\t".join(map(str, row)) + "\n" for row in table.tolist()))
+    return
 
 def OLD():
     """Just a place to store code temporarily""" 
@@ -371,31 +359,46 @@ def process_peaks_worker(proc_queue, ofp,
                          chipseq_reads, atacseq_reads, histone_mark_reads,
                          frag_len):
     # relaod the file handles to make random access process safe 
-    fasta = FastaFile(fasta.filename)
+    fasta = reload_genome(fasta)
     for key, reads in chipseq_reads.iteritems():
         chipseq_reads[key] = reads.reload()
     atacseq_reads = atacseq_reads.reload()
+    def write_batch(peaks):
+        try: 
+            write_summary_stats(ofp, calc_summary_stats_batch(peaks))
+        except:
+            # fall back to the individual peaks, so that one bad peak
+            # doesn't lose the whole batch
+            for peak in peaks:
+                try: header, vals = peak.calc_summary_stats()
+                except:
+                    print "ERROR"
+                    continue
+                ofp.write("\t".join(map(str, vals)) + "\n") 
+        return
+
+    peaks = []
     while proc_queue.qsize() > 0:
         try: 
             region = proc_queue.get(timeout=0.5)[:3]
         except Queue.Empty: 
             continue 
         
-        peak = load_peak_region(
+        peaks.append(load_peak_region(
             fasta, 
             region[0], max(0, region[1]-2*frag_len), region[2]+2*frag_len, 
             atacseq_reads, histone_mark_reads,
             motif, 
-            chipseq_reads, frag_len)
-
-        try: header, vals = peak.calc_summary_stats()
-        except:
-            print "ERROR"
-            continue
-        rv = "\t".join(map(str, vals))        
+            chipseq_reads, frag_len))
+        if len(peaks) == SUMMARY_STATS_BATCH_SIZE:
+            write_batch(peaks)
+            peaks = []
         if proc_queue.qsize() > 0 and proc_queue.qsize() % 100 == 0:
             print >> sys.stderr, "%i\t%i" % (proc_queue.qsize(),os.getpid())
-        ofp.write( rv + "\n") 
+    if len(peaks) > 0:
+        write_batch(peaks)
+    if REGION_FEATURE_CACHE is not None:
+        REGION_FEATURE_CACHE.flush()
     
     return
 
@@ -424,6 +427,8 @@ class SummaryResults(pd.DataFrame):
         f_and_c = self.get_factors_and_column_indices()
         # add in the atac seq column
         columns = [1,] + f_and_c[factor]
+        import_pyplot()
+        from pandas.tools.plotting import scatter_matrix
         scatter_matrix(self[columns].rank(),  
                        figsize=(16,16), 
                        alpha=0.05, color='black')
@@ -433,6 +438,8 @@ class SummaryResults(pd.DataFrame):
         # add in the atac seq column
         columns = [1,] + f_and_c[factor]
         corr_mat = self.rank_correlation(columns)
+        import_pyplot()
+        from matplotlib import cm
         corr_mat.plot(figsize=(16,16), table=True, colormap=cm.gist_rainbow)
 
     
@@ -457,42 +464,12 @@ def load_summary_stats(fname):
             #plt.close()
 
             data.rank_plot(factor)
+            plt = import_pyplot()
             plt.savefig("%s.%s.rankcor.png" % (fname, factor))
             plt.close()
             print "FINISHED ", "%s.%s.rankcor.png" % (fname, factor)
 
 
-def collect_and_write_peak_summary_stats(
-        peaks, motifs, fasta, 
-        chipseq_reads, 
-        atacseq_reads, histone_mark_reads, 
-        frag_len, ofname):
-    proc_queue = multiprocessing.Queue()
-    for pk in peaks: proc_queue.put(pk)
-
-    # process a single peak so that we know what to name the columns
-    region = proc_queue.get()
-    peak = load_peak_region(
-        fasta, 
-        region[0], max(0, region[1]-2*frag_len), region[2]+2*frag_len,
-        atacseq_reads, histone_mark_reads,
-        motifs, 
-        chipseq_reads,
-        frag_len)
-    header, vals = peak.calc_summary_stats()
-
-    ofp = ProcessSafeOPStream(open(ofname, "w"))
-    args = [proc_queue, ofp, motifs, fasta, 
-            chipseq_reads, atacseq_reads, histone_mark_reads, frag_len]
-
-    ofp.write("\t".join(header) + "\n")
-    ofp.write("\t".join(map(str, vals)) + "\n")
-
-    fork_and_wait(NTHREADS, process_peaks_worker, args)
-    # let the printing catch up
-    time.sleep(0.1)
-    ofp.close()
-
 def collect_and_write_peak_summary_stats(
         peaks, motifs, fasta, 
         chipseq_reads, 
@@ -525,6 +502,7 @@ def collect_and_write_peak_summary_stats(
     ofp.close()
 
 def plot_predicted_vs_observed_pks(obs_score, pred_score, ofname):
+    plt = import_pyplot()
     plt.figure()
     heatmap, xedges, yedges = numpy.histogram2d(
         rankdata(-obs_score, method='ordinal'), 
@@ -657,7 +635,7 @@ def parse_arguments():
         description='Estimate tf binding from sequence and chromatin accessibility data.')
 
     parser.add_argument( '--fasta', type=file, required=True,
-        help='Fasta containing genome sequence.')
+        help='Fasta (or coded genome index) containing genome sequence.')
 
     parser.add_argument( '--motifs', type=file,  nargs='+',
         help='Files containing a PWM.')
@@ -668,9 +646,14 @@ def parse_arguments():
     parser.add_argument( '--ChIP-seq-reads', type=file,  nargs='+',
         help='File containing ChIP-seq reads.')
 
-    parser.add_argument( '--ATAC-seq-reads', type=file,  required=True,
+    parser.add_argument( '--ATAC-seq-reads', type=file,
         help='Indexed BAM file containing ATAC seq reads.')
 
+    parser.add_argument( '--coverage-tracks', 
+        help='Coverage track store (built by build_coverage_tracks.py) to '
+             + 'read the ATAC-seq and ChIP-seq coverage from, instead of '
+             + 'the BAMs.')
+
     parser.add_argument( '--Histone-mark-seq-reads', type=file, 
                          nargs='*', default=[], 
         help='Indexed BAM files containing histone mark reads.')
@@ -685,6 +668,15 @@ def parse_arguments():
     parser.add_argument( '--threads', '-t', default=1, type=int,
                          help='The number of threads to run.')
 
+    parser.add_argument( '--feature-cache', 
+        default='./CACHED_OBJECTS/region_features.sqlite',
+        help='Database to cache the peak region features in.')
+    parser.add_argument( '--feature-cache-size', type=float, default=10.0,
+        help='The maximum size of the feature cache, in GB (default: 10).')
+    parser.add_argument( '--no-feature-cache', default=False, 
+                         action='store_true',
+                         help="Don't cache the peak region features.")
+
     args = parser.parse_args()
     global NTHREADS
     NTHREADS = args.threads
@@ -692,10 +684,15 @@ def parse_arguments():
     global PLOT
     PLOT = args.plot
 
-    fasta = FastaFile(args.fasta.name)
+    global REGION_FEATURE_CACHE
+    if not args.no_feature_cache:
+        REGION_FEATURE_CACHE = RegionFeatureCache(
+            args.feature_cache, int(args.feature_cache_size*2**30))
 
-    atacseq_reads = ATACSeqReads(args.ATAC_seq_reads.name).init(
-        True, True, False, False)
+    fasta = load_genome(args.fasta.name)
+
+    if args.coverage_tracks is None and args.ATAC_seq_reads is None:
+        parser.error("Either --ATAC-seq-reads or --coverage-tracks is required")
 
     peaks = load_narrow_peaks(args.peaks.name)
     
@@ -706,8 +703,14 @@ def parse_arguments():
         motifs[motif.factor].append(motif)
     motifs = dict(motifs)
     
-    # load the chipseq data
-    chipseq_reads = load_chipseq_reads(args.ChIP_seq_reads)
+    # load the ATAC-seq and chipseq data
+    if args.coverage_tracks is not None:
+        atacseq_reads, chipseq_reads = load_coverage_tracks(
+            args.coverage_tracks)
+    else:
+        atacseq_reads = ATACSeqReads(args.ATAC_seq_reads.name).init(
+            True, True, False, False)
+        chipseq_reads = load_chipseq_reads(args.ChIP_seq_reads)
 
     # load the chipseq data
     histone_mark_reads = load_chipseq_reads(args.Histone_mark_seq_reads)
@@ -728,8 +731,7 @@ def find_optimal_GFE(motif, pks, chipseq_scores, atacseq_signal):
     for GFE in numpy.arange(-20, 10, 1.0):
         motif.build_occupancy_weights(4, GFE)
         for pk_i, pk in enumerate(pks):
-            score_cov = numpy.array(
-                [score for pos, score in motif.iter_seq_score(pk.seq)])
+            score_cov = motif.score_coded_seq(pk.coded_seq)[2]
             scores[pk_i, len(motif)+1:] = score_cov
         res.append((
             spearmanr((logistic(-scores/(R*T))*atacseq_signal).mean(1), chipseq_scores)[0],
@@ -760,6 +762,8 @@ def main():
                               atacseq_reads, histone_mark_reads,
                               motifs, chipseq_reads, 150)
         pks.append(pk)
+    if REGION_FEATURE_CACHE is not None:
+        REGION_FEATURE_CACHE.flush()
     
     max_len = max(len(pk) for pk in pks)
     print "Max Length: ", max_len
@@ -1,37 +1,49 @@
 import os, sys
 import math
+import hashlib
+import multiprocessing
 
-from itertools import product, izip, chain
+from itertools import product, izip
 
-from collections import defaultdict, namedtuple
+from collections import namedtuple, OrderedDict
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-import theano
-import theano.tensor as TT
-
-from scipy.optimize import (
-    minimize, minimize_scalar, brentq, approx_fprime )
+from scipy.optimize import minimize, minimize_scalar
+from scipy.special import expit
 from numpy.fft import rfft, irfft
 
 import random
 
 import pyTFbindtools
 
+from .cache import array_checksum
+from .backends import get_backend, set_backend
+from .shape import load_shape_table, code_fivemer, code_shape_features
+
 from ..motif_tools import (
-    load_motifs, logistic, R, T, DeltaDeltaGArray, Motif, load_motif_from_text)
+    load_motifs, logistic, R, T, DeltaDeltaGArray, Motif, load_motif_from_text,
+    base_code_table)
 
 # ignore theano warnings
 import warnings
 warnings.simplefilter("ignore")
 
 PARTITION_FN_SAMPLE_SIZE = 10000
+# the number of energy bins used by the DP partition function estimate, and
+# the number of estimates to cache (the optimizer evaluates each parameter 
+# vector several times)
+PARTITION_FN_N_BINS = 2**12
+PARTITION_FN_CACHE_SIZE = 16
 
 CMP_LHD_NUMERATOR_CALCS = False
 RANDOM_POOL_SIZE = None
+# the number of random reads to simulate and score at once
+RANDOM_POOL_CHUNK_SIZE = 100000
 CONVERGENCE_MAX_LHD_CHANGE = None
 MAX_NUM_ITER = 1000
+# the number of processes to use when calculating the lhd gradient 
+NTHREADS = 1
 
 EXPECTED_MEAN_ENERGY = -3.0
 CONSTRAIN_MEAN_ENERGY = True
@@ -41,43 +53,15 @@ MAX_BASE_ENERGY_DIFF = 8.0
 
 USE_SHAPE = False
 
+# an ArrayCache (see selex/cache.py) used to store the coded sequences on 
+# disk between runs. If None, the coded sequences aren't cached
+CODED_SEQS_CACHE = None
+
 # during optimization, how much to account for previous values
 MOMENTUM = None
 
 RC_map = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
 base_map_dict = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 0: 0, 1: 1, 2: 2, 3: 3}
-ShapeData = namedtuple(
-    'ShapeData', ['HelT', 'MGW', 'LProT', 'RProT', 'LRoll', 'RRoll'])
-
-def load_shape_data():
-    prefix = os.path.join(os.path.dirname(__file__), './shape_data/')
-    fivemer_fnames = ["all_fivemers.HelT", "all_fivemers.MGW"]
-    fourmer_fnames = ["all_fivemers.ProT", "all_fivemers.Roll"]
-    shape_params = defaultdict(list)
-    # load shape data for all of the fivemers 
-    for fname in chain(fivemer_fnames, fourmer_fnames):
-        shape_param_name = fname.split(".")[-1]
-        with open(os.path.join(prefix, fname)) as fp:
-            for data in fp.read().strip().split(">")[1:]:
-                seq, params = data.split()
-                param = params.split(";")
-                if len(param) == 5:
-                    shape_params[seq].append(float(param[2]))
-                elif len(param) == 4:
-                    shape_params[seq].append(float(param[1]))
-                    shape_params[seq].append(float(param[2]))
-    
-    # cast into a named tuple
-    for seq, values in shape_params.iteritems():
-        shape_params[seq] = ShapeData(*values)
-    
-    return dict(shape_params)
-
-shape_data = load_shape_data()
-#for seq, values in shape_data.iteritems():
-#    print seq, values
-#assert False
-
 def base_map(base):
     if base == 'N':
         base = random.choice('ACGT')
@@ -101,12 +85,13 @@ def est_shape_params_for_subseq(subseq):
     a vector of length len(subseq) - 2 (because the encoding is done with 
     fivemers)
     """
-    res = np.zeros(6*(len(subseq)-4), dtype=theano.config.floatX)
+    shape_table = load_shape_table()
+    res = np.zeros(6*(len(subseq)-4), dtype=get_backend().floatX)
     for i, fivemer in enumerate(iter_fivemers(subseq)):
         if 'N' in fivemer:
             res[6*i:6*(i+1)] = 0
         else:
-            res[6*i:6*(i+1)] = shape_data[fivemer]
+            res[6*i:6*(i+1)] = shape_table[code_fivemer(fivemer)]
     return res
 
 def code_subseq(subseq, left_flank_dimer, right_flank_dimer, motif_len):
@@ -118,7 +103,7 @@ def code_subseq(subseq, left_flank_dimer, right_flank_dimer, motif_len):
     len_per_base = 3
     if USE_SHAPE: 
         len_per_base += 6 
-    values = np.zeros(motif_len*len_per_base, dtype=theano.config.floatX)
+    values = np.zeros(motif_len*len_per_base, dtype=get_backend().floatX)
     coded_subseq = np.array([
         pos*3 + (base_map(base) - 1) 
         for pos, base in enumerate(subseq)
@@ -144,34 +129,144 @@ def code_sequence(seq, motif_len,
         values = code_subseq(subseq, left_flank, right_flank, motif_len)
         coded_bss.append(values)
 
+        # the flanks of the reverse complement are the reverse complements
+        # of the opposite flanks
         subseq = "".join(
             RC_map[base] for base in reversed(seq[offset:offset+motif_len]))
         left_flank = "".join(
+            RC_map[base] for base in reversed(
+                seq[offset+motif_len:offset+motif_len+2]))
+        right_flank = "".join(
             RC_map[base] for base in reversed(seq[offset-2:offset]))
-        right_flank_flank = "".join(
-            RC_map[base] for base in reversed(seq[offset+motif_len:offset+motif_len+2]))
         values = code_subseq(subseq, left_flank, right_flank, motif_len)
         coded_bss.append(values)
 
     return coded_bss
 
-def code_seqs(seqs, motif_len, n_seqs=None, ON_GPU=True):
+def code_reads(seqs):
+    """Code equal length reads as a (n_seqs, read_len) uint8 matrix.
+
+    Bases are coded as A,C,G,T -> 0,1,2,3, and N's are replaced with a random
+    base (like base_map). seqs can be an iterable of strings (or of tuples of
+    bases), or an already coded matrix, which is returned unchanged.
+    """
+    if isinstance(seqs, np.ndarray):
+        return seqs
+    seqs = ["".join(seq) for seq in seqs]
+    read_len = len(seqs[0])
+    assert all(len(seq) == read_len for seq in seqs), \
+        "All of the reads must be the same length"
+    coded_reads = base_code_table[
+        np.frombuffer("".join(seqs), dtype='uint8')].reshape(
+            (len(seqs), read_len))
+    is_N = (coded_reads > 3)
+    coded_reads[is_N] = np.random.randint(4, size=is_N.sum())
+    return coded_reads
+
+def count_unique_reads(coded_reads):
+    """Collapse duplicate reads in a coded read matrix.
+
+    Returns the unique reads, and the number of times that each was observed.
+    """
+    # view each read as a single opaque value, so that reads can be sorted
+    read_values = np.ascontiguousarray(coded_reads).view(
+        np.dtype((np.void, coded_reads.dtype.itemsize*coded_reads.shape[1])))
+    unique_values, indices, cnts = np.unique(
+        read_values[:,0], return_index=True, return_counts=True)
+    return coded_reads[indices], cnts
+
+def code_binding_sites(coded_reads, motif_len, dtype):
+    """Code all of the binding sites in a matrix of coded reads.
+
+    Returns a (n_seqs, n_bind_sites, 3*motif_len) array, with the forward and 
+    reverse complement binding sites interleaved (in the same order as 
+    code_sequence). Each base is coded by 3 indicators (for C, G and T). 
+    """
+    n_seqs, read_len = coded_reads.shape
+    n_offsets = read_len - motif_len + 1
+    coded_seqs = np.empty(
+        (n_seqs, 2*n_offsets, 3*motif_len), dtype=dtype)
+    
+    def build_windows(reads):
+        one_hot = np.ascontiguousarray(
+            reads[:,:,None] == np.arange(1, 4, dtype='uint8'), dtype=dtype)
+        # build a view of all of the subsequences of length motif_len
+        return np.lib.stride_tricks.as_strided(
+            one_hot, 
+            shape=(n_seqs, n_offsets, 3*motif_len), 
+            strides=(one_hot.strides[0], one_hot.strides[1], one_hot.strides[2]))
+
+    coded_seqs[:,0::2,:] = build_windows(coded_reads)
+    # the reverse complement of the binding site starting at offset i is the
+    # binding site starting at offset n_offsets-i-1 of the reversed read
+    coded_seqs[:,1::2,:] = build_windows(3 - coded_reads[:,::-1])[:,::-1,:]
+    return coded_seqs
+
+def enumerate_coded_binding_sites(coded_reads, bs_len):
+    """Enumerate the binding sites in a matrix of coded reads.
+
+    Returns a (n_seqs, n_bind_sites, bs_len) uint8 array of coded bases with 
+    the forward and reverse complement binding sites interleaved (in the same
+    order as enumerate_binding_sites).
+    """
+    coded_reads = np.ascontiguousarray(coded_reads)
+    n_seqs, read_len = coded_reads.shape
+    n_offsets = read_len - bs_len + 1
+    binding_sites = np.empty((n_seqs, 2*n_offsets, bs_len), dtype='uint8')
+
+    def build_windows(reads):
+        return np.lib.stride_tricks.as_strided(
+            reads, 
+            shape=(n_seqs, n_offsets, bs_len), 
+            strides=(reads.strides[0], reads.strides[1], reads.strides[1]))
+
+    binding_sites[:,0::2,:] = build_windows(coded_reads)
+    binding_sites[:,1::2,:] = build_windows(
+        np.ascontiguousarray(3 - coded_reads[:,::-1]))[:,::-1,:]
+    return binding_sites
+
+def code_seqs(seqs, motif_len, n_seqs=None, ON_GPU=True, dtype=None):
     """Load SELEX data and encode all the subsequences. 
 
+    seqs can be an iterable of reads or a coded read matrix (see code_reads).
+    dtype defaults to the backend's float type, but can be set to e.g. 
+    'float16' to reduce the memory footprint. If ON_GPU is set, the coded
+    sequences are stored with the backend (see backends.py).
     """
-    if n_seqs == None: n_seqs = len(seqs)
-    subseq0 = code_sequence(next(iter(seqs)), motif_len)
-    # leave 3 rows for each sequence base, and 6 for the shape params
-    len_per_base = 3
-    if USE_SHAPE:
-        len_per_base += 6
-    coded_seqs = np.zeros((n_seqs, len(subseq0), motif_len*len_per_base), 
-                          dtype=theano.config.floatX)
-    for i, seq in enumerate(seqs):
-        for j, param_values in enumerate(code_sequence(seq, motif_len)):
-            coded_seqs[i, j, :] = param_values
+    if dtype == None: dtype = get_backend().floatX
+    coded_reads = code_reads(seqs)
+    if n_seqs != None: coded_reads = coded_reads[:n_seqs]
+    def build_coded_seqs():
+        if USE_SHAPE:
+            return code_seqs_w_shape(
+                coded_reads, motif_len, ON_GPU=False, dtype=dtype)
+        return code_binding_sites(coded_reads, motif_len, dtype)
+    if CODED_SEQS_CACHE is None:
+        coded_seqs = build_coded_seqs()
+    else:
+        key = ( 'coded_seqs', array_checksum(coded_reads), 
+                motif_len, USE_SHAPE, np.dtype(dtype).str )
+        coded_seqs = CODED_SEQS_CACHE.get(key, build_coded_seqs)
     if ON_GPU:
-        return theano.shared(coded_seqs)
+        return get_backend().shared(coded_seqs)
+    else:
+        return coded_seqs
+
+def code_seqs_w_shape(seqs, motif_len, n_seqs=None, ON_GPU=True, dtype=None):
+    """Encode all the subsequences, including the shape parameters.
+
+    Each binding site is coded by 3 base indicators for every position,
+    followed by the 6 shape parameters for every position (the same layout
+    as code_sequence).
+    """
+    if dtype == None: dtype = get_backend().floatX
+    coded_reads = code_reads(seqs)
+    if n_seqs != None: coded_reads = coded_reads[:n_seqs]
+    coded_seqs = np.concatenate(
+        (code_binding_sites(coded_reads, motif_len, dtype),
+         code_shape_features(coded_reads, motif_len, dtype)), axis=2)
+    if ON_GPU:
+        return get_backend().shared(coded_seqs)
     else:
         return coded_seqs
 
@@ -237,56 +332,167 @@ def est_partition_fn_brute(ref_energy, ddg_array, n_bind_sites, seq_len):
     min_pdf = np.array(np.diff(min_cdf), dtype='float32')
     return energies, min_cdf
 
-def est_partition_fn_sampling(ref_energy, ddg_array, n_bind_sites, seq_len):
+def load_partition_fn_sample(motif_len, seq_len):
+    """Load (and cache) the coded binding sites of the random read sample.
+    """
     n_sims = PARTITION_FN_SAMPLE_SIZE
-    key = ('SIM', ddg_array.motif_len)
+    key = ('SIM', motif_len)
     if key not in cached_coded_seqs:
-        current_pool = ["".join(random.choice('ACGT') for j in xrange(seq_len))
-                        for i in xrange(n_sims)]
-        coded_seqs = code_seqs(current_pool, ddg_array.motif_len, ON_GPU=False)
+        current_pool = np.random.randint(4, size=(n_sims, seq_len)).astype('uint8')
+        coded_seqs = code_seqs(current_pool, motif_len, ON_GPU=False)
         cached_coded_seqs[key] = coded_seqs
-    coded_seqs = cached_coded_seqs[key]
+    return cached_coded_seqs[key]
+
+def est_partition_fn_sampling(ref_energy, ddg_array, n_bind_sites, seq_len):
+    coded_seqs = load_partition_fn_sample(ddg_array.motif_len, seq_len)
     energies = ref_energy + coded_seqs.dot(ddg_array).min(1)
     energies.sort()
     part_fn = np.ones(len(energies), dtype=float)/len(energies)
     return energies, part_fn
 
+def est_partition_fn_sampling_w_grad(
+        ref_energy, ddg_array, n_bind_sites, seq_len):
+    """Estimate the partition function, and the gradient of each energy.
+
+    Returns the energies, the partition function, and a 
+    (len(energies), 1+len(ddg_array)) array containing the derivatives of 
+    each energy with respect to the reference energy and ddg_array. 
+    """
+    coded_seqs = load_partition_fn_sample(ddg_array.motif_len, seq_len)
+    bs_indices = coded_seqs.dot(ddg_array).argmin(1)
+    # the energy of each read is the energy of its best binding site, so 
+    # the gradient is the coding of that binding site
+    bs_coding = coded_seqs[np.arange(len(coded_seqs)), bs_indices]
+    energies = ref_energy + bs_coding.dot(ddg_array)
+    energy_grads = np.hstack((np.ones((len(energies), 1)), bs_coding))
+    sorted_indices = energies.argsort()
+    part_fn = np.ones(len(energies), dtype=float)/len(energies)
+    return ( energies[sorted_indices], 
+             part_fn, 
+             energy_grads[sorted_indices] )
+
+def calc_binned_site_energy_dist(ddg_array, n_bins, calc_features=False):
+    """Calculate the binned energy distribution of a random binding site.
+
+    The distribution is built one motif position at a time: each base shifts 
+    a quarter of the current probability mass by the (rounded) energy of 
+    that base. Rather than use the bin centers, we track the probability 
+    weighted energy (or, if calc_features is set, the probability weighted 
+    coding of the binding sites) in each bin so that the energy of each bin 
+    is the mean energy of the binding sites that it contains.
+
+    Returns the probability mass in each bin, and the probability weighted 
+    energies (or codings).
+    """
+    motif_len = ddg_array.motif_len
+    base_conts = ddg_array.calc_base_contributions()
+    base_conts -= base_conts.min(1)[:,None]
+    energy_range = max(base_conts.max(1).sum(), 1e-6)
+    step_size = energy_range/(n_bins-motif_len)
+    base_offsets = np.array((base_conts/step_size).round(), dtype=int)
+    # the sum of the rounded offsets can't exceed n_bins-motif_len/2
+    n_used_bins = base_offsets.max(1).sum() + 1
+    assert n_used_bins <= n_bins
+    return get_backend().calc_binned_site_energy_dist(
+        base_offsets, ddg_array, n_used_bins, calc_features)
+
+cached_partition_fns = OrderedDict()
+def est_partition_fn_dp_w_grad(ref_energy, ddg_array, n_bind_sites, seq_len, 
+                               n_bins=PARTITION_FN_N_BINS, 
+                               calc_grad=True):
+    """Estimate the partition function with a binned dynamic program.
+
+    The energy of a read is the minimum energy over its n_bind_sites binding
+    sites, which we assume are independent. This is deterministic, works for
+    any motif length, and the result (which only depends on ref_energy 
+    through a shift) is cached. Returns the bin energies, the (read only) 
+    partition function, and (if calc_grad is set) the derivatives of each 
+    energy with respect to the reference energy and ddg_array.
+    """
+    key = ( hashlib.sha1(np.ascontiguousarray(ddg_array)).hexdigest(), 
+            ddg_array.dtype.str, n_bind_sites, n_bins, calc_grad )
+    if key in cached_partition_fns:
+        energies, min_pdf, energy_grads = cached_partition_fns.pop(key)
+    else:
+        pdf, weighted_vals = calc_binned_site_energy_dist(
+            ddg_array, n_bins, calc_features=calc_grad)
+        ## Account for the energy being the minimum over multiple binding sites
+        cdf = pdf.cumsum().clip(0, 1)
+        min_cdf = -np.expm1(n_bind_sites*np.log1p(-cdf))
+        min_pdf = np.diff(np.insert(min_cdf, 0, 0.0))
+        # drop the empty bins
+        nonzero_bins = (pdf > 0)
+        min_pdf = min_pdf[nonzero_bins]
+        if calc_grad:
+            features = weighted_vals[nonzero_bins]/pdf[nonzero_bins,None]
+            energies = features.dot(ddg_array)
+            energy_grads = np.hstack((np.ones((len(energies), 1)), features))
+            energy_grads.flags.writeable = False
+        else:
+            energies = weighted_vals[nonzero_bins]/pdf[nonzero_bins]
+            energy_grads = None
+        min_pdf.flags.writeable = False
+        energies.flags.writeable = False
+        if len(cached_partition_fns) >= PARTITION_FN_CACHE_SIZE:
+            cached_partition_fns.popitem(last=False)
+    cached_partition_fns[key] = (energies, min_pdf, energy_grads)
+    
+    if calc_grad:
+        return ref_energy + energies, min_pdf, energy_grads
+    else:
+        return ref_energy + energies, min_pdf
+
+def est_partition_fn_dp(ref_energy, ddg_array, n_bind_sites, seq_len, 
+                        n_bins=PARTITION_FN_N_BINS):
+    return est_partition_fn_dp_w_grad(
+        ref_energy, ddg_array, n_bind_sites, seq_len, n_bins, calc_grad=False)
+
 #est_partition_fn = est_partition_fn_fft
 #est_partition_fn = est_partition_fn_brute
-est_partition_fn = est_partition_fn_sampling
+#est_partition_fn = est_partition_fn_sampling
+#est_partition_fn_w_grad = est_partition_fn_sampling_w_grad
+est_partition_fn = est_partition_fn_dp
+est_partition_fn_w_grad = est_partition_fn_dp_w_grad
 
 def calc_occ(seq_ddgs, ref_energy, chem_affinity):
     return logistic(-(-chem_affinity+ref_energy+seq_ddgs)/(R*T))
 
-sym_cons_dg = TT.scalar('cons_dg')
-sym_chem_pot = TT.scalar('chem_pot')
-sym_ddg = TT.vector('ddg')
-
-# calculate the sum of log occupancies for a particular round, given a 
-# set of energies
-calc_rnd_lhd_num = theano.function([sym_chem_pot, sym_cons_dg, sym_ddg], -(
-    TT.log(1.0 + TT.exp(
-        (-sym_chem_pot + sym_cons_dg + sym_ddg)/(R*T))).sum())
-)
-
+def calc_rnd_lhd_num(chem_pot, cons_dg, ddg):
+    """Calculate the sum of log occupancies for a particular round, given a
+    set of energies.
+    """
+    return get_backend().calc_log_occ_sum(chem_pot, cons_dg, ddg)
 
+def calc_rnd_weighted_lhd_num(chem_pot, cons_dg, ddg, weights):
+    """Calculate the weighted sum of log occupancies for a particular round, 
+    given a set of energies and the number of times that each sequence was
+    observed.
+    """
+    return get_backend().calc_log_occ_sum(chem_pot, cons_dg, ddg, weights)
 
 def calc_lhd_numerators(
-        seq_ddgs, chem_affinities, ref_energy):
+        seq_ddgs, chem_affinities, ref_energy, seq_weights=None):
     # the occupancies of each rnd are a function of the chemical affinity of
     # the round in which there were sequenced and each previous round. We 
     # loop through each sequenced round, and calculate the numerator of the log 
-    # lhd 
+    # lhd. If seq_weights is set, then each sequence's contribution is 
+    # weighted by the number of times that it was observed.
+    def calc_num(chem_affinity, sequencing_rnd, seq_ddgs):
+        if seq_weights is None:
+            return calc_rnd_lhd_num(chem_affinity, ref_energy, seq_ddgs)
+        return calc_rnd_weighted_lhd_num(
+            chem_affinity, ref_energy, seq_ddgs, seq_weights[sequencing_rnd])
+    
     numerators = []
     for sequencing_rnd, seq_ddgs in enumerate(seq_ddgs):
         chem_affinity = chem_affinities[0]
         #numerator = np.log(logistic(-(-chem_affinity+ref_energy+seq_ddgs)/(R*T))).sum()
-        numerator = calc_rnd_lhd_num(chem_affinity, ref_energy, seq_ddgs)
+        numerator = calc_num(chem_affinity, sequencing_rnd, seq_ddgs)
         for rnd in xrange(1, sequencing_rnd+1):
             #numerator += np.log(
             #    logistic(-(-chem_affinities[rnd]+ref_energy+seq_ddgs)/(R*T))).sum()
-            numerator += calc_rnd_lhd_num(
-                chem_affinities[rnd], ref_energy, seq_ddgs)
+            numerator += calc_num(
+                chem_affinities[rnd], sequencing_rnd, seq_ddgs)
         numerators.append(numerator)
     
     if CMP_LHD_NUMERATOR_CALCS:
@@ -303,7 +509,7 @@ def calc_lhd_denominators(
     # now calculate the denominator (the normalizing factor for each round)
     # calculate the expected bin counts in each energy level for round 0
     energies, partition_fn = est_partition_fn(
-        ref_energy, ddg_array, seq_len, n_bind_sites)
+        ref_energy, ddg_array, n_bind_sites, seq_len)
     expected_cnts = (4**seq_len)*partition_fn 
     curr_occupancies = np.ones(len(energies), dtype='float32')
     denominators = []
@@ -313,17 +519,62 @@ def calc_lhd_denominators(
     #print denominators
     return denominators
 
+def calc_lhd_denominators_w_grad(
+        energies, partition_fn, energy_grads, 
+        chem_affinities, chem_affinity_grads, seq_len):
+    """Calculate the lhd denominators, and their gradients.
+
+    chem_affinity_grads contains the gradient of each round's chemical 
+    affinity (see est_chem_potentials_w_grad) so the returned 
+    (n_rnds, n_params) gradient array accounts for the dependence of the 
+    chemical affinities on the energy model.
+    """
+    expected_cnts = (4**seq_len)*partition_fn 
+    curr_occupancies = np.ones(len(energies), dtype=float)
+    # the gradient of log(curr_occupancies) for each energy
+    log_occ_grads = np.zeros(energy_grads.shape, dtype=float)
+    denominators = []
+    denominator_grads = []
+    for rnd, (chem_affinity, chem_affinity_grad) in enumerate(
+            izip(chem_affinities, chem_affinity_grads)):
+        rnd_occs = expit((chem_affinity-energies)/(R*T))
+        curr_occupancies *= rnd_occs
+        log_occ_grads += (((1-rnd_occs)/(R*T))[:,None]*(
+            chem_affinity_grad[None,:] - energy_grads))
+        weights = expected_cnts*curr_occupancies
+        denominators.append( np.log(weights.sum()) )
+        denominator_grads.append( weights.dot(log_occ_grads)/weights.sum() )
+    return np.array(denominators), np.array(denominator_grads)
+
+def build_energy_fn(coded_seqs, motif_len):
+    """Build a function to find the best binding site of each read.
+
+    coded_seqs are either coded reads (see code_reads), which are scored 
+    directly, or coded binding sites (see code_seqs). The function takes a
+    ddg array and returns the minimum energy of each read, and the index of
+    its best binding site.
+    """
+    if isinstance(coded_seqs, np.ndarray) and coded_seqs.ndim == 2:
+        return get_backend().build_read_energy_fn(coded_seqs, motif_len)
+    return get_backend().build_energy_fn(coded_seqs)
+
+def calc_bs_coding_grad(coded_seqs, motif_len, bs_indices, weights):
+    """Calculate the weighted sum of the codings of each read's binding site
+    bs_indices (coded_seqs are as in build_energy_fn).
+    """
+    if isinstance(coded_seqs, np.ndarray) and coded_seqs.ndim == 2:
+        return get_backend().calc_read_coding_grad(
+            coded_seqs, motif_len, bs_indices, weights)
+    coded_seqs = coded_seqs.get_value(borrow=True)
+    return weights.dot(coded_seqs[np.arange(len(coded_seqs)), bs_indices])
+
 def calc_log_lhd_factory(partitioned_and_coded_rnds_and_seqs):    
+    motif_len = partitioned_and_coded_rnds_and_seqs.motif_len
     calc_energy_fns = []
-    sym_e = TT.vector()
     for rnds_and_coded_seqs in partitioned_and_coded_rnds_and_seqs:
         calc_energy_fns.append([])
         for x in rnds_and_coded_seqs:
-            #calc_energy_fns.append(
-            #    theano.function([sym_e], theano.sandbox.cuda.basic_ops.gpu_from_host(
-            #        x.dot(sym_e).min(1)) ) )
-            calc_energy_fns[-1].append(
-                theano.function([sym_e], x.dot(sym_e).min(1)) )
+            calc_energy_fns[-1].append(build_energy_fn(x, motif_len))
     
     def calc_log_lhd(ref_energy, 
                      ddg_array, 
@@ -335,10 +586,14 @@ def calc_log_lhd_factory(partitioned_and_coded_rnds_and_seqs):
         # score all of the sequences
         rnds_and_seq_ddgs = []
         for rnd, calc_energy in enumerate(calc_energy_fns[partition_index]):
-            rnds_and_seq_ddgs.append( calc_energy(ddg_array) )
-        # calculate the numerators
+            rnds_and_seq_ddgs.append( calc_energy(ddg_array)[0] )
+        # calculate the numerators (the sequences are de-duplicated, so we 
+        # weight them by their counts)
+        rnds_and_read_cnts = partitioned_and_coded_rnds_and_seqs.read_counts[
+            partition_index]
         numerators = calc_lhd_numerators(
-            rnds_and_seq_ddgs, rnds_and_chem_affinities, ref_energy)
+            rnds_and_seq_ddgs, rnds_and_chem_affinities, ref_energy, 
+            rnds_and_read_cnts)
 
         # calcualte the denominators
         denominators = calc_lhd_denominators(
@@ -347,14 +602,150 @@ def calc_log_lhd_factory(partitioned_and_coded_rnds_and_seqs):
             partitioned_and_coded_rnds_and_seqs.n_bind_sites)
 
         lhd = 0.0
-        for rnd_num, rnd_denom, rnd_seq_ddgs in izip(
-                numerators, denominators, rnds_and_seq_ddgs):
-            lhd += rnd_num - len(rnd_seq_ddgs)*rnd_denom
+        for rnd_num, rnd_denom, rnd_read_cnts in izip(
+                numerators, denominators, rnds_and_read_cnts):
+            lhd += rnd_num - rnd_read_cnts.sum()*rnd_denom
 
         return lhd
     
     return calc_log_lhd        
 
+def calc_lhd_numerators_and_grads_factory(partitioned_and_coded_rnds_and_seqs):
+    """Build a function to calculate the lhd numerators of a partition.
+
+    The returned function calculates the numerator of each round, the 
+    gradient of their sum with respect to the (ref_energy, ddg_array) 
+    parameter vector, the gradient of their sum with respect to each round's
+    chemical affinity, and the number of reads in each round.
+    """
+    motif_len = partitioned_and_coded_rnds_and_seqs.motif_len
+    calc_energy_fns = []
+    for rnds_and_coded_seqs in partitioned_and_coded_rnds_and_seqs:
+        calc_energy_fns.append([])
+        for x in rnds_and_coded_seqs:
+            calc_energy_fns[-1].append(build_energy_fn(x, motif_len))
+    
+    def calc_lhd_numerators_and_grads(
+            ref_energy, ddg_array, chem_affinities, partition_index):
+        ref_energy = np.array(ref_energy).astype('float32')
+        chem_affinities = chem_affinities.astype('float32')
+        rnds_and_read_cnts = partitioned_and_coded_rnds_and_seqs.read_counts[
+            partition_index]
+        rnds_and_coded_seqs = partitioned_and_coded_rnds_and_seqs[
+            partition_index]
+        rnds_and_seq_ddgs = []
+        grad = np.zeros(len(ddg_array)+1, dtype=float)
+        chem_affinity_grads = np.zeros(len(chem_affinities), dtype=float)
+        for sequencing_rnd, calc_energy in enumerate(
+                calc_energy_fns[partition_index]):
+            seq_ddgs, bs_indices = calc_energy(ddg_array)
+            rnds_and_seq_ddgs.append(seq_ddgs)
+            read_cnts = rnds_and_read_cnts[sequencing_rnd]
+            # the derivative of the numerator with respect to each read's 
+            # energy, and each chemical affinity
+            energy_grads = np.zeros(len(seq_ddgs), dtype=float)
+            for rnd in xrange(sequencing_rnd+1):
+                occ_grads = read_cnts*expit(
+                    (ref_energy + seq_ddgs - chem_affinities[rnd])/(R*T))/(R*T)
+                energy_grads -= occ_grads
+                chem_affinity_grads[rnd] += occ_grads.sum()
+            # the energy of each read is the energy of its best binding site,
+            # so propogate the gradient through the coding of that site
+            grad[0] += energy_grads.sum()
+            grad[1:] += calc_bs_coding_grad(
+                rnds_and_coded_seqs[sequencing_rnd], motif_len, 
+                bs_indices, energy_grads)
+        
+        numerators = calc_lhd_numerators(
+            rnds_and_seq_ddgs, chem_affinities, ref_energy, rnds_and_read_cnts)
+        rnds_n_reads = np.array([cnts.sum() for cnts in rnds_and_read_cnts])
+        return ( np.array(numerators), grad, chem_affinity_grads, rnds_n_reads )
+    
+    return calc_lhd_numerators_and_grads
+
+def calc_log_lhd_and_grad_factory(partitioned_and_coded_rnds_and_seqs):
+    """Build a function to calculate the log lhd of a partition, and its gradient.
+
+    The gradient is with respect to the parameter vector 
+    (ref_energy, ddg_array...) and accounts for the dependence of the 
+    chemical potentials on the energy model through implicit differentiation.
+    """
+    calc_lhd_numerators_and_grads = calc_lhd_numerators_and_grads_factory(
+        partitioned_and_coded_rnds_and_seqs)
+    seq_len = partitioned_and_coded_rnds_and_seqs.seq_length
+    n_bind_sites = partitioned_and_coded_rnds_and_seqs.n_bind_sites
+    n_rnds = len(partitioned_and_coded_rnds_and_seqs[0])
+
+    def calc_log_lhd_and_grad(ref_energy, ddg_array, dna_conc, prot_conc,
+                              partition_index, init_chem_pots=None):
+        energies, partition_fn, energy_grads = est_partition_fn_w_grad(
+            ref_energy, ddg_array, n_bind_sites, seq_len)
+        chem_pots, chem_pot_grads = est_chem_potentials_w_grad(
+            energies, partition_fn, energy_grads, 
+            dna_conc, prot_conc, n_rnds, init_chem_pots)
+        ( numerators, numerators_grad, numerators_chem_pot_grads, rnds_n_reads
+            ) = calc_lhd_numerators_and_grads(
+                ref_energy, ddg_array, chem_pots, partition_index)
+        denominators, denominator_grads = calc_lhd_denominators_w_grad(
+            energies, partition_fn, energy_grads, 
+            chem_pots, chem_pot_grads, seq_len)
+
+        lhd = numerators.sum() - rnds_n_reads.dot(denominators)
+        grad = ( numerators_grad 
+                 + numerators_chem_pot_grads.dot(chem_pot_grads) 
+                 - rnds_n_reads.dot(denominator_grads) )
+        return lhd, grad, chem_pots
+    
+    return calc_log_lhd_and_grad
+
+# the lhd function used by the worker processes. This is set immediately 
+# before the workers are forked, so the workers share the coded sequences with
+# the parent process rather than receiving them through a pipe
+_worker_calc_log_lhd_and_grad = None
+def _calc_log_lhd_and_grad_worker(args):
+    return _worker_calc_log_lhd_and_grad(*args)
+
+class ParallelLogLhdEvaluator(object):
+    """Calculate the summed log lhd, and gradient, of several partitions.
+
+    The partitions are evaluated concurrently by a pool of n_threads worker 
+    processes. The workers are forked when the evaluator is created, so the
+    coded partitions are shared (copy on write) with the parent process and 
+    only the parameters and results are pickled.
+    """
+    def __init__(self, partitioned_and_coded_rnds_and_seqs, 
+                 dna_conc, prot_conc, n_threads):
+        global _worker_calc_log_lhd_and_grad
+        self.dna_conc = dna_conc
+        self.prot_conc = prot_conc
+        self.calc_log_lhd_and_grad = calc_log_lhd_and_grad_factory(
+            partitioned_and_coded_rnds_and_seqs)
+        self.pool = None
+        if n_threads > 1:
+            _worker_calc_log_lhd_and_grad = self.calc_log_lhd_and_grad
+            self.pool = multiprocessing.Pool(n_threads)
+    
+    def __call__(self, ref_energy, ddg_array, partition_indices, 
+                 init_chem_pots=None):
+        args = [ (ref_energy, ddg_array, self.dna_conc, self.prot_conc, 
+                  partition_index, init_chem_pots)
+                 for partition_index in partition_indices ]
+        if self.pool is None:
+            res = [ self.calc_log_lhd_and_grad(*x) for x in args ]
+        else:
+            res = self.pool.map(_calc_log_lhd_and_grad_worker, args)
+        lhd = sum(x[0] for x in res)
+        grad = sum(x[1] for x in res)
+        # the chemical potentials don't depend on the partition
+        chem_pots = res[0][2]
+        return lhd, grad, chem_pots
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
 def estimate_chem_pots_w_lhd(rnds_and_seqs, ddg_array, 
                              dna_conc, prot_conc,
                              ref_energy, ftol=1e-12):
@@ -376,89 +767,316 @@ def estimate_chem_pots_w_lhd(rnds_and_seqs, ddg_array,
                    options={'disp': False, 'maxiter': 50000} )
     return res.x, -f([res.x,])
 
+def solve_chem_potentials(energy_grids, partition_fns, 
+                          dna_conc, prot_conc, 
+                          init_chem_pots=None, xtol=1e-6, max_iter=200):
+    """Solve for the chemical affinities of a batch of partition functions.
+
+    energy_grids and partition_fns are (n_problems, n_bins) arrays (pad with 
+    zero probability bins). For each problem we find the root of 
+    
+    f(u) = [TF]_0 - exp{u} - [DNA]_0*\sum{i}{ p_i/(1+exp(E_i - u)) }
+
+    f is decreasing in u, so we run Newton's method on all of the problems
+    at once, falling back to bisection whenever a Newton step leaves the 
+    current bracket. init_chem_pots, if set, is used as the starting point 
+    (e.g. the chemical affinities from the previous optimization step).
+    """
+    n_problems = energy_grids.shape[0]
+    dna_conc = np.resize(np.asarray(dna_conc, dtype=float), n_problems)
+    prot_conc = np.resize(np.asarray(prot_conc, dtype=float), n_problems)
+    # f(min_u) > 0, and f(log([TF]_0)) < 0
+    min_u = np.zeros(n_problems) - 1000
+    max_u = np.log(prot_conc)
+    if init_chem_pots is None:
+        chem_pots = max_u.copy()
+    else:
+        chem_pots = np.array(init_chem_pots, dtype=float).clip(min_u, max_u)
+    converged = np.zeros(n_problems, dtype=bool)
+    for i in xrange(max_iter):
+        bnd_fracs = expit(chem_pots[:,None] - energy_grids)
+        free_prot = np.exp(chem_pots)
+        f = prot_conc - free_prot - dna_conc*(
+            partition_fns*bnd_fracs).sum(1)
+        df = -free_prot - dna_conc*(
+            partition_fns*bnd_fracs*(1-bnd_fracs)).sum(1)
+        # tighten the brackets
+        min_u = np.where(f > 0, chem_pots, min_u)
+        max_u = np.where(f > 0, max_u, chem_pots)
+        new_chem_pots = chem_pots - f/df
+        use_bisection = ~( (new_chem_pots >= min_u) & (new_chem_pots <= max_u) )
+        new_chem_pots[use_bisection] = (
+            min_u[use_bisection] + max_u[use_bisection])/2
+        # stop updating the problems that have converged
+        new_chem_pots[converged] = chem_pots[converged]
+        converged |= ( (np.abs(new_chem_pots - chem_pots) < xtol) 
+                       | (max_u - min_u < xtol) )
+        chem_pots = new_chem_pots
+        if converged.all(): 
+            break
+    return chem_pots
+
 def est_chem_potential(
         energy_grid, partition_fn, 
-        dna_conc, prot_conc ):
+        dna_conc, prot_conc, init_chem_pot=None ):
     """Estimate chemical affinity for round 1.
     
     [TF] - [TF]_0 - \sum{all seq}{ [s_i]_0[TF](1/{[TF]+exp(delta_g)}) = 0  
     exp{u} - [TF]_0 - \sum{i}{ 1/(1+exp(G_i)exp(-)
     """
-    def f(u):
-        sum_terms = dna_conc*partition_fn/(1+np.exp(energy_grid-u))
-        return prot_conc - math.exp(u) - sum_terms.sum()
-    min_u = -1000
-    max_u = 100 + math.log(prot_conc)
-    rv = brentq(f, min_u, max_u, xtol=1e-4)
-    return rv
+    return solve_chem_potentials(
+        np.asarray(energy_grid)[None,:], np.asarray(partition_fn)[None,:], 
+        dna_conc, prot_conc, 
+        None if init_chem_pot is None else [init_chem_pot,])[0]
+
+def est_chem_potentials_batch(energy_grids, partition_fns, 
+                              dna_conc, prot_conc, num_rnds, 
+                              init_chem_pots=None):
+    """Estimate the chemical affinities of every round for many models.
+
+    energy_grids and partition_fns are lists, with one entry for each model
+    (e.g. each candidate parameter vector). Each round depends on the 
+    previous round's chemical affinity, so the rounds are solved in turn 
+    but all of the models are solved together. Returns a 
+    (n_models, num_rnds) array.
+    """
+    n_bins = max(len(energy_grid) for energy_grid in energy_grids)
+    padded_energy_grids = np.zeros((len(energy_grids), n_bins))
+    padded_partition_fns = np.zeros((len(energy_grids), n_bins))
+    for i, (energy_grid, partition_fn) in enumerate(
+            izip(energy_grids, partition_fns)):
+        padded_energy_grids[i,:len(energy_grid)] = energy_grid
+        padded_partition_fns[i,:len(partition_fn)] = partition_fn
+    if init_chem_pots is not None:
+        init_chem_pots = np.asarray(init_chem_pots, dtype=float).reshape(
+            (len(energy_grids), num_rnds))
+
+    chem_pots = np.zeros((len(energy_grids), num_rnds))
+    for rnd in xrange(num_rnds):
+        chem_pots[:,rnd] = solve_chem_potentials(
+            padded_energy_grids, padded_partition_fns, 
+            dna_conc, prot_conc, 
+            None if init_chem_pots is None else init_chem_pots[:,rnd])
+        padded_partition_fns = padded_partition_fns*logistic(
+            (chem_pots[:,rnd,None] - padded_energy_grids)/(R*T))
+        padded_partition_fns /= padded_partition_fns.sum(1)[:,None]
+    return np.array(chem_pots, dtype='float32')
 
 def est_chem_potentials(ddg_array, ref_energy, dna_conc, prot_conc,
-                        n_bind_sites, seq_len, num_rnds):
+                        n_bind_sites, seq_len, num_rnds, 
+                        init_chem_pots=None):
     energy_grid, partition_fn = est_partition_fn(
         ref_energy, ddg_array, n_bind_sites, seq_len)
+    return est_chem_potentials_batch(
+        [energy_grid,], [partition_fn,], dna_conc, prot_conc, num_rnds, 
+        init_chem_pots)[0]
+
+def est_chem_potentials_w_grad(energy_grid, partition_fn, energy_grads,
+                               dna_conc, prot_conc, num_rnds, 
+                               init_chem_pots=None):
+    """Estimate the chemical potentials, and their gradients.
+
+    energy_grads contains the derivatives of each energy in energy_grid with 
+    respect to the model parameters (see est_partition_fn_sampling_w_grad). 
+    The gradients of the chemical potentials are found by implicitly 
+    differentiating the equilibrium equation solved in est_chem_potential, 
+    propogating the dependence of each round's partition function on the 
+    previous rounds' chemical potentials. Returns the chemical potentials, 
+    and a (num_rnds, n_params) array of their gradients.
+    init_chem_pots, if set, is used to warm start the solver.
+    """
     chem_pots = []
+    chem_pot_grads = []
+    partition_fn = partition_fn.copy()
+    # the gradient of the partition function with respect to the parameters
+    partition_fn_grads = np.zeros(energy_grads.shape, dtype=float)
     for rnd in xrange(num_rnds):
         chem_pot = est_chem_potential(
             energy_grid, partition_fn,
-            dna_conc, prot_conc )
+            dna_conc, prot_conc, 
+            None if init_chem_pots is None else init_chem_pots[rnd] )
+        # differentiate 
+        # f(u) = prot_conc - exp(u) - dna_conc*\sum{i}{ p_i*s_i } = 0
+        # where s_i = 1/(1+exp(E_i - u))
+        bnd_fracs = expit(chem_pot - energy_grid)
+        d_bnd_fracs = bnd_fracs*(1-bnd_fracs)
+        df_du = -math.exp(chem_pot) - dna_conc*(partition_fn*d_bnd_fracs).sum()
+        df_dtheta = -dna_conc*(
+            bnd_fracs.dot(partition_fn_grads) 
+            - (partition_fn*d_bnd_fracs).dot(energy_grads) )
+        chem_pot_grad = -df_dtheta/df_du
         chem_pots.append(chem_pot)
-        partition_fn *= logistic(-(-chem_pot+energy_grid)/(R*T))
-        partition_fn = partition_fn/partition_fn.sum()
-    return np.array(chem_pots, dtype='float32')
+        chem_pot_grads.append(chem_pot_grad)
+
+        # update the partition function, and its gradient
+        occs = expit((chem_pot-energy_grid)/(R*T))
+        occ_grads = (occs*(1-occs)/(R*T))[:,None]*(
+            chem_pot_grad[None,:] - energy_grads)
+        new_partition_fn = partition_fn*occs
+        new_partition_fn_grads = ( 
+            partition_fn_grads*occs[:,None] + partition_fn[:,None]*occ_grads )
+        norm = new_partition_fn.sum()
+        partition_fn = new_partition_fn/norm
+        partition_fn_grads = ( new_partition_fn_grads/norm 
+                               - partition_fn[:,None]*(
+                                   new_partition_fn_grads.sum(0)/norm)[None,:] )
+    return np.array(chem_pots, dtype='float32'), np.array(chem_pot_grads)
+
+def code_kmers(coded_reads, k):
+    """Code every k-mer in a matrix of coded reads as an integer.
+
+    Each base takes 2 bits, so k-mer i of read j is coded by rolling the 
+    bases into the low bits of an int64. Returns the forward and reverse 
+    complement codes, each with shape (n_seqs, read_len-k+1). 
+    """
+    assert k <= 31
+    coded_reads = coded_reads.astype('int64')
+    n_offsets = coded_reads.shape[1] - k + 1
+    rc_reads = 3 - coded_reads[:,::-1]
+    fwd_codes = np.zeros((len(coded_reads), n_offsets), dtype='int64')
+    rc_codes = np.zeros((len(coded_reads), n_offsets), dtype='int64')
+    for i in xrange(k):
+        fwd_codes = (fwd_codes << 2) | coded_reads[:,i:i+n_offsets]
+        rc_codes = (rc_codes << 2) | rc_reads[:,i:i+n_offsets]
+    # the reverse complement of the k-mer at offset i is the k-mer at offset 
+    # n_offsets-i-1 of the reversed read
+    return fwd_codes, rc_codes[:,::-1]
+
+def decode_kmer(code, k):
+    return "".join('ACGT'[(code >> 2*(k-i-1)) & 3] for i in xrange(k))
+
+def count_kmers(seqs, k, chunk_size=100000):
+    """Count the k-mers on both strands of seqs.
+
+    A k-mer and its reverse complement have the same count, so we only 
+    count the canonical (smallest code) k-mer; palindromes are counted twice,
+    once for each strand. k-mers with k <= 12 are counted with a bincount, 
+    and longer k-mers with a sort. Returns the canonical k-mer codes that 
+    were observed, and their counts.
+    """
+    coded_reads = code_reads(seqs)
+    kmers = np.zeros(0, dtype='int64')
+    cnts = np.zeros(0, dtype='int64')
+    for i in xrange(0, len(coded_reads), chunk_size):
+        fwd_codes, rc_codes = code_kmers(coded_reads[i:i+chunk_size], k)
+        canonical_codes = np.minimum(fwd_codes, rc_codes).ravel()
+        palindromes = canonical_codes[(fwd_codes == rc_codes).ravel()]
+        if k <= 12:
+            cnts = ( np.bincount(canonical_codes, minlength=4**k)
+                     + np.bincount(palindromes, minlength=4**k) 
+                     + (cnts if len(cnts) > 0 else 0) )
+        else:
+            chunk_kmers, chunk_cnts = np.unique(
+                np.concatenate((canonical_codes, palindromes)), 
+                return_counts=True)
+            kmers, inverse = np.unique(
+                np.concatenate((kmers, chunk_kmers)), return_inverse=True)
+            cnts = np.bincount(
+                inverse, weights=np.concatenate((cnts, chunk_cnts))
+            ).astype('int64')
+    if k <= 12:
+        kmers = np.nonzero(cnts)[0]
+        cnts = cnts[kmers]
+    return kmers, cnts
+
+KmerCandidate = namedtuple('KmerCandidate', ['kmer', 'count', 'enrichment'])
+
+def find_consensus_candidates(rnds_and_seqs, k, n_candidates=10):
+    """Find the most common k-mers in each round.
+
+    Returns a list (one entry per round) of the n_candidates most common 
+    k-mers, along with their counts and their enrichment (the ratio of 
+    their frequency to their frequency in the previous round, with a 
+    pseudo count of 1). The enrichment of the first round is None.
+    """
+    rnds_candidates = []
+    prev_kmers, prev_freqs = None, None
+    for seqs in rnds_and_seqs:
+        kmers, cnts = count_kmers(seqs, k)
+        freqs = (cnts + 1.0)/cnts.sum()
+        top_indices = np.argsort(-cnts, kind='mergesort')[:n_candidates]
+        candidates = []
+        for index in top_indices:
+            enrichment = None
+            if prev_kmers is not None:
+                prev_index = np.searchsorted(prev_kmers, kmers[index])
+                if ( prev_index < len(prev_kmers) 
+                     and prev_kmers[prev_index] == kmers[index] ):
+                    prev_freq = prev_freqs[prev_index]
+                else:
+                    prev_freq = 1.0/prev_total_cnt
+                enrichment = freqs[index]/prev_freq
+            candidates.append(KmerCandidate(
+                decode_kmer(kmers[index], k), cnts[index], enrichment))
+        rnds_candidates.append(candidates)
+        prev_kmers, prev_freqs, prev_total_cnt = kmers, freqs, cnts.sum()
+    return rnds_candidates
 
 def find_consensus_bind_site(seqs, bs_len):
     # produce and initial alignment from the last round
-    mers = defaultdict(int)
-    for seq in seqs:
-        for bs in enumerate_binding_sites(seq, bs_len):
-            mers[bs] += 1
-    max_cnt = max(mers.values())
-    consensus = next(mer for mer, cnt in mers.items() 
-                     if cnt == max_cnt)
-    return consensus
-
-def find_pwm_from_starting_alignment(seqs, counts):
-    assert counts.shape[0] == 4
-    bs_len = counts.shape[1]
+    kmers, cnts = count_kmers(seqs, bs_len)
+    return decode_kmer(kmers[cnts.argmax()], bs_len)
+
+def find_pwms_from_starting_alignments(seqs, all_counts, chunk_size=10000):
+    """Find PWMs by hard EM, starting from each set of base counts.
+
+    all_counts is a list of (4, bs_len) count matrices, which must all have 
+    the same length. The alignments are run together so that each pass 
+    through the reads updates every model. Initially every binding site is 
+    weighted equally; then each read is assigned to its highest scoring 
+    binding site until the (rounded) counts stop changing. Returns a 
+    (bs_len, 4) PWM for each starting alignment. 
+    """
+    bs_len = all_counts[0].shape[1]
+    assert all(counts.shape == (4, bs_len) for counts in all_counts)
+    coded_reads = code_reads(seqs)
+    base_indices = np.arange(bs_len)
+    
+    def iter_binding_sites():
+        for i in xrange(0, len(coded_reads), chunk_size):
+            yield enumerate_coded_binding_sites(
+                coded_reads[i:i+chunk_size], bs_len)
+
+    def sum_base_counts(binding_sites, weight=1.0):
+        return weight*np.bincount(
+            (binding_sites.reshape((-1, bs_len))*bs_len + base_indices).ravel(),
+            minlength=4*bs_len).reshape((4, bs_len))
     
-    # code the sequences
-    all_binding_sites = []
-    all_weights = []
-    for seq in seqs:
-        binding_sites = list(enumerate_binding_sites(seq, bs_len))
-        all_binding_sites.append( binding_sites )
-        weights = np.array([1.0/len(binding_sites)]*len(binding_sites))
-        all_weights.append(weights)
-
-    # iterate over the alignments
-    prev_counts = counts.copy()
+    # weight every binding site in each read equally 
+    n_bind_sites = 2*(coded_reads.shape[1] - bs_len + 1)
+    uniform_counts = sum(sum_base_counts(binding_sites, 1.0/n_bind_sites)
+                         for binding_sites in iter_binding_sites())
+    prev_counts = [counts.copy() for counts in all_counts]
+    all_counts = [counts + uniform_counts for counts in all_counts]
+    converged = [False]*len(all_counts)
     for i in xrange(50):
-        # upadte the counts
-        for bss, weights in izip(all_binding_sites, all_weights):
-            for bs, weight in izip(bss, weights):
-                for j, base in enumerate(bs):
-                    counts[base_map(base),j] += weight
-
-        # update the weights
-        for bss, weights in izip(all_binding_sites, all_weights):
-            max_score = 0
-            max_pos = None
-            for j, bs in enumerate(bss):
-                score = sum(
-                    counts[base_map(base), k] for k, base in enumerate(bs))
-                if score > max_score:
-                    max_score = score
-                    max_pos = j
-                weights[:] = 0
-                weights[max_pos] = 1
-            weights /= weights.sum()
-        if (counts.round() - prev_counts.round() ).sum() == 0: 
+        for j, (counts, prev) in enumerate(izip(all_counts, prev_counts)):
+            converged[j] = ( 
+                np.abs(counts.round() - prev.round()).sum() == 0 )
+        if all(converged):
             break
-        else: 
-            prev_counts = counts.copy()
-            counts[:,:] = 0
+        # assign each read to its highest scoring binding site, and count the
+        # bases in the assigned binding sites
+        new_counts = [np.zeros((4, bs_len)) for counts in all_counts]
+        for binding_sites in iter_binding_sites():
+            for j, counts in enumerate(all_counts):
+                if converged[j]: continue
+                scores = np.zeros(binding_sites.shape[:2])
+                for k in xrange(bs_len):
+                    scores += counts[binding_sites[:,:,k], k]
+                best_sites = binding_sites[
+                    np.arange(len(binding_sites)), scores.argmax(1)]
+                new_counts[j] += sum_base_counts(best_sites)
+        for j in xrange(len(all_counts)):
+            if converged[j]: continue
+            prev_counts[j] = all_counts[j]
+            all_counts[j] = new_counts[j]
+    
+    return [(counts/counts.sum(0)).T for counts in all_counts]
 
-    return (counts/counts.sum(0)).T
+def find_pwm_from_starting_alignment(seqs, counts):
+    assert counts.shape[0] == 4
+    return find_pwms_from_starting_alignments(seqs, [counts,])[0]
 
 def find_pwm(rnds_and_seqs, bs_len):
     consensus = find_consensus_bind_site(rnds_and_seqs[-1], bs_len)
@@ -472,20 +1090,29 @@ def find_pwm(rnds_and_seqs, bs_len):
     return pwm
 
 def build_random_read_energies_pool(pool_size, read_len, ddg_array, ref_energy, 
-                                    store_seqs=False):
-    seqs = []
+                                    store_seqs=False, 
+                                    chunk_size=RANDOM_POOL_CHUNK_SIZE):
+    """Simulate random reads, and find the energy of their best binding sites.
+
+    The reads are simulated and scored chunk_size reads at a time. Returns 
+    the minimum binding site ddg of each read (ref_energy is not added) and,
+    if store_seqs is set, a (pool_size, read_len) uint8 matrix of the coded
+    reads (otherwise None).
+    """
+    motif_len = ddg_array.motif_len
     energies = np.zeros(pool_size, dtype='float32')
-    for i in xrange(pool_size):
-        if i%10000 == 0: 
-            pyTFbindtools.log("Bootstrapped %i reads." % i, level='VERBOSE')
-        seq = "".join(random.choice('ACGT') for j in xrange(read_len))
-        # np.random.randint(4, size=read_len)
-        if store_seqs: seqs.append(seq)
-        coded_seq = code_sequence(seq, ddg_array.motif_len)
-        energy = 1e100
-        for subseq in coded_seq:
-            energy = min(energy, ddg_array.dot(subseq))
-        energies[i] = energy
+    seqs = np.zeros((pool_size, read_len), dtype='uint8') if store_seqs else None
+    for start in xrange(0, pool_size, chunk_size):
+        pyTFbindtools.log("Bootstrapped %i reads." % start, level='VERBOSE')
+        n_reads = min(chunk_size, pool_size-start)
+        coded_reads = np.random.randint(
+            4, size=(n_reads, read_len)).astype('uint8')
+        if store_seqs: seqs[start:start+n_reads] = coded_reads
+        # the shape features can't be scored from the reads directly
+        coded_seqs = (
+            code_seqs(coded_reads, motif_len) if USE_SHAPE else coded_reads)
+        energies[start:start+n_reads] = build_energy_fn(
+            coded_seqs, motif_len)(ddg_array)[0]
     return energies, seqs
 
 def bootstrap_lhd_numerators(initial_energy_pool, sim_sizes, 
@@ -514,8 +1141,8 @@ def bootstrap_lhd_numerators(initial_energy_pool, sim_sizes,
         numerator = 0
         for inner_rnd in xrange(rnd+1):
             numerator += calc_rnd_lhd_num(
-                chem_pots[inner_rnd].astype('float32'), 
-                ref_energy.astype('float32'), 
+                np.float32(chem_pots[inner_rnd]), 
+                np.float32(ref_energy), 
                 selected_energies)
         numerators.append(numerator)
 
@@ -552,7 +1179,7 @@ def bootstrap_lhds(read_len,
     # energy model and chemical affinities, so we only need to do this once
     # for all of the simulated samples
     denominators = calc_lhd_denominators(
-        ref_energy, ddg_array, chem_pots, n_bind_sites)
+        ref_energy, ddg_array, chem_pots, read_len, n_bind_sites)
     normalizing_constant = sum(cnt*denom for cnt, denom 
                                in izip(sim_sizes, denominators))
 
@@ -576,56 +1203,154 @@ class PartitionedAndCodedSeqs(list):
     def partition_data(seqs):
         assert len(seqs) > 150
         n_partitions = max(5, len(seqs)/10000)
-        partitioned_seqs = [[] for i in xrange(n_partitions)]
-        for i, seq in enumerate(seqs):
-            partitioned_seqs[i%n_partitions].append(seq)
-        return partitioned_seqs
+        # sequence i goes into partition i%n_partitions
+        return [seqs[i::n_partitions] for i in xrange(n_partitions)]
 
     def __init__(self, rnds_and_seqs, bs_len):
-        self.seq_length = len(rnds_and_seqs[0][0])
-        self.extend(zip(*[
-            [ code_seqs(rnd_seqs, bs_len)
-              for rnd_seqs in self.partition_data(seqs)]
-            for seqs in rnds_and_seqs]))
-        self.n_bind_sites = self[0][0].get_value().shape[1]
+        # code each round once (this is a no-op for already coded reads)
+        rnds_and_coded_reads = [code_reads(seqs) for seqs in rnds_and_seqs]
+        self.seq_length = rnds_and_coded_reads[0].shape[1]
+        # partition each round, and then collapse the duplicate reads within
+        # each partition. self.partitioned_reads and self.read_counts are 
+        # indexed by [partition][rnd], like the coded sequences
+        self.partitioned_reads = []
+        self.read_counts = []
+        for rnds_reads in zip(*[self.partition_data(coded_reads)
+                                for coded_reads in rnds_and_coded_reads]):
+            unique_reads_and_cnts = [
+                count_unique_reads(reads) for reads in rnds_reads]
+            self.partitioned_reads.append(
+                [reads for reads, cnts in unique_reads_and_cnts])
+            self.read_counts.append(
+                [cnts.astype(get_backend().floatX) 
+                 for reads, cnts in unique_reads_and_cnts])
+        self._code_partitions(bs_len)
+
+    def _code_partitions(self, bs_len):
+        self.motif_len = bs_len
+        self.n_bind_sites = 2*(self.seq_length - bs_len + 1)
+        if USE_SHAPE:
+            # the shape parameters can't be looked up from the read bases by
+            # the energy kernels, so code all of the binding sites
+            self.extend(
+                [ code_seqs(rnd_reads, bs_len) for rnd_reads in rnds_reads ]
+                for rnds_reads in self.partitioned_reads)
+        else:
+            # the reads are scored directly (see build_energy_fn), so the 
+            # memory use is proportional to the size of the reads
+            self.extend(self.partitioned_reads)
+
+    def recode(self, bs_len):
+        """Code the reads for a new binding site length.
+
+        The partitioned and de-duplicated reads are shared with self, so 
+        the partitions (and the test partition) are the same.
+        """
+        rv = PartitionedAndCodedSeqs.__new__(PartitionedAndCodedSeqs)
+        rv.seq_length = self.seq_length
+        rv.partitioned_reads = self.partitioned_reads
+        rv.read_counts = self.read_counts
+        rv._code_partitions(bs_len)
+        return rv
+
+class AdaDeltaState(object):
+    """The running averages of the squared gradients and updates in AdaDelta.
+
+    Passing the same state to successive calls of 
+    estimate_dg_matrix_with_adadelta continues the optimization, rather 
+    than starting with fresh accumulators.
+    """
+    def __init__(self, n_params):
+        self.grad_sq = np.zeros(n_params)
+        self.delta_x_sq = np.zeros(n_params)
+
+    def insert_position(self, pos):
+        """Add (zeroed) accumulators for a new motif position.
+
+        The first parameter is the reference energy, followed by 3 
+        parameters for each motif position.
+        """
+        index = 1 + 3*pos
+        self.grad_sq = np.insert(self.grad_sq, index, np.zeros(3))
+        self.delta_x_sq = np.insert(self.delta_x_sq, index, np.zeros(3))
 
 def estimate_dg_matrix_with_adadelta(
         partitioned_and_coded_rnds_and_seqs,
         init_ddg_array, init_ref_energy,
         dna_conc, prot_conc,
-        ftol=1e-12):    
-    def calc_penalty(ref_energy, ddg_array, chem_pots):
+        ftol=1e-12,
+        adadelta_state=None,
+        free_params=None):
+    """Fit the energy model with AdaDelta.
+
+    adadelta_state, if set, is an AdaDeltaState that is used to initialize
+    the optimizer, and is updated in place. free_params, if set, is a boolean
+    mask over (ref_energy, ddg_array...) of the parameters to optimize; the 
+    other parameters are held fixed.
+    """
+    def calc_penalty_and_grad(ref_energy, ddg_array):
         penalty = 0
+        grad = np.zeros(len(ddg_array)+1, dtype=float)
         
         # Penalize models with non-physical mean affinities
         new_mean_energy = ref_energy + ddg_array.sum()/3
         if CONSTRAIN_MEAN_ENERGY:
             penalty += (new_mean_energy - EXPECTED_MEAN_ENERGY)**2
+            mean_energy_grad = 2*(new_mean_energy - EXPECTED_MEAN_ENERGY)
+            grad[0] += mean_energy_grad
+            grad[1:] += mean_energy_grad/3
 
         # Penalize non-physical differences in base affinities
         if CONSTRAIN_BASE_ENERGY_DIFF:
             base_conts = ddg_array.calc_base_contributions()
             energy_diff = base_conts.max(1) - base_conts.min(1)
             penalty += (energy_diff[(energy_diff > 6)]**2).sum()
+            # the first base is the reference, so it has no parameter
+            base_conts_grad = np.zeros(base_conts.shape, dtype=float)
+            for pos in np.nonzero(energy_diff > 6)[0]:
+                base_conts_grad[pos, base_conts[pos].argmax()] += (
+                    2*energy_diff[pos])
+                base_conts_grad[pos, base_conts[pos].argmin()] -= (
+                    2*energy_diff[pos])
+            grad[1:1+base_conts.size*3/4] += base_conts_grad[:,1:].ravel()
         #return 0
-        return penalty
+        return penalty, grad
 
-    def extract_data_from_array(x):
+    def extract_data_from_array(x, init_chem_pots=None):
         ref_energy = x[0]
         ddg_array = x[1:].astype('float32').view(DeltaDeltaGArray)
         chem_pots = est_chem_potentials(
             ddg_array, ref_energy, dna_conc, prot_conc,
             partitioned_and_coded_rnds_and_seqs.n_bind_sites, 
             partitioned_and_coded_rnds_and_seqs.seq_length, 
-            len(partitioned_and_coded_rnds_and_seqs[0]))
+            len(partitioned_and_coded_rnds_and_seqs[0]),
+            init_chem_pots)
         return ref_energy, chem_pots, ddg_array
     
-    def f_dg(x, train_index):
-        ref_energy, chem_pots, ddg_array = extract_data_from_array(x)
+    def f_dg(x, train_index, init_chem_pots=None):
+        ref_energy, chem_pots, ddg_array = extract_data_from_array(
+            x, init_chem_pots)
         rv = calc_log_lhd(ref_energy, ddg_array, chem_pots, train_index)
-        penalty = calc_penalty(ref_energy, ddg_array, chem_pots)
+        penalty, penalty_grad = calc_penalty_and_grad(ref_energy, ddg_array)
         return -rv + penalty
 
+    def f_dg_grad(x, train_index, init_chem_pots=None):
+        ref_energy = x[0]
+        ddg_array = x[1:].astype('float32').view(DeltaDeltaGArray)
+        if parallel_calc_log_lhd_and_grad is None:
+            lhd, lhd_grad, chem_pots = calc_log_lhd_and_grad(
+                ref_energy, ddg_array, dna_conc, prot_conc, train_index, 
+                init_chem_pots)
+        # if we have multiple processes, then use all of the training 
+        # partitions rather than a single random one 
+        else:
+            lhd, lhd_grad, chem_pots = parallel_calc_log_lhd_and_grad(
+                ref_energy, ddg_array, 
+                range(1, len(partitioned_and_coded_rnds_and_seqs)),
+                init_chem_pots)
+        penalty, penalty_grad = calc_penalty_and_grad(ref_energy, ddg_array)
+        return -lhd_grad + penalty_grad, chem_pots
+
     # ada delta
     test_lhds = []
     train_lhds = []
@@ -634,23 +1359,29 @@ def estimate_dg_matrix_with_adadelta(
         # from http://arxiv.org/pdf/1212.5701.pdf
         e = 1e-6
         p = 0.99
-        grad_sq = np.zeros(len(x0))
-        delta_x_sq = np.zeros(len(x0))
+        grad_sq = adadelta_state.grad_sq
+        delta_x_sq = adadelta_state.delta_x_sq
         
         eps = 1.0
         num_small_decreases = 0
+        # warm start the chemical potential solver from the previous step
+        chem_pots = None
         for i in xrange(MAX_NUM_ITER):
             train_index = random.randint(
                 1, len(partitioned_and_coded_rnds_and_seqs)-1)
-            grad = approx_fprime(x0, f_dg, 1e-3, train_index)
-            grad_sq = p*grad_sq + (1-p)*(grad**2)
+            grad, chem_pots = f_dg_grad(x0, train_index, chem_pots)
+            grad_sq = np.where(
+                free_params, p*grad_sq + (1-p)*(grad**2), grad_sq)
             delta_x = -np.sqrt(delta_x_sq + e)/np.sqrt(
                 grad_sq + e)*grad
-            delta_x_sq = p*delta_x_sq + (1-p)*(delta_x**2)
+            delta_x[~free_params] = 0
+            delta_x_sq = np.where(
+                free_params, p*delta_x_sq + (1-p)*(delta_x**2), delta_x_sq)
             x0 += delta_x.clip(-2, 2) #grad #delta
-            train_lhd = -f_dg(x0, train_index)
-            test_lhd = -f_dg(x0, 0)
-            ref_energy, chem_pots, ddg_array = extract_data_from_array(x0)
+            ref_energy, chem_pots, ddg_array = extract_data_from_array(
+                x0, chem_pots)
+            train_lhd = -f_dg(x0, train_index, chem_pots)
+            test_lhd = -f_dg(x0, 0, chem_pots)
 
             debug_output = []
             debug_output.append(str(ddg_array.consensus_seq()))
@@ -676,17 +1407,34 @@ def estimate_dg_matrix_with_adadelta(
                     > sum(test_lhds[-min_num_iter:])/min_num_iter ):
                 break
 
+        adadelta_state.grad_sq = grad_sq
+        adadelta_state.delta_x_sq = delta_x_sq
         x_hat_index = np.argmax(np.array(test_lhds))
         return xs[x_hat_index]
     
     bs_len = init_ddg_array.motif_len    
     calc_log_lhd = calc_log_lhd_factory(partitioned_and_coded_rnds_and_seqs)
+    calc_log_lhd_and_grad = calc_log_lhd_and_grad_factory(
+        partitioned_and_coded_rnds_and_seqs)
+    parallel_calc_log_lhd_and_grad = None
+    if NTHREADS > 1:
+        parallel_calc_log_lhd_and_grad = ParallelLogLhdEvaluator(
+            partitioned_and_coded_rnds_and_seqs, dna_conc, prot_conc, 
+            NTHREADS)
 
     x0 = init_ddg_array.copy().astype('float32')
     if USE_SHAPE:
         x0 = np.append(x0, np.zeros(6*(len(x0)/3)))
     x0 = np.insert(x0, 0, init_ref_energy)
-    x = ada_delta(x0)
+    if adadelta_state is None:
+        adadelta_state = AdaDeltaState(len(x0))
+    if free_params is None:
+        free_params = np.ones(len(x0), dtype=bool)
+    try:
+        x = ada_delta(x0)
+    finally:
+        if parallel_calc_log_lhd_and_grad is not None:
+            parallel_calc_log_lhd_and_grad.close()
 
     ref_energy, chem_pots, ddg_array = extract_data_from_array(x)
     test_lhd = calc_log_lhd(ref_energy, ddg_array, chem_pots, 0)
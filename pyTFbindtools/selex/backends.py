@@ -0,0 +1,353 @@
+"""Compute backends for the SELEX likelihood kernels.
+
+A backend stores the coded binding sites, and implements the kernels that
+dominate the likelihood calculation:
+
+- the minimum binding site energy of every read (the energy matmul-min)
+- the (weighted) sum of the log occupancies of a round
+- the binned energy distribution of a random binding site (which the
+  partition function is built from)
+
+NumpyBackend is the reference implementation, NumbaBackend JIT compiles
+fused versions of the kernels, and TheanoBackend compiles theano functions
+(which is only worthwhile on a GPU). The backend is chosen at runtime with
+set_backend; 'auto' (the default) uses numba if it's installed.
+"""
+import os
+import hashlib
+import inspect
+import marshal
+
+import numpy as np
+
+import pyTFbindtools
+from ..motif_tools import R, T
+
+BACKEND_NAMES = ('auto', 'numpy', 'numba', 'theano')
+
+# the number of reads to score at once in NumpyBackend.build_read_energy_fn
+READ_ENERGY_CHUNK_SIZE = 100000
+
+def build_energy_luts(ddg_array, motif_len, dtype):
+    """Build the energy lookup tables of the forward and reverse complement
+    binding sites.
+
+    Returns two (motif_len, 4) arrays: the energy of each base at each
+    position of the binding site (A is the reference base, so it's zero), and
+    the same table for the reverse complement of the binding site, so that 
+    the reverse complement energy of a site is the lookup of its forward
+    bases.
+    """
+    fwd_lut = np.zeros((motif_len, 4), dtype=dtype)
+    fwd_lut[:,1:] = np.asarray(ddg_array).reshape((motif_len, 3))
+    rc_lut = np.ascontiguousarray(fwd_lut[::-1,::-1])
+    return fwd_lut, rc_lut
+
+class SharedArray(object):
+    """Hold an array with the same interface as a theano shared variable.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get_value(self, borrow=False):
+        if borrow:
+            return self.value
+        return self.value.copy()
+
+class NumpyBackend(object):
+    name = 'numpy'
+    floatX = 'float32'
+
+    def shared(self, array):
+        return SharedArray(array)
+
+    def build_energy_fn(self, coded_seqs):
+        """Build a function to find each read's best binding site.
+
+        coded_seqs is a (shared) (n_seqs, n_bind_sites, n_features) array.
+        The returned function takes a ddg array, and returns the minimum
+        binding site energy of each read and the index of that binding site.
+        """
+        coded_seqs = coded_seqs.get_value(borrow=True)
+        def calc_min_energies(ddg_array):
+            bs_energies = coded_seqs.dot(np.asarray(ddg_array))
+            bs_indices = bs_energies.argmin(1)
+            return ( bs_energies[np.arange(len(bs_energies)), bs_indices],
+                     bs_indices )
+        return calc_min_energies
+
+    def build_read_energy_fn(self, coded_reads, motif_len):
+        """Build a function to find each read's best binding site.
+
+        This is the same as build_energy_fn, but scores the (n_seqs, 
+        read_len) uint8 coded reads directly with an energy lookup table, so
+        the binding sites are never coded. The binding site indices are in 
+        the order of code_binding_sites (the forward and reverse complement
+        sites are interleaved).
+        """
+        coded_reads = np.ascontiguousarray(coded_reads)
+        n_seqs, read_len = coded_reads.shape
+        n_offsets = read_len - motif_len + 1
+        floatX = self.floatX
+        def calc_min_energies(ddg_array):
+            fwd_lut, rc_lut = build_energy_luts(ddg_array, motif_len, floatX)
+            min_energies = np.empty(n_seqs, dtype=floatX)
+            bs_indices = np.empty(n_seqs, dtype='int64')
+            # score the reads in chunks, so that the energy of every binding 
+            # site is only stored for one chunk at a time
+            for start in xrange(0, n_seqs, READ_ENERGY_CHUNK_SIZE):
+                reads = coded_reads[start:start+READ_ENERGY_CHUNK_SIZE]
+                bs_energies = np.zeros((len(reads), n_offsets, 2), dtype=floatX)
+                for pos in xrange(motif_len):
+                    bases = reads[:,pos:pos+n_offsets]
+                    bs_energies[:,:,0] += fwd_lut[pos][bases]
+                    bs_energies[:,:,1] += rc_lut[pos][bases]
+                bs_energies = bs_energies.reshape((len(reads), 2*n_offsets))
+                chunk_indices = bs_energies.argmin(1)
+                min_energies[start:start+len(reads)] = bs_energies[
+                    np.arange(len(reads)), chunk_indices]
+                bs_indices[start:start+len(reads)] = chunk_indices
+            return min_energies, bs_indices
+        return calc_min_energies
+
+    def calc_read_coding_grad(self, coded_reads, motif_len, bs_indices, weights):
+        """Calculate the weighted sum of the codings of the binding sites
+        bs_indices (see build_read_energy_fn) of each read.
+
+        This is the gradient of the weighted read energies with respect to 
+        the ddg array.
+        """
+        coded_reads = np.asarray(coded_reads)
+        offsets = bs_indices//2
+        is_rc = (bs_indices%2 == 1)
+        positions = np.arange(motif_len)
+        # the forward sites start at offset, and the reverse complement
+        # sites are read backwards from offset+motif_len-1
+        read_positions = np.where(
+            is_rc[:,None], 
+            (offsets + motif_len - 1)[:,None] - positions[None,:],
+            offsets[:,None] + positions[None,:])
+        bases = coded_reads[np.arange(len(coded_reads))[:,None], read_positions]
+        bases = np.where(is_rc[:,None], 3 - bases, bases)
+        base_weights = np.bincount(
+            (4*positions[None,:] + bases).ravel(), 
+            weights=np.repeat(weights, motif_len), 
+            minlength=4*motif_len).reshape((motif_len, 4))
+        return base_weights[:,1:].ravel()
+
+    def calc_log_occ_sum(self, chem_pot, ref_energy, ddgs, weights=None):
+        """Calculate the (weighted) sum of the log occupancies of the reads.
+        """
+        log_occs = -np.logaddexp(
+            0, (-chem_pot + ref_energy + np.asarray(ddgs, dtype=float))/(R*T))
+        if weights is None:
+            return log_occs.sum()
+        return weights.dot(log_occs)
+
+    def calc_binned_site_energy_dist(
+            self, base_offsets, ddg_array, n_used_bins, calc_features):
+        """Run the dynamic program that bins the random binding site energies.
+
+        base_offsets[pos, base] is the bin shift of each base. See
+        calc_binned_site_energy_dist in selex/__init__.py.
+        """
+        motif_len = len(base_offsets)
+        pdf = np.zeros(n_used_bins, dtype=float)
+        pdf[0] = 1.0
+        if calc_features:
+            weighted_vals = np.zeros((n_used_bins, 3*motif_len), dtype=float)
+        else:
+            weighted_vals = np.zeros(n_used_bins, dtype=float)
+        for pos in xrange(motif_len):
+            new_pdf = np.zeros(n_used_bins, dtype=float)
+            new_weighted_vals = np.zeros(weighted_vals.shape, dtype=float)
+            for base in xrange(4):
+                offset = base_offsets[pos, base]
+                n_shifted = n_used_bins - offset
+                new_pdf[offset:] += 0.25*pdf[:n_shifted]
+                new_weighted_vals[offset:] += 0.25*weighted_vals[:n_shifted]
+                # A is the reference base, so it doesn't change the coding or
+                # the energy
+                if base == 0: continue
+                if calc_features:
+                    new_weighted_vals[offset:, 3*pos+base-1] += (
+                        0.25*pdf[:n_shifted])
+                else:
+                    new_weighted_vals[offset:] += (
+                        0.25*pdf[:n_shifted]*ddg_array[3*pos+base-1])
+            pdf, weighted_vals = new_pdf, new_weighted_vals
+        return pdf, weighted_vals
+
+class NumbaBackend(NumpyBackend):
+    name = 'numba'
+
+    def __init__(self):
+        # import the kernels now, so that a missing numba is caught when the
+        # backend is chosen
+        from . import numba_kernels
+        self.kernels = numba_kernels
+
+    def build_energy_fn(self, coded_seqs):
+        coded_seqs = coded_seqs.get_value(borrow=True)
+        kernels = self.kernels
+        def calc_min_energies(ddg_array):
+            min_energies = np.zeros(len(coded_seqs), dtype=coded_seqs.dtype)
+            bs_indices = np.zeros(len(coded_seqs), dtype='int64')
+            kernels.calc_min_energies(
+                coded_seqs, np.asarray(ddg_array, dtype=coded_seqs.dtype),
+                min_energies, bs_indices)
+            return min_energies, bs_indices
+        return calc_min_energies
+
+    def build_read_energy_fn(self, coded_reads, motif_len):
+        coded_reads = np.ascontiguousarray(coded_reads)
+        kernels = self.kernels
+        floatX = self.floatX
+        def calc_min_energies(ddg_array):
+            fwd_lut, rc_lut = build_energy_luts(ddg_array, motif_len, floatX)
+            min_energies = np.zeros(len(coded_reads), dtype=floatX)
+            bs_indices = np.zeros(len(coded_reads), dtype='int64')
+            kernels.calc_min_read_energies(
+                coded_reads, fwd_lut, rc_lut, min_energies, bs_indices)
+            return min_energies, bs_indices
+        return calc_min_energies
+
+    def calc_log_occ_sum(self, chem_pot, ref_energy, ddgs, weights=None):
+        if weights is None:
+            weights = np.ones(len(ddgs))
+        return self.kernels.calc_log_occ_sum(
+            float(chem_pot), float(ref_energy), ddgs, weights, R*T)
+
+    def calc_binned_site_energy_dist(
+            self, base_offsets, ddg_array, n_used_bins, calc_features):
+        motif_len = len(base_offsets)
+        pdf = np.zeros(n_used_bins, dtype=float)
+        pdf[0] = 1.0
+        weighted_vals = np.zeros(
+            (n_used_bins, 3*motif_len if calc_features else 1), dtype=float)
+        # the energy of each base relative to A
+        base_energies = np.hstack((
+            np.zeros((motif_len, 1)),
+            np.asarray(ddg_array, dtype=float).reshape((motif_len, 3))))
+        self.kernels.calc_binned_site_energy_dist(
+            np.ascontiguousarray(base_offsets, dtype='int64'), base_energies,
+            pdf, weighted_vals, calc_features)
+        if not calc_features:
+            weighted_vals = weighted_vals[:,0]
+        return pdf, weighted_vals
+
+class TheanoBackend(NumpyBackend):
+    name = 'theano'
+
+    def __init__(self):
+        import theano
+        self.floatX = theano.config.floatX
+        self.compiled_fns = {}
+
+    def shared(self, array):
+        import theano
+        return theano.shared(np.array(array))
+
+    def load_or_compile_fn(self, name, build_fn, *args):
+        """Return the theano function built by build_fn(*args).
+
+        Each function is compiled once, and pickled into the theano compile
+        directory so that later processes can skip the graph optimization.
+        The pickle is keyed by a digest of build_fn's source, args and the
+        constants that the graphs use, so that a changed graph is rebuilt
+        rather than loaded from a stale pickle.
+        """
+        import theano
+        import cPickle as pickle
+        if name in self.compiled_fns:
+            return self.compiled_fns[name]
+        try:
+            source = inspect.getsource(build_fn)
+        except (IOError, TypeError):
+            source = marshal.dumps(build_fn.__code__)
+        digest = hashlib.sha1(repr((source, args, R, T))).hexdigest()
+        fname = os.path.join(
+            theano.config.compiledir, "pyTFbindtools.%s.%s.%s.%s.pkl" % (
+                name, digest[:16], theano.__version__, theano.config.floatX))
+        try:
+            with open(fname, "rb") as fp:
+                fn = pickle.load(fp)
+        except Exception:
+            fn = build_fn(*args)
+            # write to a temporary file and then move it, so that concurrent
+            # processes never load a partially written function
+            try:
+                with open(fname + ".%i.tmp" % os.getpid(), "wb") as ofp:
+                    pickle.dump(fn, ofp, pickle.HIGHEST_PROTOCOL)
+                os.rename(fname + ".%i.tmp" % os.getpid(), fname)
+            except (IOError, OSError, pickle.PicklingError):
+                pyTFbindtools.log(
+                    "Could not cache the theano function %s" % name, 'DEBUG')
+        self.compiled_fns[name] = fn
+        return fn
+
+    def build_energy_fn(self, coded_seqs):
+        import theano
+        import theano.tensor as TT
+        sym_e = TT.vector()
+        bs_energies = coded_seqs.dot(sym_e)
+        return theano.function(
+            [sym_e], [bs_energies.min(1), bs_energies.argmin(1)])
+
+    def calc_log_occ_sum(self, chem_pot, ref_energy, ddgs, weights=None):
+        if weights is None:
+            fn = self.load_or_compile_fn(
+                'calc_rnd_lhd_num', build_theano_log_occ_sum, False)
+            return fn(chem_pot, ref_energy, ddgs)
+        fn = self.load_or_compile_fn(
+            'calc_rnd_weighted_lhd_num', build_theano_log_occ_sum, True)
+        return fn(chem_pot, ref_energy, ddgs, weights)
+
+def build_theano_log_occ_sum(weighted):
+    import theano
+    import theano.tensor as TT
+    sym_cons_dg = TT.scalar('cons_dg')
+    sym_chem_pot = TT.scalar('chem_pot')
+    sym_ddg = TT.vector('ddg')
+    log_occs = -TT.log(1.0 + TT.exp(
+        (-sym_chem_pot + sym_cons_dg + sym_ddg)/(R*T)))
+    if not weighted:
+        return theano.function(
+            [sym_chem_pot, sym_cons_dg, sym_ddg], log_occs.sum())
+    sym_weights = TT.vector('weights')
+    return theano.function(
+        [sym_chem_pot, sym_cons_dg, sym_ddg, sym_weights],
+        (sym_weights*log_occs).sum())
+
+backend_types = {
+    'numpy': NumpyBackend, 'numba': NumbaBackend, 'theano': TheanoBackend }
+
+backend = None
+def set_backend(name='auto'):
+    """Set the compute backend ('auto', 'numpy', 'numba' or 'theano').
+
+    'auto' uses numba if it can be imported, and numpy otherwise.
+    """
+    global backend
+    if name not in BACKEND_NAMES:
+        raise ValueError, "Unrecognized backend '%s' (expected one of %s)" % (
+            name, ", ".join(BACKEND_NAMES))
+    if name == 'auto':
+        try:
+            backend = NumbaBackend()
+        except ImportError:
+            backend = NumpyBackend()
+    else:
+        backend = backend_types[name]()
+    pyTFbindtools.log("Using the %s backend" % backend.name, 'VERBOSE')
+    return backend
+
+def get_backend():
+    """Return the current compute backend.
+
+    If no backend has been set, then this sets the backend named by the
+    PYTFBINDTOOLS_BACKEND environment variable (which defaults to 'auto').
+    """
+    if backend is None:
+        set_backend(os.environ.get('PYTFBINDTOOLS_BACKEND', 'auto'))
+    return backend
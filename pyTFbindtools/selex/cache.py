@@ -0,0 +1,108 @@
+"""A persistent on-disk cache of numpy arrays.
+
+Each array is stored as a .npy file named by the hash of its key, and is
+loaded with mmap_mode='r', so cached coded reads and binding site tensors
+are paged in lazily (and shared between processes). The cache is kept under a
+size budget by deleting the least recently used files; the modification time
+of a file is updated whenever it is used.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+import pyTFbindtools
+
+# the default cache size budget, in bytes
+DEFAULT_MAX_SIZE = 50*2**30
+
+def file_checksum(fname, block_size=2**24):
+    """Calculate the sha1 checksum of the contents of fname.
+    """
+    checksum = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if block == "": break
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def array_checksum(array):
+    """Calculate the sha1 checksum of an array's shape, dtype and data.
+    """
+    checksum = hashlib.sha1()
+    checksum.update(repr((array.shape, array.dtype.str)))
+    checksum.update(np.ascontiguousarray(array).data)
+    return checksum.hexdigest()
+
+class ArrayCache(object):
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _fname(self, key):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(repr(key)).hexdigest() + ".npy")
+
+    def load(self, key):
+        """Load the array stored under key, or return None.
+        """
+        fname = self._fname(key)
+        try:
+            array = np.load(fname, mmap_mode='r')
+            # mark this entry as recently used
+            os.utime(fname, None)
+        except (IOError, OSError):
+            return None
+        return array
+
+    def save(self, key, array):
+        """Store array under key, and return the memory mapped copy.
+        """
+        fname = self._fname(key)
+        # write to a temporary file and then move it, so that other processes
+        # never see a partially written array
+        fd, tmp_fname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as ofp:
+            np.save(ofp, np.asarray(array))
+        os.rename(tmp_fname, fname)
+        self.evict(keep=fname)
+        return np.load(fname, mmap_mode='r')
+
+    def get(self, key, build_array):
+        """Return the array stored under key, building it if necessary.
+        """
+        array = self.load(key)
+        if array is None:
+            pyTFbindtools.log("Cache miss for %s" % (key,), 'DEBUG')
+            array = self.save(key, build_array())
+        return array
+
+    def evict(self, keep=None):
+        """Delete the least recently used arrays until the cache fits.
+
+        The file keep (e.g. the array that was just saved) is never deleted.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".npy"): continue
+            fname = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        total_size = sum(size for mtime, size, fname in entries)
+        for mtime, size, fname in sorted(entries):
+            if total_size <= self.max_size: break
+            if fname == keep: continue
+            # another process may have already removed this file
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total_size -= size
+        return
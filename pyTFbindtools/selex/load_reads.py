@@ -0,0 +1,153 @@
+"""Load SELEX reads into coded uint8 read matrices.
+
+Reads are parsed a block at a time, so only the sequence lines of the current
+block are ever held as strings, and each kept read is stored as one byte per
+base (A,C,G,T -> 0,1,2,3). Rounds are loaded in parallel threads (gzip
+decompression releases the GIL).
+"""
+import os
+import gzip
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import pyTFbindtools
+
+from ..motif_tools import base_code_table
+from .cache import file_checksum
+
+# the number of (decompressed) bytes to parse at once
+BLOCK_SIZE = 2**24
+# the number of reads in each chunk yielded by iter_coded_read_chunks
+CHUNK_SIZE = 1000000
+
+def rnd_from_fname(fname):
+    """Parse the SELEX round from a file name (e.g. 'ALX1_TGA40NTG_3.fastq.gz').
+    """
+    return int(os.path.basename(fname).split("_")[-1].split(".")[0])
+
+def iter_seq_lines(fname, block_size=BLOCK_SIZE):
+    """Iterate over blocks of sequence lines in a (gzipped) fastq or text file.
+
+    Text files are expected to contain one read per line.
+    """
+    opener = gzip.open if fname.endswith(".gz") else open
+    is_fastq = (".fastq" in fname or ".fq" in fname)
+    line_i = 0
+    remainder = ""
+    with opener(fname) as fp:
+        while True:
+            block = fp.read(block_size)
+            lines = (remainder + block).split("\n")
+            # the last line may be incomplete, so save it for the next block
+            remainder = lines.pop() if block != "" else ""
+            if is_fastq:
+                seq_lines = lines[(1-line_i)%4::4]
+                line_i += len(lines)
+            else:
+                seq_lines = lines
+            yield [line.strip() for line in seq_lines]
+            if block == "":
+                break
+    return
+
+def iter_coded_read_chunks(fname, read_len=None, max_Ns=0,
+                           chunk_size=CHUNK_SIZE):
+    """Iterate over chunks of coded reads from fname.
+
+    Reads whose length differs from read_len (which defaults to the length of
+    the first read) and reads with more than max_Ns N's are skipped. The
+    remaining N's are replaced with a random base. Yields
+    (<=chunk_size, read_len) uint8 matrices.
+    """
+    buffered_seqs = []
+    n_buffered = 0
+    for seqs in iter_seq_lines(fname):
+        if read_len is None:
+            non_empty_seqs = [seq for seq in seqs if seq != ""]
+            if len(non_empty_seqs) == 0: continue
+            read_len = len(non_empty_seqs[0])
+        seqs = [seq for seq in seqs if len(seq) == read_len]
+        buffered_seqs.extend(seqs)
+        n_buffered += len(seqs)
+        while n_buffered >= chunk_size:
+            yield code_and_filter_reads(
+                buffered_seqs[:chunk_size], read_len, max_Ns)
+            buffered_seqs = buffered_seqs[chunk_size:]
+            n_buffered -= chunk_size
+    if n_buffered > 0:
+        yield code_and_filter_reads(buffered_seqs, read_len, max_Ns)
+    return
+
+def code_and_filter_reads(seqs, read_len, max_Ns):
+    coded_reads = base_code_table[
+        np.frombuffer("".join(seqs), dtype='uint8')].reshape(
+            (len(seqs), read_len))
+    is_N = (coded_reads > 3)
+    coded_reads = coded_reads[is_N.sum(1) <= max_Ns]
+    is_N = (coded_reads > 3)
+    coded_reads[is_N] = np.random.randint(4, size=is_N.sum())
+    return coded_reads
+
+def load_coded_reads(fname, read_len=None, max_Ns=0, max_num_reads=None):
+    """Load the reads in fname into a (n_reads, read_len) uint8 matrix.
+
+    If max_num_reads is set, then a uniform random subsample of max_num_reads
+    reads is returned. The subsample is found by giving each read a random
+    key and keeping the reads with the smallest keys, so memory is bounded
+    by the size of the subsample rather than by the size of the file.
+    """
+    chunks = []
+    if max_num_reads is None:
+        for chunk in iter_coded_read_chunks(fname, read_len, max_Ns):
+            chunks.append(chunk)
+    else:
+        chunk_size = max(CHUNK_SIZE, max_num_reads)
+        keys = np.zeros(0)
+        for chunk in iter_coded_read_chunks(
+                fname, read_len, max_Ns, chunk_size):
+            chunks.append(chunk)
+            keys = np.concatenate((keys, np.random.random(len(chunk))))
+            chunks = [np.concatenate(chunks),]
+            if len(keys) > max_num_reads:
+                # keep the reads in file order
+                kept = np.sort(np.argpartition(keys, max_num_reads)[
+                    :max_num_reads])
+                keys = keys[kept]
+                chunks = [chunks[0][kept],]
+    if len(chunks) == 0:
+        return np.zeros((0, 0 if read_len is None else read_len),
+                        dtype='uint8')
+    return np.concatenate(chunks)
+
+def load_rounds(fnames, read_len=None, max_Ns=0, max_num_reads=None,
+                n_threads=None, cache=None):
+    """Load the reads of each SELEX round, ordered by round number.
+
+    The rounds are loaded in n_threads threads (defaults to one per round).
+    If cache (an ArrayCache) is set, then the coded reads are stored in it,
+    keyed by the file contents and the loading parameters. Note that a cached
+    subsample is reused, rather than re-drawn.
+    """
+    fnames = sorted(fnames, key=rnd_from_fname)
+    def load(fname):
+        pyTFbindtools.log("Loading reads from '%s'" % fname, 'VERBOSE')
+        if cache is None:
+            return load_coded_reads(fname, read_len, max_Ns, max_num_reads)
+        key = ('coded_reads', file_checksum(fname), 
+               read_len, max_Ns, max_num_reads)
+        return cache.get(key, lambda: load_coded_reads(
+            fname, read_len, max_Ns, max_num_reads))
+    if n_threads is None:
+        n_threads = len(fnames)
+    if n_threads <= 1 or len(fnames) == 1:
+        rnds_and_reads = [load(fname) for fname in fnames]
+    else:
+        pool = ThreadPool(min(n_threads, len(fnames)))
+        rnds_and_reads = pool.map(load, fnames)
+        pool.close()
+        pool.join()
+    assert len(set(reads.shape[1] for reads in rnds_and_reads)) == 1, \
+        "The reads in every round must be the same length"
+    return rnds_and_reads
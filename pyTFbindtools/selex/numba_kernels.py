@@ -0,0 +1,101 @@
+"""numba implementations of the SELEX likelihood kernels.
+
+This module is only imported by NumbaBackend (see backends.py), so numba is
+an optional dependency. The compiled kernels are cached on disk.
+"""
+import numpy as np
+
+import numba
+
+@numba.njit(cache=True)
+def calc_min_energies(coded_seqs, ddg_array, min_energies, bs_indices):
+    """Find the minimum binding site energy of each read (in place).
+
+    This fuses the matmul and min, so the energy of every binding site is 
+    never stored.
+    """
+    n_seqs, n_bind_sites, n_features = coded_seqs.shape
+    for i in range(n_seqs):
+        for j in range(n_bind_sites):
+            energy = 0.0
+            for k in range(n_features):
+                energy += coded_seqs[i,j,k]*ddg_array[k]
+            if j == 0 or energy < min_energies[i]:
+                min_energies[i] = energy
+                bs_indices[i] = j
+
+@numba.njit(cache=True)
+def calc_min_read_energies(
+        coded_reads, fwd_lut, rc_lut, min_energies, bs_indices):
+    """Find the minimum binding site energy of each coded read (in place).
+
+    The energy of each site is the sum of the lookup table values of its 
+    bases (see backends.build_energy_luts), and the sites are indexed in the
+    order of code_binding_sites.
+    """
+    n_seqs, read_len = coded_reads.shape
+    motif_len = fwd_lut.shape[0]
+    n_offsets = read_len - motif_len + 1
+    for i in range(n_seqs):
+        for offset in range(n_offsets):
+            fwd_energy = 0.0
+            rc_energy = 0.0
+            for pos in range(motif_len):
+                base = coded_reads[i, offset+pos]
+                fwd_energy += fwd_lut[pos, base]
+                rc_energy += rc_lut[pos, base]
+            if offset == 0 or fwd_energy < min_energies[i]:
+                min_energies[i] = fwd_energy
+                bs_indices[i] = 2*offset
+            if rc_energy < min_energies[i]:
+                min_energies[i] = rc_energy
+                bs_indices[i] = 2*offset + 1
+
+@numba.njit(cache=True)
+def calc_log_occ_sum(chem_pot, ref_energy, ddgs, weights, kT):
+    """Calculate the weighted sum of the log occupancies of the reads.
+    """
+    res = 0.0
+    for i in range(len(ddgs)):
+        x = (-chem_pot + ref_energy + ddgs[i])/kT
+        # -log(1 + exp(x)), without overflow
+        if x > 0:
+            res -= weights[i]*(x + np.log1p(np.exp(-x)))
+        else:
+            res -= weights[i]*np.log1p(np.exp(x))
+    return res
+
+@numba.njit(cache=True)
+def calc_binned_site_energy_dist(
+        base_offsets, base_energies, pdf, weighted_vals, calc_features):
+    """Run the binned site energy dynamic program (in place).
+
+    pdf should start with all of its mass in the first bin, and 
+    weighted_vals should be zero. If calc_features is False, the energies
+    are accumulated in the first column of weighted_vals.
+    """
+    motif_len = base_offsets.shape[0]
+    n_used_bins = pdf.shape[0]
+    new_pdf = np.zeros_like(pdf)
+    new_weighted_vals = np.zeros_like(weighted_vals)
+    for pos in range(motif_len):
+        new_pdf[:] = 0
+        new_weighted_vals[:,:] = 0
+        for base in range(4):
+            offset = base_offsets[pos, base]
+            for i in range(n_used_bins - offset):
+                mass = 0.25*pdf[i]
+                if mass == 0: continue
+                new_pdf[i+offset] += mass
+                for k in range(weighted_vals.shape[1]):
+                    new_weighted_vals[i+offset,k] += 0.25*weighted_vals[i,k]
+                # A is the reference base, so it doesn't change the coding or
+                # the energy
+                if base == 0: continue
+                if calc_features:
+                    new_weighted_vals[i+offset,3*pos+base-1] += mass
+                else:
+                    new_weighted_vals[i+offset,0] += (
+                        mass*base_energies[pos, base])
+        pdf[:] = new_pdf
+        weighted_vals[:,:] = new_weighted_vals
@@ -0,0 +1,116 @@
+"""DNA shape features for coded reads.
+
+The shape parameters of the central base of every fivemer are stored in a
+(1024, 6) float32 table (shape_data/fivemer_shape_table.npy), indexed by the
+fivemer's 2-bit code (A,C,G,T -> 0,1,2,3, with the first base in the most
+significant bits). The columns are HelT (left and right step), MGW, ProT,
+and Roll (left and right step). The table is built from the text files in
+shape_data/ by running this module:
+
+    python -m pyTFbindtools.selex.shape
+"""
+import os
+
+import numpy as np
+
+SHAPE_DATA_DIR = os.path.join(os.path.dirname(__file__), 'shape_data')
+SHAPE_TABLE_FNAME = os.path.join(SHAPE_DATA_DIR, 'fivemer_shape_table.npy')
+N_SHAPE_PARAMS = 6
+
+_shape_table = None
+
+def code_fivemer(fivemer):
+    """Return the 2-bit code of a fivemer string.
+    """
+    code = 0
+    for base in fivemer.upper():
+        code = 4*code + 'ACGT'.index(base)
+    return code
+
+def build_shape_table():
+    """Parse the shape text files into a (1024, N_SHAPE_PARAMS) table.
+    """
+    # HelT and Roll are measured at base steps, so the files contain 4
+    # values, and we use the steps on either side of the central base. MGW and
+    # ProT are measured at bases, so we use the value of the central base.
+    param_fnames_and_cols = [
+        ("all_fivemers.HelT", (1,2)),
+        ("all_fivemers.MGW", (2,)),
+        ("all_fivemers.ProT", (2,)),
+        ("all_fivemers.Roll", (1,2))]
+    shape_table = np.zeros((4**5, N_SHAPE_PARAMS), dtype='float32')
+    start_col = 0
+    for fname, cols in param_fnames_and_cols:
+        with open(os.path.join(SHAPE_DATA_DIR, fname)) as fp:
+            for data in fp.read().strip().split(">")[1:]:
+                seq, params = data.split()
+                params = params.split(";")
+                for i, col in enumerate(cols):
+                    shape_table[code_fivemer(seq), start_col+i] = float(
+                        params[col])
+        start_col += len(cols)
+    return shape_table
+
+def load_shape_table():
+    """Load the fivemer shape table (it is only read from disk once).
+    """
+    global _shape_table
+    if _shape_table is None:
+        _shape_table = np.load(SHAPE_TABLE_FNAME)
+        _shape_table.flags.writeable = False
+    return _shape_table
+
+def est_shape_params_for_reads(coded_reads):
+    """Estimate the shape parameters at every base of the coded reads.
+
+    Returns a (n_seqs, read_len, N_SHAPE_PARAMS) float32 array. The first
+    and last two bases of each read don't have a complete fivemer, so their
+    shape parameters are set to zero (like fivemers containing an N).
+    """
+    coded_reads = np.asarray(coded_reads)
+    n_seqs, read_len = coded_reads.shape
+    shape_params = np.zeros(
+        (n_seqs, read_len, N_SHAPE_PARAMS), dtype='float32')
+    if read_len < 5: return shape_params
+    codes = np.zeros((n_seqs, read_len-4), dtype='int64')
+    for i in xrange(5):
+        codes = 4*codes + coded_reads[:,i:read_len-4+i]
+    shape_params[:,2:read_len-2,:] = load_shape_table()[codes]
+    return shape_params
+
+def code_shape_features(coded_reads, motif_len, dtype):
+    """Code the shape parameters of all of the binding sites in coded_reads.
+
+    Returns a (n_seqs, n_bind_sites, N_SHAPE_PARAMS*motif_len) array, with
+    the forward and reverse complement binding sites interleaved (in the same
+    order as code_binding_sites). The shape parameters of a reverse
+    complement binding site are calculated from the reverse complement
+    strand, so its flanks are the reverse complements of the opposite flanks.
+    """
+    coded_reads = np.asarray(coded_reads)
+    n_seqs, read_len = coded_reads.shape
+    n_offsets = read_len - motif_len + 1
+    coded_shapes = np.empty(
+        (n_seqs, 2*n_offsets, N_SHAPE_PARAMS*motif_len), dtype=dtype)
+
+    def build_windows(reads):
+        shape_params = np.ascontiguousarray(
+            est_shape_params_for_reads(reads), dtype=dtype)
+        return np.lib.stride_tricks.as_strided(
+            shape_params,
+            shape=(n_seqs, n_offsets, N_SHAPE_PARAMS*motif_len),
+            strides=(shape_params.strides[0],
+                     shape_params.strides[1],
+                     shape_params.strides[2]))
+
+    coded_shapes[:,0::2,:] = build_windows(coded_reads)
+    coded_shapes[:,1::2,:] = build_windows(3 - coded_reads[:,::-1])[:,::-1,:]
+    return coded_shapes
+
+def main():
+    shape_table = build_shape_table()
+    np.save(SHAPE_TABLE_FNAME, shape_table)
+    print "Wrote %s" % SHAPE_TABLE_FNAME
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ from motif_tools import load_motifs, logistic, R, T, DeltaDeltaGArray, logit
 from itertools import product, izip
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 from scipy.signal import fftconvolve
 
@@ -78,6 +77,7 @@ def est_partition_fn(ref_energy, ddg_array, n_bins=NBINS):
 
 
 def cmp_to_brute():
+    import matplotlib.pyplot as plt
     motif = load_motifs(sys.argv[1]).values()[0][0]
     ref_energy, ddg_array = motif.build_ddg_array()
     x, part_fn = est_partition_fn(ref_energy, ddg_array, NBINS)
@@ -93,4 +93,45 @@ def cmp_to_brute():
 
     return
 
-cmp_to_brute()
+def cmp_dp_to_brute(motif_lens=(4, 5, 6), n_bind_sites=(1, 10, 62), 
+                    tol=1e-5):
+    """Check the DP partition function against brute force enumeration.
+
+    The DP estimate treats every binding site as an independent random site,
+    so we enumerate every sequence of the motif length, score its forward 
+    strand, and take the minimum over n_bind_sites sites from the sorted 
+    energies. We compare the mean energy and the mean occupancy at several
+    chemical potentials.
+    """
+    from pyTFbindtools.selex import est_partition_fn_dp, code_seqs
+    np.random.seed(0)
+    for motif_len in motif_lens:
+        ddg_array = np.random.uniform(-1, 3, 3*motif_len).astype(
+            'float32').view(DeltaDeltaGArray)
+        ref_energy = -5.0
+        seqs = np.array(list(product(range(4), repeat=motif_len)), 
+                        dtype='uint8')
+        brute_energies = np.sort(ref_energy + code_seqs(
+            seqs, motif_len, ON_GPU=False)[:,0].dot(ddg_array))
+        cdf = np.arange(1, len(seqs)+1, dtype=float)/len(seqs)
+        for n_bs in n_bind_sites:
+            energies, part_fn = est_partition_fn_dp(
+                ref_energy, ddg_array, n_bs, motif_len)
+            brute_part_fn = np.diff(np.insert(1 - (1 - cdf)**n_bs, 0, 0.0))
+            errors = [ abs(part_fn.sum() - 1), 
+                       abs((part_fn*energies).sum() 
+                           - (brute_part_fn*brute_energies).sum()) ]
+            for chem_pot in (-10, -5, 0):
+                errors.append(abs(
+                    (part_fn*logistic((chem_pot-energies)/(R*T))).sum()
+                    - (brute_part_fn*logistic(
+                        (chem_pot-brute_energies)/(R*T))).sum()))
+            print motif_len, n_bs, max(errors)
+            assert max(errors) < tol
+    return
+
+if __name__ == '__main__':
+    cmp_dp_to_brute()
+    # plot the fft estimate against brute force for a motif file
+    if len(sys.argv) > 1:
+        cmp_to_brute()
@@ -0,0 +1,89 @@
+"""Measure the import time of each command line entry point.
+
+Each module is imported in a fresh interpreter (so nothing is already in
+sys.modules), and we report the time spent in the import statement and the
+wall clock time of the whole process.
+
+usage: python scripts/benchmark_import_time.py [--n-runs N] [modules ...]
+"""
+import os, sys
+import time
+import subprocess
+
+import numpy as np
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# modules are imported with both the repo and bin/ on the path, so the bin
+# scripts can be imported by name (they all have main guards)
+ENTRY_POINTS = [
+    'pyTFbindtools.motif_tools',
+    'pyTFbindtools.selex',
+    'pyTFbindtools.score_genomic_regions',
+    'pyTFbindtools.predictTFPeaks',
+    'fit_selex',
+    'fit_selex_batch',
+    'fit_selex_from_db',
+]
+
+IMPORT_TIMER = """
+import time
+start = time.time()
+import %s
+print time.time() - start
+"""
+
+def time_import(module_name):
+    """Import module_name in a new interpreter.
+
+    Returns (import time, process time), or None if the import failed.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [BASE_DIR, os.path.join(BASE_DIR, 'bin')]
+        + env.get('PYTHONPATH', '').split(os.pathsep))
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-c', IMPORT_TIMER % module_name],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    process_time = time.time() - start
+    if proc.returncode != 0:
+        print >> sys.stderr, "Failed to import %s:\n%s" % (
+            module_name, stderr.strip().split("\n")[-1])
+        return None
+    return float(stdout.strip().split("\n")[-1]), process_time
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of each entry point.')
+    parser.add_argument( 'modules', nargs='*', default=ENTRY_POINTS,
+        help='The modules to import (default: all of the entry points).')
+    parser.add_argument( '--n-runs', type=int, default=5,
+        help='The number of times to import each module.')
+    args = parser.parse_args()
+    return args.modules, args.n_runs
+
+def main():
+    modules, n_runs = parse_arguments()
+    print "\t".join(("module", "import_median", "import_min", "process_median"))
+    for module_name in modules:
+        timings = []
+        for i in xrange(n_runs):
+            res = time_import(module_name)
+            if res is None: break
+            timings.append(res)
+        if len(timings) == 0:
+            print "%s\tNA\tNA\tNA" % module_name
+            continue
+        timings = np.array(timings)
+        print "%s\t%.3f\t%.3f\t%.3f" % (
+            module_name,
+            np.median(timings[:,0]),
+            timings[:,0].min(),
+            np.median(timings[:,1]))
+    return
+
+if __name__ == '__main__':
+    main()
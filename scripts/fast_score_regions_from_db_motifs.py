@@ -6,7 +6,7 @@ import cPickle as pickle
 
 import psycopg2
 
-from pysam import FastaFile, TabixFile
+from pysam import TabixFile
 
 #import pyximport; pyximport.install()
 #import score_seq
@@ -16,7 +16,9 @@ import grit
 from grit.lib.multiprocessing_utils import fork_and_wait, ThreadSafeFile
 
 
-from motif_tools import load_all_pwms_from_db as load_all_pwms, score_seq
+from motif_tools import (
+    load_pwms_from_db as load_all_pwms, score_region, MotifLibrary )
+from coded_genome import load_genome, reload_genome
 
 def load_regions_in_bed(fp):
     regions = []
@@ -29,7 +31,7 @@ def load_regions_in_bed(fp):
     return regions
 
 def score_regions_worker(ofp, genome, regions_queue, motifs):
-    genome = FastaFile(genome.filename)
+    genome = reload_genome(genome)
     while regions_queue.qsize() > 0:
         region = regions_queue.get()
         print regions_queue.qsize()
@@ -55,12 +57,12 @@ def main():
     genome_fname = sys.argv[1]
     regions_fname = sys.argv[2]
 
-    genome = FastaFile(genome_fname)
+    genome = load_genome(genome_fname)
     print "Loaded genome"
     with open(regions_fname) as fp:
         regions = load_regions_in_bed(fp)
     print "Loaded regions"
-    motifs = load_all_pwms()
+    motifs = MotifLibrary(load_all_pwms())
     print "Loaded motifs"
 
     import cProfile
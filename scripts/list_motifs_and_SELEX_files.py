@@ -1,6 +1,5 @@
 import os, sys
 from collections import defaultdict
-import psycopg2
 
 aliases = {
     'ZNF306': 'ZKSCAN3',
@@ -21,6 +20,9 @@ aliases = {
     'Zfp652': 'ZNF652',
 }
 
+DNA_CONC = 7.5e-8
+PROT_CONC = 3e-09
+
 def parse_input_files(base_dir):
     selex_files = defaultdict(list)
     for fname in os.listdir(base_dir):
@@ -39,10 +41,32 @@ def parse_input_files(base_dir):
             (rnd, os.path.join(base_dir, fname)))
     return selex_files
 
+def write_manifest(selex_files, ofp):
+    """Write a manifest of the SELEX experiments for fit_selex_batch.py.
+
+    Each line contains the experiment name, the DNA and protein 
+    concentrations, and the comma separated round files.
+    """
+    for (factor, primer), rnds_and_fnames in sorted(selex_files.items()):
+        fnames = [fname for rnd, fname in sorted(rnds_and_fnames)]
+        ofp.write("\t".join((
+            "%s_%s" % (factor, primer), 
+            "%e" % DNA_CONC, "%e" % PROT_CONC, 
+            ",".join(fnames))) + "\n")
+    return
+
 def main():
     selex_dir = "/mnt/data/TF_binding/in_vitro/HT_SELEX/"
     selex_files = parse_input_files(selex_dir)
 
+    # if an output file is specified, write a manifest rather than loading 
+    # the experiments into the DB
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "w") as ofp:
+            write_manifest(selex_files, ofp)
+        return
+    
+    import psycopg2
     conn = psycopg2.connect("host=mitra dbname=cisbp user=nboley")
     cur = conn.cursor()
     
@@ -58,9 +82,10 @@ def main():
         cur.execute(query)
         selex_exp_id = cur.fetchall()[0][0]
         for rnd, fname in sorted(rnds_and_fnames):
-            query = "INSERT INTO selex_round VALUES (%i, %i, '%s', 7.5e-8, 3e-09, '%s')" % (selex_exp_id, rnd, primer, fname)
+            query = "INSERT INTO selex_round VALUES (%i, %i, '%s', %e, %e, '%s')" % (selex_exp_id, rnd, primer, DNA_CONC, PROT_CONC, fname)
             cur.execute(query)
     conn.commit()
     return
 
-main()    
+if __name__ == '__main__':
+    main()
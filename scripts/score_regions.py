@@ -1,6 +1,7 @@
 import os, sys
 sys.path.insert(0, "/users/nboley/src/TF_binding/")
-from motif_tools import Motif, logistic, R, T
+from motif_tools import Motif, MotifLibrary, logistic, R, T, fetch_coded_seq
+from coded_genome import load_genome
 from selex import code_sequence
 
 import numpy as np
@@ -10,7 +11,7 @@ from scipy.signal import fftconvolve
 import psycopg2
 import psycopg2.extras
 
-from pysam import FastaFile, TabixFile
+from pysam import TabixFile
 
 def load_all_motifs():
     conn = psycopg2.connect("host=mitra dbname=cisbp")
@@ -44,35 +45,15 @@ def load_regions_in_bed(fp):
         regions.append((contig, start, stop))
     return regions
 
-def score_region(motifs, seq):
-    # code the sequence
-    coded_seq = {}
-    for base in 'ACGT':
-        coded_seq[base] = np.zeros(len(seq), dtype='float32')
-    for i, base in enumerate(seq.upper()):
-        coded_seq[base][i] = 1
-    coded_RC_seq = {}
-    for base in 'TGCA':
-        coded_seq[base] = np.zeros(len(seq), dtype='float32')
-
-
-    motif_scores = []
-    for motif in motifs:
-        score_mat = motif.motif_data
-        scores = np.zeros(len(seq)-len(score_mat)+1, dtype='float32')
-        for base, base_scores in zip('ACGT', score_mat.T):
-            scores += np.convolve(coded_seq[base], base_scores, mode='valid')
-
-        for i, base in enumerate(seq.upper()):
-            coded_seq[base][len(seq)-i-1] = 1
-        RC_scores = np.zeros(len(seq)-len(score_mat)+1, dtype='float32')
-        for base, base_scores in zip('TCGA', score_mat.T):
-            scores += np.convolve(coded_seq[base], base_scores, mode='valid')
-
-        max_scores = np.vstack((scores, RC_scores)).max(0)
-        motif_scores.append( max_scores.mean() )
-
-    return np.array(motif_scores)
+def score_region(motifs, coded_seq):
+    # score both strands of every offset against all of the motifs at once. 
+    # The library scores are negated energies that include the consensus 
+    # energy, so convert them back to the (positive) energies relative to 
+    # the consensus, and average over the offsets
+    scores = motifs.score_coded_seq(coded_seq, both_strands=True)
+    consensus_energies = np.array(
+        [motif.consensus_energy for motif in motifs])
+    return -np.nanmean(scores, axis=1) - consensus_energies
 
 ChIPseq_peaks = TabixFile(
     "/mnt/data/TF_binding/in_vivo/ENCODE/CHiP_seq_peaks/human_ENCODE_TFS.bed.gz")
@@ -90,9 +71,9 @@ def main():
     genome_fname = sys.argv[1]
     regions_fname = sys.argv[2]
     
-    genome = FastaFile(genome_fname)
+    genome = load_genome(genome_fname)
     print "Loaded genome"
-    motifs = load_all_motifs()
+    motifs = MotifLibrary(load_all_motifs())
     tfname_id_map = load_tfname_tfid_mapping()
     print "Loaded Motifs"
     with open(regions_fname) as fp:
@@ -126,8 +107,8 @@ def main():
             motif.factor for motif in motifs]) +"\n")
         for i, region in enumerate(regions):
             if i%100 == 0: print i, len(regions), os.path.basename(regions_fname)
-            seq = genome.fetch(*region).upper()
-            try: scores = score_region(motifs, seq)
+            coded_seq = fetch_coded_seq(genome, *region)
+            try: scores = score_region(motifs, coded_seq)
             except: continue
             ofp.write("%s\t%s\n" % (
                       "_".join(map(str, region)).ljust(30), 